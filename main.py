@@ -50,4 +50,7 @@ def main():
     qapp.exec_()
 
 if __name__ == '__main__':
+    import multiprocessing
+    #worker processes of a frozen build start by running this script
+    multiprocessing.freeze_support()
     main()
@@ -20,7 +20,7 @@ setup(
                                   'plugins/*.py','plugins/icons/*.png',
                                   'datasets/*.csv']},
     install_requires=['matplotlib>=3.0',
-                      'pandas>=1.1',
+                      'pandas>=1.5',
                       'PySide2', #comment out for snap building
                       'xlrd>=1.0',
                       'openpyxl'
@@ -29,7 +29,7 @@ from .qt import *
 import pandas as pd
 from .core import DataFrameModel, DataFrameTable, DataFrameWidget
 from .plotting import PlotViewer
-from . import util, core, dialogs, widgets, plotting
+from . import util, core, dialogs, widgets, plotting, jobs, readers
 
 homepath = os.path.expanduser("~")
 module_path = os.path.dirname(os.path.abspath(__file__))
@@ -172,8 +172,16 @@ class Application(QMainWindow):
         docks['labels'].raise_()
         self.docks = docks
 
+        #background job queue
+        dock = self.jobsdock = QDockWidget('任务队列')
+        dock.setStyleSheet(dockstyle)
+        dock.setWidget(jobs.JobsPanel(dock))
+        self.addDockWidget(QtCore.Qt.BottomDockWidgetArea, dock)
+        dock.hide()
+        self.docks['jobs'] = dock
+
         #add dock menu items
-        for name in ['general','format','labels','axes']:
+        for name in ['general','format','labels','axes','jobs']:
             action = self.docks[name].toggleViewAction()
             self.dock_menu.addAction(action)
             action.setCheckable(True)
@@ -272,6 +280,11 @@ class Application(QMainWindow):
             core.TIMEFORMAT = s.value("timeformat")
             core.PRECISION = int(s.value("precision"))
             core.SHOWPLOTTER = util.valueToBool(s.value("showplotter"))
+            core.SEARCHINDEX = util.valueToBool(s.value("searchindex"))
+            core.BITMAPINDEX = util.valueToBool(s.value("bitmapindex"))
+            core.UNDOLEVELS = int(s.value("undolevels"))
+            core.UNDOMEMORY = int(s.value("undomemory"))
+            core.OPTIMIZETYPES = util.valueToBool(s.value("optimizetypes"))
             core.PLOTSTYLE = s.value("plotstyle")
             core.DPI = int(s.value("dpi"))
             import matplotlib as mpl
@@ -302,6 +315,11 @@ class Application(QMainWindow):
         self.settings.setValue('timeformat', core.TIMEFORMAT)
         self.settings.setValue('precision', core.PRECISION)
         self.settings.setValue('showplotter', core.SHOWPLOTTER)
+        self.settings.setValue('searchindex', core.SEARCHINDEX)
+        self.settings.setValue('bitmapindex', core.BITMAPINDEX)
+        self.settings.setValue('undolevels', core.UNDOLEVELS)
+        self.settings.setValue('undomemory', core.UNDOMEMORY)
+        self.settings.setValue('optimizetypes', core.OPTIMIZETYPES)
         self.settings.setValue('plotstyle', core.PLOTSTYLE)
         self.settings.setValue('dpi', core.DPI)
         self.settings.setValue('recent_files',','.join(self.recent_files))
@@ -397,6 +415,8 @@ class Application(QMainWindow):
         self.file_menu.addAction('批量导入', self.importMultiple)
         self.file_menu.addAction('导入 Pickle 文件', self.importPickle)
         self.file_menu.addAction('导入 HDF5', self.importHDF)
+        self.file_menu.addAction('导入 Parquet 文件', self.importParquet)
+        self.file_menu.addAction('映射 Arrow/Feather 文件', self.importArrow)
         self.file_menu.addAction('导入 URL', self.importURL)
         self.file_menu.addAction('导出为', self.exportAs)
         icon = QIcon(os.path.join(iconpath,'application-exit.png'))
@@ -409,6 +429,8 @@ class Application(QMainWindow):
         self.undo_item = self.edit_menu.addAction('撤销', self.undo,
                 QtCore.Qt.CTRL + QtCore.Qt.Key_Z)
         #self.undo_item.setDisabled(True)
+        self.redo_item = self.edit_menu.addAction('重做', self.redo,
+                QtCore.Qt.CTRL + QtCore.Qt.Key_Y)
         icon = QIcon(os.path.join(iconpath,'copy.png'))
         self.edit_menu.addAction(icon, '复制', self.copy)
         icon = QIcon(os.path.join(iconpath,'paste.png'))
@@ -418,6 +440,8 @@ class Application(QMainWindow):
         icon = QIcon(os.path.join(iconpath,'findreplace.png'))
         self.edit_menu.addAction(icon, '查找/替换', self.findReplace,
                 QtCore.Qt.CTRL + QtCore.Qt.Key_F)
+        self.edit_menu.addAction('跳转到值', self.goToValue,
+                QtCore.Qt.CTRL + QtCore.Qt.Key_G)
         icon = QIcon(os.path.join(iconpath,'preferences-system.png'))
         self.edit_menu.addAction(icon, '首选项', self.preferences)
 
@@ -471,6 +495,7 @@ class Application(QMainWindow):
         icon = QIcon(os.path.join(iconpath,'table-duplicates.png'))
         self.tools_menu.addAction(icon, '查找重复', lambda: self._call('findDuplicates'))
         self.tools_menu.addAction('转换为数值', lambda: self._call('convertNumeric'))
+        self.tools_menu.addAction('优化内存', lambda: self._call('optimizeMemory'))
         self.tools_menu.addAction('格式化列名', lambda: self._call('convertColumnNames'))
         self.tools_menu.addAction('时间序列重采样', lambda: self._call('resample'))
         icon = QIcon(os.path.join(iconpath,'tabletotext.png'))
@@ -595,7 +620,10 @@ class Application(QMainWindow):
                     meta = data[s]['meta']
                 else:
                     meta=None
-                self.addSheet(s, df, meta)
+                model = None
+                if 'arrowfile' in data[s]:
+                    model = self.openArrowModel(data[s]['arrowfile'])
+                self.addSheet(s, df, meta, model=model)
             if 'scratch_items' in data:
                 self.scratch_items = data['scratch_items']
             #set current sheet
@@ -663,7 +691,7 @@ class Application(QMainWindow):
         if not os.path.splitext(filename)[1] == '.txpl':
             filename += '.txpl'
         self.filename = filename
-        self.do_saveProject(filename)
+        self.saveWithProgress(filename)
         self.addRecentFile(filename)
         self.proj_label.setText(self.filename)
         return
@@ -688,13 +716,19 @@ class Application(QMainWindow):
         return
 
     def saveWithProgress(self, filename):
-        """Save with progress bar"""
+        """Save with progress bar, as a job after any running on the project"""
 
         self.savedlg = dlg = dialogs.ProgressWidget(label='Saving to %s' %filename)
         dlg.show()
-        def func(progress_callback):
-            self.do_saveProject(self.filename)
-        self.run_threaded_process(func, self.processing_completed)
+        dlg.progressbar.setRange(0,0)
+        def error(e):
+            self.processing_completed()
+            dialogs.showMessage(self, str(e))
+        #sheets are snapshot on the GUI thread when the job starts
+        args = lambda: (filename, self.getProjectData())
+        jobs.getManager().submit('保存项目', self.do_saveProject, args, key=self,
+                                 label=os.path.basename(filename),
+                                 done=lambda r: self.processing_completed(), error=error)
         return
 
     def run_threaded_process(self, process, on_complete):
@@ -721,32 +755,54 @@ class Application(QMainWindow):
         self.running = False
         return
 
-    def do_saveProject(self, filename, progress_callback=None):
-        """Does the actual saving. Save sheets inculding table dataframes
-           and meta data as dict to compressed pickle.
-        """
+    def getProjectData(self):
+        """Snapshots of the sheet tables with their meta data for saving.
+        Taken on the GUI thread, the snapshots don't change when the
+        tables are edited while saving."""
 
         data={}
         for i in self.sheets:
             tablewidget = self.sheets[i]
             table = tablewidget.table
             data[i] = {}
-            #save dataframe with current column order
-            if table.filtered == True:
-                table.showAll()
-
-            df = table.model.df
-            cols = table.getColumnOrder()
-            if table.checkColumnsUnique() == True:
-                df = df[cols]
-            data[i]['table'] = df
+            if table.model.isMapped():
+                #mapped files are re-opened rather than stored
+                data[i]['table'] = None
+                data[i]['arrowfile'] = table.model.filename
+                data[i]['meta'] = self.saveMeta(tablewidget)
+                continue
+            #the full table if filtered, with current column order
+            data[i]['table'] = table.snapshot(source=True)
             data[i]['meta'] = self.saveMeta(tablewidget)
 
         data['scratch_items'] = self.scratch_items
         data['meta'] = {}
         data['meta']['currentsheet'] = self.tabs.currentIndex()
+        return data
+
+    def do_saveProject(self, filename, data=None, progress_callback=None):
+        """Does the actual saving. Save sheets inculding table dataframes
+           and meta data as dict to compressed pickle. Can run in a worker
+           given the data from getProjectData.
+        """
+
+        if data is None:
+            data = self.getProjectData()
+        data = dict(data)
+        for i in data:
+            if i in ['scratch_items','meta']:
+                continue
+            snap = data[i]['table']
+            if not isinstance(snap, core.Snapshot):
+                continue
+            df = snap.df
+            cols = snap.meta['columnorder']
+            if cols is not None:
+                df = df[cols]
+            data[i] = dict(data[i], table=df)
         file = gzip.GzipFile(filename, 'w')
         pickle.dump(data, file)
+        file.close()
         return
 
     def saveMeta(self, tablewidget):
@@ -765,8 +821,7 @@ class Application(QMainWindow):
 
         #save table selections
         meta['table'] = util.getAttributes(table)
-        meta['table']['selectedcols'] = table.getSelectedColumns()
-        meta['table']['selectedrows'] = table.getSelectedRows()
+        meta['table']['selection'] = table.getSelectionRanges()
         meta['table']['scrollposition'] = table.getScrollPosition()
         meta['table']['filtered'] = False
         meta['table']['column_widths'] = table.getColumnWidths()
@@ -779,7 +834,7 @@ class Application(QMainWindow):
             meta['showplotter'] = True
         #save child table if present
         if tablewidget.subtable != None:
-            meta['subtable'] = tablewidget.subtable.table.model.df
+            meta['subtable'] = tablewidget.subtable.table.model.viewFrame()
 
         return meta
 
@@ -822,7 +877,9 @@ class Application(QMainWindow):
             #util.setAttributes(table.child, childsettings)
 
         #redraw selections
-        if 'selectedrows' in tablesettings:
+        if 'selection' in tablesettings:
+            table.table.setSelectionRanges(tablesettings['selection'])
+        elif 'selectedrows' in tablesettings:
             rows = tablesettings['selectedrows']
             cols = tablesettings['selectedcols']
             table.table.setSelected(rows, cols)
@@ -864,36 +921,58 @@ class Application(QMainWindow):
         if not filenames:
             return
         num_files = len(filenames)
-        concat=False
-        reply = QMessageBox.question(self, '合并表格？',
-                                 '%s 个文件将被导入。是否将它们合并为一个表？' %num_files,
-                                  QMessageBox.Yes, QMessageBox.No)
-        if reply == QMessageBox.Yes:
-            concat = True
-
-        tables = []
-        if concat == False:
-            for f in filenames:
-                lbl = os.path.splitext(os.path.basename(f))[0]
-                name = lbl
-                i=1
-                while name in self.sheets:
-                    name=lbl+'_%s' %i
-                    i+=1
-                    self.addSheet(name)
-                    w = self.getCurrentTable()
-                    w.importFile(f, dialog=False)
-                    QApplication.processEvents()
-        elif concat == True:
-            tables = []
-            for f in filenames:
-                df = pd.read_csv(f)
-                tables.append(df)
-            final = pd.concat(tables)
+        opts = {'concat': {'type':'checkbox','default':1,'label':'合并为一个表'},
+                'source': {'type':'checkbox','default':0,'label':'添加来源文件列'},
+                }
+        dlg = dialogs.MultipleInputDialog(self, opts, title='导入 %s 个文件' %num_files,
+                            width=250,height=150)
+        dlg.exec_()
+        if not dlg.accepted:
+            return
+        concat = dlg.values['concat']
+        source = dlg.values['source']
+
+        #files are read in parallel as one job, errors are shown at the end
+        name = '导入 %s 个文件' %num_files
+        if concat == True:
             self.addSheet('imported')
             w = self.getCurrentTable()
-            w.table.model.df = final
-            w.refresh()
+            def done(result):
+                df, errors = result
+                w.table.model.df = df
+                w.refresh()
+                self.showImportErrors(errors)
+            w.table.runJob(name, readers.concatFiles, (filenames,),
+                           {'source': source == True}, done=done)
+        else:
+            def add(item):
+                f, df = item
+                name = self.uniqueName(os.path.splitext(os.path.basename(f))[0])
+                self.addSheet(name, df=df)
+            jobs.getManager().submit(name, readers.readEachFile, (filenames,),
+                                     {'publish': jobs.publish}, partial=add,
+                                     done=self.showImportErrors)
+        return
+
+    def uniqueName(self, lbl):
+        """A sheet name based on lbl that is not in use"""
+
+        name = lbl
+        i=1
+        while name in self.sheets:
+            name=lbl+'_%s' %i
+            i+=1
+        return name
+
+    def showImportErrors(self, errors):
+        """Show the files that could not be imported"""
+
+        if len(errors) == 0:
+            return
+        msg = QMessageBox(QMessageBox.Warning, '导入错误',
+                          '%s 个文件无法导入' %len(errors), parent=self)
+        msg.setDetailedText('\n'.join(['%s: %s' %e for e in errors]))
+        msg.exec_()
         return
 
     def importExcel(self, filename=None):
@@ -917,6 +996,32 @@ class Application(QMainWindow):
         w.importHDF()
         return
 
+    def importParquet(self):
+        """Import selected columns and rows of a Parquet file"""
+
+        self.addSheet()
+        w = self.getCurrentTable()
+        w.importParquet()
+        return
+
+    def importArrow(self):
+        """Open an Arrow/Feather file memory mapped"""
+
+        self.addSheet()
+        w = self.getCurrentTable()
+        w.importArrow()
+        return
+
+    def openArrowModel(self, filename):
+        """Memory mapped model for a saved sheet, None if it can't be opened"""
+
+        try:
+            from . import arrowmodel
+            return arrowmodel.ArrowDataFrameModel(filename)
+        except Exception as e:
+            print ('could not open %s: %s' %(filename, e))
+            return
+
     def importURL(self):
         """Import from URL"""
 
@@ -934,20 +1039,16 @@ class Application(QMainWindow):
         options = QFileDialog.Options()
         w = self.getCurrentTable()
         filename, _ = QFileDialog.getSaveFileName(self,"导出",
-                             "","csv files (*.csv);;xlsx files (*.xlsx);;xls Files (*.xls);;hdf files (*.hdf5);;All Files (*)",
+                             "","csv files (*.csv);;xlsx files (*.xlsx);;xls Files (*.xls);;hdf files (*.hdf5);;parquet files (*.parquet);;arrow files (*.feather *.arrow);;All Files (*)",
                              options=options)
-        df = w.table.model.df
-        ext = os.path.splitext(filename)[1]
-        if ext == '.csv':
-            df.to_csv(filename)
-        elif ext == '.hdf5':
-            df.to_hdf(filename)
-        elif ext == '.xls':
-            df.to_excel(filename)
+        if not filename:
+            return
+        w.exportTable(filename)
         return
 
-    def addSheet(self, name=None, df=None, meta=None):
-        """Add a new sheet"""
+    def addSheet(self, name=None, df=None, meta=None, model=None):
+        """Add a new sheet, model is an optional table model to use
+        instead of one created from df"""
 
         names = list(self.sheets.keys())
         i=len(self.sheets)+1
@@ -961,10 +1062,11 @@ class Application(QMainWindow):
         sheet.setStyleSheet(splittercss)
         idx = self.tabs.addTab(sheet, name)
         #provide reference to self to dataframewidget
-        dfw = DataFrameWidget(sheet, dataframe=df, app=self,
+        dfw = DataFrameWidget(sheet, dataframe=df, app=self, model=model,
                                 font=core.FONT, fontsize=core.FONTSIZE, bg=core.BGCOLOR,
                                 columnwidth=core.COLUMNWIDTH, timeformat=core.TIMEFORMAT)
         sheet.addWidget(dfw)
+        dfw.name = name
         self.sheets[name] = dfw
         self.currenttable = dfw
         pf = dfw.createPlotViewer(sheet)
@@ -992,6 +1094,7 @@ class Application(QMainWindow):
             if reply == QMessageBox.No:
                 return False
         name = self.tabs.tabText(index)
+        self.sheets[name].close()
         del self.sheets[name]
         self.tabs.removeTab(index)
         return
@@ -1011,6 +1114,7 @@ class Application(QMainWindow):
                                     "Sheet name already present")
                 return
             self.sheets[new] = self.sheets[name]
+            self.sheets[new].name = new
             del self.sheets[name]
             self.tabs.setTabText(index, new)
         return
@@ -1022,7 +1126,7 @@ class Application(QMainWindow):
             return
         index = self.tabs.currentIndex()
         name = self.tabs.tabText(index)
-        df = self.sheets[name].table.model.df.copy()
+        df = self.sheets[name].table.model.viewFrame().copy()
         meta = self.saveMeta(self.sheets[name])
         new, ok = QInputDialog.getText(self, '新名称', '名称：',
                 QLineEdit.Normal, name+'_copy')
@@ -1054,7 +1158,7 @@ class Application(QMainWindow):
         lblcol = kwds['add label column']
         new = []
         for n in names:
-            df = self.sheets[n].table.model.df
+            df = self.sheets[n].table.model.viewFrame()
             if lblcol == True:
                 df['label'] = n
             new.append(df)
@@ -1078,12 +1182,13 @@ class Application(QMainWindow):
         if not dlg.accepted:
             return
         kwds = dlg.values
-        table1 = self.sheets[kwds['sheet1']].table
-        table2 = self.sheets[kwds['sheet2']].table
-        dlg = dialogs.MergeDialog(self, df=table1.model.df, df2=table2.model.df, app=self)
-        dlg.exec_()
-        if not dlg.accepted:
-            return
+        #mapped sheets are loaded in a job first
+        def show(df1):
+            def merge(df2):
+                dlg = dialogs.MergeDialog(self, df=df1, df2=df2, app=self)
+                dlg.exec_()
+            self.sheets[kwds['sheet2']].withSnapshotFrame('合并', merge)
+        self.sheets[kwds['sheet1']].withSnapshotFrame('合并', show)
         return
 
     def clearSheets(self, ask=True):
@@ -1147,6 +1252,8 @@ class Application(QMainWindow):
         if reply == QMessageBox.Cancel:
             event.ignore()
             return
+        manager = jobs.getManager()
+        manager.cancel()
         if reply == QMessageBox.Yes:
             self.saveProject()
 
@@ -1155,6 +1262,7 @@ class Application(QMainWindow):
         self.saveSettings()
         if hasattr(self,'scratchpad'):
             self.scratchpad.close()
+        manager.waitForDone()
         self.threadpool.waitForDone()
         self.fileQuit()
         return
@@ -1234,7 +1342,12 @@ class Application(QMainWindow):
 
         w = self.getCurrentTable()
         w.table.undo()
-        w.refresh()
+        return
+
+    def redo(self):
+
+        w = self.getCurrentTable()
+        w.table.redo()
         return
 
     '''def runLastAction(self):
@@ -1249,6 +1362,13 @@ class Application(QMainWindow):
         w.findreplace()
         return
 
+    def goToValue(self):
+        """Jump to a value in the current column"""
+
+        w = self.getCurrentTable()
+        w.table.goToValue()
+        return
+
     def refresh(self):
         """Refresh all tables"""
 
@@ -1445,6 +1565,9 @@ class Application(QMainWindow):
 
 def main():
     import sys, os
+    import multiprocessing
+    #worker processes of a frozen build start by running the entry point
+    multiprocessing.freeze_support()
 
     from argparse import ArgumentParser
     parser = ArgumentParser()
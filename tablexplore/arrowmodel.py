@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    tablexplore 的 Arrow/Feather 内存映射数据模型
+    创建于 2026 年 10 月
+    版权所有 (C) Damien Farrell
+
+    以内存映射方式打开 Arrow IPC/Feather 文件，只为视图实际请求的
+    行块和列生成 pandas 对象。排序和过滤以行号排列的形式作用于映射文件，
+    因此可以浏览远大于内存的文件。需要 pyarrow。
+"""
+
+from __future__ import absolute_import, division, print_function
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.feather as feather
+from .qt import *
+from .core import DataFrameModel, positionArray
+from . import filters
+
+def openMapped(filename):
+    """以内存映射方式读取 Arrow IPC 文件/流或 Feather 文件，返回 pyarrow 表。
+    未压缩文件的数据不会被复制到内存中。"""
+
+    source = pa.memory_map(filename, 'r')
+    try:
+        return pa.ipc.open_file(source).read_all()
+    except pa.ArrowInvalid:
+        pass
+    source.seek(0)
+    try:
+        return pa.ipc.open_stream(source).read_all()
+    except pa.ArrowInvalid:
+        pass
+    #feather v1
+    return feather.read_table(filename, memory_map=True)
+
+class ArrowDataFrameModel(DataFrameModel):
+    """
+    以内存映射的 Arrow/Feather 文件为数据的 DataFrameModel。只把视图
+    请求的行块和列转换为 pandas。排序和过滤得到文件位置的行映射，而不是
+    新表格。访问 df 属性或 DataFrameTable.loadMapped 把当前视图读成普通
+    DataFrame，之后模型与 DataFrameModel 完全相同。
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.table = openMapped(filename)
+        empty = self.table.schema.empty_table().to_pandas()
+        DataFrameModel.__init__(self, empty)
+        self._df = None
+        #index columns stored by pandas are used as row labels
+        meta = self.table.schema.pandas_metadata or {}
+        index = meta.get('index_columns', [])
+        self.indexcols = [c for c in index
+                          if isinstance(c, str) and c in self.table.column_names]
+        #a RangeIndex is only stored as start/step
+        self.indexrange = (0, 1)
+        if len(index) == 1 and isinstance(index[0], dict) and index[0].get('kind') == 'range':
+            self.indexrange = (index[0].get('start', 0), index[0].get('step', 1))
+        cols = [c for c in self.table.column_names if c not in self.indexcols]
+        self.datatable = self.table.select(cols)
+        self.empty = self.datatable.schema.empty_table().to_pandas(ignore_metadata=True)
+        self.sortorder = None
+        self.rowfilter = None
+        self.rowmap = None
+        self.view = object()
+        self.windowkey = self.dataKey()
+        #sorted indexes of file columns, the file does not change
+        self.sortedindexes = {}
+        return
+
+    @property
+    def df(self):
+        """以 DataFrame 取数据，会把整个文件读入内存"""
+
+        if self._df is None:
+            self.setLoaded(self.loadFrame())
+        return DataFrameModel.df.fget(self)
+
+    @df.setter
+    def df(self, df):
+        DataFrameModel.df.fset(self, df)
+
+    def isMapped(self):
+        return self._df is None
+
+    def loadFrame(self):
+        """以 DataFrame 按文件顺序取整个文件，行标签与映射视图中相同。
+        只读取映射的文件，因此可以在后台任务中运行"""
+
+        return self.table.to_pandas()
+
+    def setLoaded(self, df):
+        """用 loadFrame 生成的表代替映射的文件。视图的排序和过滤成为
+        表的行顺序和显示的行，隐藏的行仍保留在表中"""
+
+        self._df = df
+        self.roworder = self.sortorder
+        self.rowsubset = None
+        if self.rowfilter is not None:
+            self.rowsubset = np.unique(self.rowfilter)
+        DataFrameModel.updateRowMap(self)
+        self.windowkey = self.dataKey()
+        return
+
+    def dataKey(self):
+        if not self.isMapped():
+            return self._df
+        return self.view
+
+    def arrowTable(self):
+        """以 pyarrow 表取当前视图的行"""
+
+        if self.rowmap is None:
+            return self.table
+        return self.table.take(self.rowmap)
+
+    def fileRows(self):
+        """映射文件中的行数"""
+
+        return self.table.num_rows
+
+    def totalRows(self):
+        if not self.isMapped():
+            return DataFrameModel.totalRows(self)
+        if self.rowmap is not None:
+            return len(self.rowmap)
+        return self.table.num_rows
+
+    def positions(self, rows):
+        """给定视图行位置在文件中的位置"""
+
+        if isinstance(rows, slice):
+            if self.rowmap is None:
+                return positionArray(rows)
+            return self.rowmap[rows]
+        rows = np.asarray(rows, dtype=np.int64)
+        if self.rowmap is None:
+            return rows
+        return self.rowmap[rows]
+
+    def labels(self, pos):
+        """给定文件位置的行标签，作为索引"""
+
+        if len(self.indexcols) == 0:
+            start, step = self.indexrange
+            return pd.Index(start + pos * step)
+        index = self.table.select(self.indexcols).take(pos)
+        if len(self.indexcols) == 1:
+            return pd.Index(index.column(0).to_pandas(), name=self.indexcols[0])
+        return pd.MultiIndex.from_frame(index.to_pandas(ignore_metadata=True))
+
+    def getBlock(self, start, stop, j):
+        if not self.isMapped():
+            return DataFrameModel.getBlock(self, start, stop, j)
+        col = self.datatable.column(j)
+        stop = min(stop, self.totalRows())
+        if self.rowmap is None:
+            arr = col.slice(start, max(stop-start, 0))
+        else:
+            arr = col.take(self.rowmap[start:stop])
+        return arr.to_pandas()
+
+    def getFrame(self, rows, cols):
+        if not self.isMapped():
+            return DataFrameModel.getFrame(self, rows, cols)
+        if isinstance(cols, slice):
+            cols = range(cols.start, cols.stop)
+        pos = self.positions(rows)
+        table = self.datatable.select(list(cols))
+        if isinstance(rows, slice) and self.rowmap is None:
+            #a run of rows in file order is sliced without copying
+            table = table.slice(rows.start, rows.stop-rows.start)
+        else:
+            table = table.take(pos)
+        df = table.to_pandas(ignore_metadata=True)
+        df.index = self.labels(pos)
+        return df
+
+    def getSample(self, n=100):
+        if not self.isMapped():
+            return DataFrameModel.getSample(self, n)
+        rows = range(min(n, self.totalRows()))
+        return self.getFrame(rows, range(self.datatable.num_columns))
+
+    def getColumns(self, names):
+        """以 DataFrame 按文件顺序取整列，忽略排序和过滤"""
+
+        return self.datatable.select(list(names)).to_pandas(ignore_metadata=True)
+
+    def getRowLabel(self, i):
+        if not self.isMapped():
+            return DataFrameModel.getRowLabel(self, i)
+        pos = int(self.positions([i])[0])
+        if len(self.indexcols) == 0:
+            start, step = self.indexrange
+            return str(start + pos * step)
+        values = [self.table.column(c)[pos].as_py() for c in self.indexcols]
+        return ','.join(['' if v is None else str(v) for v in values])
+
+    def schemaFrame(self):
+        if not self.isMapped():
+            return DataFrameModel.schemaFrame(self)
+        return self.empty
+
+    def memoryUsage(self, maxrows=1e6):
+        if not self.isMapped():
+            return DataFrameModel.memoryUsage(self, maxrows)
+        m = self.table.nbytes
+        if self.rowmap is not None:
+            m += self.rowmap.nbytes
+        return m, False
+
+    def updateRowMap(self):
+        """把排序顺序和行过滤合并为行映射"""
+
+        if not self.isMapped():
+            return DataFrameModel.updateRowMap(self)
+        if self.sortorder is None:
+            self.rowmap = self.rowfilter
+        elif self.rowfilter is None:
+            self.rowmap = self.sortorder
+        else:
+            keep = np.zeros(self.table.num_rows, dtype=bool)
+            keep[self.rowfilter] = True
+            self.rowmap = self.sortorder[keep[self.sortorder]]
+        self.view = object()
+        self.cache.clear()
+        self.highlights.clear()
+        return
+
+    def setRowFilter(self, rows=None):
+        """只显示给定的文件位置，None 显示全部行"""
+
+        if not self.isMapped():
+            return self.showRows(rows)
+        if rows is not None:
+            rows = np.asarray(rows, dtype=np.int64)
+        self.rowfilter = rows
+        self.updateRowMap()
+        return
+
+    def sort(self, idx, ascending=True):
+        if not self.isMapped():
+            return DataFrameModel.sort(self, idx, ascending)
+        if not isinstance(idx, (list, tuple)):
+            idx = [idx]
+        self.layoutAboutToBeChanged.emit()
+        order = 'ascending' if ascending else 'descending'
+        t = pa.table({'k%s' %k: self.datatable.column(j) for k, j in enumerate(idx)})
+        keys = [('k%s' %k, order) for k in range(len(idx))]
+        self.sortorder = pc.sort_indices(t, sort_keys=keys).to_numpy()
+        self.updateRowMap()
+        self.layoutChanged.emit()
+        return
+
+    def findValue(self, name, text):
+        if not self.isMapped():
+            return DataFrameModel.findValue(self, name, text)
+        index = self.sortedindexes.get(name)
+        if index is None:
+            index = filters.SortedIndex.build(self.getColumns([name])[name])
+            if index is None:
+                return
+            self.sortedindexes[name] = index
+        value = index.key(text)
+        if value is None:
+            return
+        found = index.order[index.first(value):]
+        if self.rowmap is not None:
+            #first file position in order that is shown
+            shown = np.zeros(self.fileRows(), dtype=bool)
+            shown[self.rowmap] = True
+            found = found[shown[found]]
+        if len(found) == 0:
+            return
+        if self.rowmap is None:
+            return int(found[0])
+        return int(np.flatnonzero(self.rowmap == found[0])[0])
+
+    def setData(self, index, value, role=QtCore.Qt.EditRole):
+        if self.isMapped():
+            return False
+        return DataFrameModel.setData(self, index, value, role)
+
+    def flags(self, index):
+        if self.isMapped():
+            return QtCore.Qt.ItemIsEnabled | QtCore.Qt.ItemIsSelectable
+        return DataFrameModel.flags(self, index)
@@ -21,11 +21,13 @@
 """
 
 import sys, os, io, platform
-import tempfile
+import weakref
 import numpy as np
 import pandas as pd
 from pandas.api.types import is_datetime64_any_dtype as is_datetime
+from pandas.api.types import is_numeric_dtype
 import string
+from collections import OrderedDict
 from .qt import *
 
 homepath = os.path.expanduser("~")
@@ -57,7 +59,12 @@ defaults = {
             'PLOTSTYLE'  :'bmh',
             'DPI' : 100,
             'BGCOLOR' : '#F4F4F3',
-            'THEME': 'Fusion'
+            'THEME': 'Fusion',
+            'SEARCHINDEX' : True,
+            'BITMAPINDEX' : False,
+            'UNDOLEVELS' : 20,
+            'UNDOMEMORY' : 500,
+            'OPTIMIZETYPES' : False
 }
 #populate current class variable
 for k in defaults:
@@ -68,7 +75,7 @@ try:
 except AttributeError:
     def _fromUtf8(s):
         return s
-from . import dialogs, plotting, util
+from . import dialogs, plotting, util, search, filters, journal, jobs, readers
 
 icons = {'load': 'open', 'save': 'export',
          'importexcel': 'excel',
@@ -109,7 +116,7 @@ class SubWidget(QDockWidget):
     def closeEvent(self, ce):
         self.table.showAll()
         #self.table.filtered = False
-        self.table.model.highlighted = None
+        self.table.model.highlights.clear()
         self.table.refresh()
         #we should actually do this:
         #for i in xrange(self.layout.count()):
@@ -157,7 +164,6 @@ class DataFrameWidget(QWidget):
         self.filterdock = None
         self.finddock = None
         self.mode = 'default'
-        self.table.model.dataChanged.connect(self.stateChanged)
         return
 
     #@Slot('QModelIndex','QModelIndex','int')
@@ -175,6 +181,20 @@ class DataFrameWidget(QWidget):
         w.setMaximumHeight(30)
         self.size_label = QLabel("")
         l.addWidget(self.size_label, 1)
+        self.filter_label = QLabel("")
+        l.addWidget(self.filter_label)
+        #progress of background jobs such as sorting
+        self.progress_label = QLabel("")
+        l.addWidget(self.progress_label)
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setRange(0, 0)
+        self.progress_bar.setMaximumWidth(120)
+        l.addWidget(self.progress_bar)
+        self.cancel_button = QPushButton('取消')
+        self.cancel_button.clicked.connect(self.cancelProgress)
+        l.addWidget(self.cancel_button)
+        self.progress_cancel = None
+        self.hideProgress()
         w.setStyleSheet('color: #1a216c; font-size:12px')
         self.layout.addWidget(w, 2, 1)
         self.updateStatusBar()
@@ -219,6 +239,7 @@ class DataFrameWidget(QWidget):
 
         if self.pyconsole != None:
             self.pyconsole.closeEvent()
+        jobs.getManager().cancel(self)
         return
 
     def refresh(self):
@@ -231,10 +252,66 @@ class DataFrameWidget(QWidget):
 
         if not hasattr(self, 'size_label'):
             return
-        df = self.table.model.df
+        model = self.table.model
+        schema = model.getSchema()
         meminfo = self.table.getMemory()
-        s = '{r} rows x {c} columns | {m}'.format(r=len(df), c=len(df.columns),m=meminfo)
+        s = '{r} rows x {c} columns | {m}'.format(r=model.totalRows(), c=len(schema),m=meminfo)
         self.size_label.setText(s)
+        if self.table.filtered == False:
+            self.filter_label.setText('')
+        return
+
+    def showProgress(self, text='', cancel=None):
+        """在状态栏中显示后台任务的进度，cancel 为取消该任务的函数"""
+
+        if not hasattr(self, 'progress_bar'):
+            return
+        self.progress_label.setText(text)
+        self.progress_label.show()
+        self.progress_bar.show()
+        self.progress_cancel = cancel
+        self.cancel_button.setVisible(cancel is not None)
+        return
+
+    def hideProgress(self):
+        """隐藏状态栏中的进度"""
+
+        if not hasattr(self, 'progress_bar'):
+            return
+        self.progress_cancel = None
+        self.progress_label.hide()
+        self.progress_bar.hide()
+        self.cancel_button.hide()
+        return
+
+    def cancelProgress(self):
+        """取消正在运行的后台任务"""
+
+        cancel = self.progress_cancel
+        self.hideProgress()
+        if cancel is not None:
+            cancel()
+        return
+
+    def showFilterCount(self, count=None, total=None):
+        """在状态栏中显示过滤匹配的行数，count 为 None 表示正在计算"""
+
+        if not hasattr(self, 'filter_label'):
+            return
+        if count is None:
+            s = '正在过滤...'
+        elif total is None:
+            s = '匹配 {c} 行'.format(c=count)
+        else:
+            s = '匹配 {c} / {t} 行'.format(c=count, t=total)
+        self.filter_label.setText(s)
+        return
+
+    def clearFilterCount(self):
+        """清除状态栏中的过滤行数"""
+
+        if hasattr(self, 'filter_label'):
+            self.filter_label.setText('')
         return
 
     def load(self):
@@ -263,13 +340,52 @@ class DataFrameWidget(QWidget):
             dlg.exec_()
             if not dlg.accepted:
                 return
-            self.table.model.df = dlg.df
-            self.refresh()
+            self.importCSV(filename, dlg.dtypes, **dlg.values)
         else:
-            self.table.model.df = pd.read_csv(filename)
-            self.refresh()
+            self.importCSV(filename)
+        return
+
+    def importCSV(self, filename, dtypes=None, **kwargs):
+        """在后台分块读取 CSV 文件，读到的行随即追加显示在表格中，
+        进度显示读取的字节数和每秒行数，可以取消"""
+
+        state = {'frame': None, 'revision': None}
+        def show(df):
+            model = self.table.model
+            shown = state['frame']
+            if shown is None or model.dataKey() is not shown or \
+                model.revision != state['revision'] or len(df) < len(shown) or \
+                list(df.dtypes) != list(shown.dtypes):
+                model.df = df
+                self.refresh()
+            else:
+                model.df = df
+                model.insertedRows(len(shown), len(df)-len(shown))
+            state['frame'] = df
+            state['revision'] = model.revision
+        def done(df):
+            show(df)
+            self.imported()
+        kwargs['publish'] = jobs.publish
+        return self.table.runJob('导入 CSV', readers.readCSV, (filename, dtypes), kwargs,
+                                 done=done, partial=show)
+
+    def imported(self):
+        """导入完成后调用，按设置优化内存"""
+
+        if OPTIMIZETYPES == True:
+            self.optimizeMemory(dialog=False)
         return
 
+    def importJob(self, name, fn, *args, **kwargs):
+        """在后台读取数据，读完后替换表格"""
+
+        def done(df):
+            self.table.model.df = df
+            self.refresh()
+            self.imported()
+        return self.table.runJob(name, fn, args, kwargs, done=done)
+
     def importPickle(self):
 
         options = QFileDialog.Options()
@@ -277,21 +393,90 @@ class DataFrameWidget(QWidget):
                      "","pickle files (*.pkl *.pickle);;All Files (*)",
                      options=options)
         if filename:
-            self.table.model.df = pd.read_pickle(filename)
-            self.refresh()
+            self.importJob('导入 Pickle', pd.read_pickle, filename)
+        return
+
+    def importArrow(self, filename=None):
+        """以内存映射方式导入 Arrow/Feather 文件，只读取视图需要的行和列"""
+
+        if filename == None:
+            options = QFileDialog.Options()
+            filename, _ = QFileDialog.getOpenFileName(self,"导入 Arrow/Feather",
+                             "","arrow files (*.feather *.arrow *.arrows *.ipc);;All Files (*)",
+                             options=options)
+        if not filename:
+            return
+        try:
+            from . import arrowmodel
+        except ImportError:
+            QMessageBox.warning(self, '缺少 pyarrow',
+                                '需要安装 pyarrow 才能映射 Arrow/Feather 文件。')
+            return
+        model = arrowmodel.ArrowDataFrameModel(filename)
+        self.table.setDataModel(model)
+        return
+
+    def importParquet(self, filename=None):
+        """导入 Parquet 文件，只读取选中的列，行过滤交给读取器以跳过不需要的行组"""
+
+        if filename == None:
+            options = QFileDialog.Options()
+            filename, _ = QFileDialog.getOpenFileName(self,"导入 Parquet",
+                             "","parquet files (*.parquet *.pq);;All Files (*)",
+                             options=options)
+        if not filename:
+            return
+        try:
+            dlg = dialogs.ParquetDialog(self, filename)
+        except ImportError:
+            QMessageBox.warning(self, '缺少 pyarrow', '需要安装 pyarrow 才能读取 Parquet 文件。')
+            return
+        dlg.exec_()
+        if not dlg.accepted:
+            return
+        self.importJob('导入 Parquet', readers.readParquet, filename, dlg.columns, dlg.filters)
         return
 
     def importExcel(self, filename=None):
-        """导入 Excel 文件"""
+        """导入 Excel 文件中选中的工作表，多个工作表在后台进程中并行读取，
+        每个工作表导入为一个表单"""
 
         if filename == None:
             options = QFileDialog.Options()
             filename, _ = QFileDialog.getOpenFileName(self,"导入 Excel",
                              "","xlsx files (*.xlsx);;xls Files (*.xls);;All Files (*)",
                              options=options)
-        if filename:
-            self.table.model.df = pd.read_excel(filename)
-            self.refresh()
+        if not filename:
+            return
+        try:
+            dlg = dialogs.ExcelDialog(self, filename)
+        except Exception as e:
+            QMessageBox.warning(self, '导入 Excel', str(e))
+            return
+        dlg.exec_()
+        if not dlg.accepted:
+            return
+        sheets = dlg.sheets
+        if self.app is None:
+            #only one sheet can be shown without the application
+            sheets = sheets[:1]
+        state = {'first': True}
+        def add(item):
+            #the first sheet goes into this table, others into new sheets
+            name, df = item
+            if state['first'] == True:
+                state['first'] = False
+                self.table.model.df = df
+                self.refresh()
+                self.imported()
+            else:
+                self.app.addSheet(self.app.uniqueName(str(name)), df)
+                self.app.getCurrentTable().imported()
+        def done(errors):
+            if len(errors) > 0:
+                QMessageBox.warning(self, '导入 Excel', '\n'.join(['%s: %s' %e for e in errors]))
+        self.table.runJob('导入 Excel', readers.readSheets, (filename, sheets),
+                          {'publish': jobs.publish}, done=done, partial=add)
         return
 
     def importHDF(self):
@@ -302,8 +487,7 @@ class DataFrameWidget(QWidget):
                      "","hdf files (*.hdf5);;All Files (*)",
                      options=options)
         if filename:
-            self.table.model.df = pd.read_hdf(filename, **kwargs)
-            self.refresh()
+            self.importJob('导入 HDF', pd.read_hdf, filename)
         return
 
     def importURL(self, recent):
@@ -321,33 +505,80 @@ class DataFrameWidget(QWidget):
             return False
         url = dlg.values['url']
         sep = dlg.values['sep']
-        self.table.model.df = pd.read_csv(url, sep=sep)
-        self.refresh()
+        self.importJob('导入 URL', pd.read_csv, url, sep=sep)
         return url
 
-    def exportTable(self):
-        """导出表格"""
+    def exportTable(self, filename=None):
+        """导出表格，在后台从快照写出文件。内存映射的表从映射的 Arrow 表写出，
+        不先读成 DataFrame"""
 
-        options = QFileDialog.Options()
-        #options.setDefaultSuffix('csv')
-        filename, _ = QFileDialog.getSaveFileName(self,"导出",
-                             "","csv files (*.csv);;xlsx files (*.xlsx);;xls Files (*.xls);;All Files (*)",
-                             options=options)
+        if filename == None:
+            options = QFileDialog.Options()
+            #options.setDefaultSuffix('csv')
+            filename, _ = QFileDialog.getSaveFileName(self,"导出",
+                                 "","csv files (*.csv);;xlsx files (*.xlsx);;xls Files (*.xls);;parquet files (*.parquet);;arrow files (*.feather *.arrow);;All Files (*)",
+                                 options=options)
         if not filename:
             return
-        df = self.table.model.df
-        df.to_csv(filename)
+        ext = os.path.splitext(filename)[1]
+        kwds = {}
+        if ext == '.parquet':
+            opts = {'compression': {'type':'combobox','default':'snappy','label':'压缩',
+                            'items':['snappy','zstd','lz4','gzip','brotli','none']},
+                    'rowgroup': {'type':'spinbox','default':1000000,'range':(1000,100000000),
+                            'interval':100000,'label':'每行组行数'},
+                   }
+        elif ext in readers.ARROWEXT:
+            opts = {'compression': {'type':'combobox','default':'uncompressed','label':'压缩',
+                            'items':['uncompressed','lz4'],
+                            'tooltip':'未压缩的文件打开时可以直接内存映射'},
+                   }
+        if ext == '.parquet' or ext in readers.ARROWEXT:
+            dlg = dialogs.MultipleInputDialog(self, opts, title='导出')
+            dlg.exec_()
+            if not dlg.accepted:
+                return
+            kwds = dlg.values
+        model = self.table.model
+        def args():
+            if model is not self.table.model:
+                return
+            if model.isMapped():
+                #the mapped file does not change, rows are taken in the job
+                return (model.table, model.rowmap)
+            return (self.table.snapshot(source=True),)
+        def export(data, rows=None):
+            if not isinstance(data, Snapshot):
+                readers.writeMapped(data, rows, filename, model.labels, **kwds)
+                return
+            df = data.df
+            if ext == '.parquet':
+                readers.writeParquet(df, filename, kwds['compression'], kwds['rowgroup'])
+            elif ext in readers.ARROWEXT:
+                readers.writeArrow(df, filename, kwds['compression'])
+            elif ext == '.hdf5':
+                df.to_hdf(filename, key='df')
+            elif ext in ['.xls', '.xlsx']:
+                df.to_excel(filename)
+            else:
+                df.to_csv(filename)
+        self.table.runJob('导出', export, args)
         return
 
     def copy(self):
         """复制到剪贴板"""
 
-        #check size of dataframe
-        m = self.table.model.df.memory_usage(deep=True).sum()
+        #estimate size of the selection from the memory used by the table
+        model = self.table.model
+        rows, cols = self.table.getSelection()
+        cells = model.totalRows() * model.columnCount()
+        m = 0
+        if cells > 0:
+            m = model.memoryUsage()[0] * countPositions(rows) * countPositions(cols) / cells
         if m>1e8:
             answer = QMessageBox.question(self, '复制？',
                              '数据可能过大，是否继续复制？', QMessageBox.Yes, QMessageBox.No)
-            if not answer:
+            if answer == QMessageBox.No:
                 return
         df = self.table.getSelectedDataFrame()
         df.to_clipboard()
@@ -366,7 +597,7 @@ class DataFrameWidget(QWidget):
         """从剪贴板插入"""
 
         self.table.storeCurrent()
-        df = self.table.model.df
+        df = self.table.model.viewFrame()
         new = pd.read_clipboard(sep='\t')
         self.table.model.df = pd.concat([df,new])
         self.refresh()
@@ -384,8 +615,12 @@ class DataFrameWidget(QWidget):
         if self.pf == None:
             self.createPlotViewer()
         self.pf.setVisible(True)
-        df = self.getSelectedDataFrame()
-        self.pf.replot(df)
+        table = self.table
+        #the data is taken from a snapshot when the job starts
+        def args():
+            rows, cols = table.getSelection()
+            return (rows, cols, table.snapshot())
+        table.runJob('绘图', table.selectionFrame, args, done=self.pf.replot)
         return
 
     def createPlotViewer(self, parent=None):
@@ -402,7 +637,17 @@ class DataFrameWidget(QWidget):
         """表信息"""
 
         buf = io.StringIO()
-        self.table.model.df.info(verbose=True,buf=buf,memory_usage=True)
+        model = self.table.model
+        if model.isMapped():
+            #from the Arrow schema, the file is not read
+            t = model.datatable
+            buf.write('映射文件 %s\n%d 行, 文件共 %d 行, %d 列\n\n'
+                      %(model.filename, model.totalRows(), model.fileRows(), t.num_columns))
+            for name, col in zip(t.column_names, t.columns):
+                buf.write('%s  %s  缺失 %d\n' %(name, col.type, col.null_count))
+            buf.write('\n%s' %self.table.getMemory())
+        else:
+            model.df.info(verbose=True,buf=buf,memory_usage=True)
         td = dialogs.TextDialog(self, buf.getvalue(), 'Info', width=600, height=400)
         return
 
@@ -425,7 +670,7 @@ class DataFrameWidget(QWidget):
     def findDuplicates(self):
         """查找或删除重复项"""
 
-        df = self.table.model.df
+        df = self.table.model.viewFrame()
         cols = df.columns
 
         opts = {'remove':  {'type':'checkbox','default':0,'label':'Drop duplicates',
@@ -474,7 +719,7 @@ class DataFrameWidget(QWidget):
     def cleanData(self):
         """处理缺失数据"""
 
-        df = self.table.model.df
+        df = self.table.model.viewFrame()
         cols = df.columns
         fillopts = ['fill scalar','','ffill','bfill','interpolate']
         opts = {'replace':{'label':'替换','type':'entry','default':'',
@@ -573,24 +818,73 @@ class DataFrameWidget(QWidget):
         fillempty = kwds['fillempty']
 
         if useselected == 1 and len(idx)>0:
-            colnames = df.columns[idx]
+            colnames = list(df.columns[idx])
         else:
-            colnames = df.columns
-        print (idx,colnames)
-        self.table.storeCurrent()
-        for c in colnames:
-            x = df[c]
-            if fillempty == 1 or convtype is int:
-                x = x.fillna(0)
-            if currency == 1:
-                x = x.replace( '[\$\£\€,)]','', regex=True ).replace( '[(]','-', regex=True )
-            if removetext == 1:
-                x = x.replace( '[^\d.]+', '', regex=True)
-            try:
-                self.table.model.df[c] = pd.to_numeric(x, errors='coerce').astype(convtype)
-            except:
-                pass
-        self.refresh()
+            colnames = list(df.columns)
+
+        def convert(df):
+            result = OrderedDict()
+            for k, c in enumerate(colnames):
+                jobs.report(str(c), k/len(colnames))
+                x = df[c]
+                if fillempty == 1 or convtype is int:
+                    x = x.fillna(0)
+                if currency == 1:
+                    x = x.replace( '[\$\£\€,)]','', regex=True ).replace( '[(]','-', regex=True )
+                if removetext == 1:
+                    x = x.replace( '[^\d.]+', '', regex=True)
+                try:
+                    result[c] = pd.to_numeric(x, errors='coerce').astype(convtype)
+                except:
+                    pass
+            return result
+        def done(result):
+            names = list(result.keys())
+            self.table.storeColumns(names)
+            model = self.table.model
+            for c in names:
+                model.df[c] = result[c]
+            model.updateCells(cols=model.columnPositions(names))
+        self.table.runFrameJob('转换为数值', convert, done)
+        return
+
+    def optimizeMemory(self, dialog=True):
+        """在后台缩小表格占用的内存：数值列降为更小的类型，重复较多的文本
+        转为分类，大部分为空的列转为稀疏类型，见 util.optimizeDtypes。
+        完成后显示每列前后的内存，dialog 为 False 时不询问也不显示。"""
+
+        kwds = {'catratio':50, 'sparseratio':90, 'arrowstrings':0}
+        if dialog == True:
+            opts = {'catratio':  {'type':'spinbox','default':50,'range':(0,100),
+                            'label':'分类阈值 (%)','tooltip':'不同取值占行数的比例不超过此值的文本列转为分类'},
+                    'sparseratio':  {'type':'spinbox','default':90,'range':(1,100),
+                            'label':'稀疏阈值 (%)','tooltip':'空值比例不低于此值的数值列转为稀疏类型'},
+                    'arrowstrings':  {'type':'checkbox','default':0,'label':'Arrow 文本列',
+                            'tooltip':'其余文本列以 Arrow 字符串保存'},
+                   }
+            dlg = dialogs.MultipleInputDialog(self, opts, title='优化内存')
+            dlg.exec_()
+            if not dlg.accepted:
+                return
+            kwds = dlg.values
+
+        def optimize(df):
+            return util.optimizeDtypes(df, kwds['catratio']/100, kwds['sparseratio']/100,
+                                       kwds['arrowstrings'] == True, report=jobs.report)
+        def done(result):
+            columns, info = result
+            model = self.table.model
+            if len(columns) > 0:
+                pos = list(columns.keys())
+                self.table.storeColumns(list(model.df.columns[pos]))
+                for j in pos:
+                    model.df.isetitem(j, columns[j])
+                model.updateCells(cols=pos)
+            self.updateStatusBar()
+            if dialog == True:
+                dlg = dialogs.TextDialog(self, util.memoryReport(info), '优化内存',
+                                         width=600, height=400)
+        self.table.runFrameJob('优化内存', optimize, done)
         return
 
     def convertTypes(self):
@@ -640,7 +934,7 @@ class DataFrameWidget(QWidget):
 
         if trunc > 0:
             df.columns = [i[:trunc] for i in df.columns]
-        self.refresh()
+        self.table.model.renamedColumns()
         return
 
     def applyColumnFunction(self, column):
@@ -695,43 +989,49 @@ class DataFrameWidget(QWidget):
         else:
             func = getattr(np, funcname)
 
-        self.table.storeCurrent()
-
         if newcol == '':
             if len(cols)>3:
                 s = ' %s cols' %len(cols)
             else:
                 s =  '(%s)' %(','.join(cols))[:20]
             newcol = funcname + s
+        if len(cols) < 2 and inplace == True:
+            newcol = col
 
-        if funcname == 'divide':
-            result = df[cols].div(arg, axis=0)
-        elif funcname == 'multiply':        
-            result = df[cols].mul(arg, axis=0)
-        elif funcname == 'mod':
-            result = df[cols].mod(arg, axis=0)
-        elif funcname == 'add':
-            result = df[cols].add(arg, axis=0)
-        elif funcname == 'power':
-            result = df[cols].pow(arg, axis=0)
-        elif len(cols) >= 2:
-            result = df[cols].apply(func, 1)
-        else:
-            if inplace == True:
-                newcol = col
-            if group != '':
+        def apply(df):
+            if funcname == 'divide':
+                result = df[cols].div(arg, axis=0)
+            elif funcname == 'multiply':
+                result = df[cols].mul(arg, axis=0)
+            elif funcname == 'mod':
+                result = df[cols].mod(arg, axis=0)
+            elif funcname == 'add':
+                result = df[cols].add(arg, axis=0)
+            elif funcname == 'power':
+                result = df[cols].pow(arg, axis=0)
+            elif len(cols) >= 2:
+                result = df[cols].apply(func, 1)
+            elif group != '':
                 result = df.groupby(group)[col].apply(func)
             else:
                 result = df[col].apply(func, 1)
-
-        if funcname in ['divide','multiply','mod','add','power']:
-            df[cols] = result
-        elif funcname in multifuncs or inplace == False:
-            idx = df.columns.get_loc(col)
-            df.insert(idx+1, newcol, result)
-        else:
-            df[cols] = result
-        self.refresh()
+            return result
+        def done(result):
+            self.table.storeColumns(cols)
+            df = self.table.model.df
+            model = self.table.model
+            result = model.frameValues(result)
+            if funcname in ['divide','multiply','mod','add','power']:
+                df[cols] = result
+                model.updateCells(cols=model.columnPositions(cols))
+            elif funcname in multifuncs or inplace == False:
+                idx = df.columns.get_loc(col)
+                df.insert(idx+1, newcol, result)
+                model.insertedColumns(idx+1)
+            else:
+                df[cols] = result
+                model.updateCells(cols=model.columnPositions(cols))
+        self.table.runFrameJob('应用函数', apply, done, ordered=True)
         return
 
     def _getFunction(self, funcname, obj=None):
@@ -779,7 +1079,6 @@ class DataFrameWidget(QWidget):
             return
         kwds = dlg.values
 
-        self.table.storeCurrent()
         op = kwds['operation']
         winfunc = kwds['winfunc']
         wintype = kwds['wintype']
@@ -793,29 +1092,42 @@ class DataFrameWidget(QWidget):
         if wintype == '':
             wintype=None
 
-        for col in cols:
-            if op == 'rolling window':
-                w = df[col].rolling(window=window, win_type=wintype, center=center)
-                func = self._getFunction(winfunc, obj=w)
-                result = func()
-            elif op == 'expanding':
-                func = self._getFunction(winfunc)
-                result = df[col].expanding(2, center=True).apply(func)
-            elif op == 'shift':
-                result = df[col].shift(periods=periods)
-
-            if result is None:
-                return
-            if newcol == '' or len(cols)>1:
-                newcol = winfunc+'('+str(col)+')'
-            if inplace == True:
-                df[col] = result
-            else:
-                if newcol in df.columns:
-                    newcol = dialogs.getName(self, txt="输入列名")
-                idx = df.columns.get_loc(col)
-                df.insert(idx+1, newcol, result)
-        self.refresh()
+        def transform(df):
+            results = []
+            for k, col in enumerate(cols):
+                jobs.report(str(col), k/len(cols))
+                if op == 'rolling window':
+                    w = df[col].rolling(window=window, win_type=wintype, center=center)
+                    func = self._getFunction(winfunc, obj=w)
+                    result = func()
+                elif op == 'expanding':
+                    func = self._getFunction(winfunc)
+                    result = df[col].expanding(2, center=True).apply(func)
+                elif op == 'shift':
+                    result = df[col].shift(periods=periods)
+                if result is None:
+                    break
+                results.append((col, result))
+            return results
+        def done(results):
+            self.table.storeColumns(cols)
+            df = self.table.model.df
+            model = self.table.model
+            name = newcol
+            for col, result in results:
+                if name == '' or len(cols)>1:
+                    name = winfunc+'('+str(col)+')'
+                result = model.frameValues(result)
+                if inplace == True:
+                    df[col] = result
+                    model.updateCells(cols=model.columnPositions([col]))
+                else:
+                    if name in df.columns:
+                        name = dialogs.getName(self, txt="输入列名")
+                    idx = df.columns.get_loc(col)
+                    df.insert(idx+1, name, result)
+                    model.insertedColumns(idx+1)
+        self.table.runFrameJob('转换/重采样', transform, done, ordered=True)
         return
 
     def fillDates(self, column):
@@ -845,9 +1157,10 @@ class DataFrameWidget(QWidget):
         l=len(df)
         data = pd.date_range(start=start, end=end, freq=freq, periods=periods)[:l]
         #print (data)
-        self.table.storeCurrent()
-        self.table.model.df[column] = data
-        self.refresh()
+        self.table.storeColumns([column])
+        model = self.table.model
+        model.df[column] = model.frameValues(data)
+        self.updateColumn(column)
         return
 
     def fillStrings(self, column):
@@ -871,9 +1184,10 @@ class DataFrameWidget(QWidget):
             data = [util.gen_upper(namelen) for i in range(len(df))]
         else:
             data = [util.gen_word(namelen) for i in range(len(df))]
-        self.table.storeCurrent()
-        self.table.model.df[column] = data
-        self.refresh()
+        self.table.storeColumns([column])
+        model = self.table.model
+        model.df[column] = model.frameValues(data)
+        self.updateColumn(column)
 
     def fillData(self, column):
         """用数据填充列"""
@@ -928,9 +1242,21 @@ class DataFrameWidget(QWidget):
             step = (high-low)/len(df)
             data = pd.Series(np.arange(low,high,step))
 
-        self.table.storeCurrent()
-        self.table.model.df[column] = data
-        self.refresh()
+        self.table.storeColumns([column])
+        model = self.table.model
+        model.df[column] = model.frameValues(data)
+        self.updateColumn(column)
+        return
+
+    def updateColumn(self, column):
+        """报告列的值已被修改，列不存在时视为新增列"""
+
+        model = self.table.model
+        pos = model.columnPositions([column])
+        if len(model.getSchema()) < len(model.df.columns):
+            model.insertedColumns(pos[-1])
+        else:
+            model.updateCells(cols=pos)
         return
 
     def convertDates(self, column):
@@ -958,26 +1284,37 @@ class DataFrameWidget(QWidget):
         if format == 'infer':
             format = None
             infer = True
-        temp = df[column]
-        self.table.storeCurrent()
-        if temp.dtype != 'datetime64[ns]':
-            temp = pd.to_datetime(temp, format=format, infer_datetime_format=infer,
-                                errors=errors)
-
-        if props != '' and len(props)>0:
+        def convert(df):
+            temp = df[column]
+            if temp.dtype != 'datetime64[ns]':
+                temp = pd.to_datetime(temp, format=format, infer_datetime_format=infer,
+                                    errors=errors)
+            if props == '' or len(props) == 0:
+                return temp
+            result = OrderedDict()
             for prop in props:
+                jobs.checkCancelled()
                 new = getattr(temp.dt, prop)
                 try:
                     new = new.astype(int)
                 except:
                     pass
+                result[prop] = new
+            return result
+        def done(result):
+            self.table.storeColumns([column])
+            df = self.table.model.df
+            if isinstance(result, pd.Series):
+                df[column] = result
+                self.updateColumn(column)
+                return
+            for prop in result:
                 if prop in df.columns:
                     df.drop(columns=prop)
                 idx = df.columns.get_loc(column)
-                df.insert(idx+1, prop, new)
-        else:
-            self.table.model.df[column] = temp
-        self.refresh()
+                df.insert(idx+1, prop, result[prop])
+                self.table.model.insertedColumns(idx+1)
+        self.table.runFrameJob('转换日期', convert, done)
         return
 
     def applyStringMethod(self, column):
@@ -1005,7 +1342,6 @@ class DataFrameWidget(QWidget):
             return
         kwds = dlg.values
 
-        self.table.storeCurrent()
         func = kwds['function']
         sep = kwds['sep']
         start = int(kwds['start'])
@@ -1014,48 +1350,55 @@ class DataFrameWidget(QWidget):
         repl = kwds['repl']
         inplace = kwds['inplace']
         concatsep = kwds['concat_sep']
-        x = None
-
-        if func == 'split':
-            new = df[col].str.split(sep).apply(pd.Series)
-            new.columns = [col+'_'+str(i) for i in new.columns]
-            self.table.model.df = pd.concat([df,new],1)
-            self.refresh()
-            return
-        elif func == 'strip':
-            x = df[col].str.strip()
-        elif func == 'lstrip':
-            x = df[col].str.lstrip(pat)
-        elif func == 'upper':
-            x = df[col].str.upper()
-        elif func == 'lower':
-            x = df[col].str.lower()
-        elif func == 'title':
-            x = df[col].str.title()
-        elif func == 'swapcase':
-            x = df[col].str.swapcase()
-        elif func == 'len':
-            x = df[col].str.len()
-        elif func == 'slice':
-            x = df[col].str.slice(start,end)
-        elif func == 'replace':
-            x = df[col].replace(pat, repl, regex=True)
-        elif func == 'concat':
-            #x = df[col].str.cat(df[cols[1]].astype(str), sep=sep)
-            x = df[cols].astype(str).apply(lambda row: concatsep.join(row.values.astype(str)), axis=1)
-        if inplace == 0:
-            newcol = col+'_'+func
-        else:
-            newcol = col
-        if x is None:
+        if func == '':
             print ('no function selected')
             return
-        if inplace == 0:
-            if newcol in df.columns:
-                df.drop(columns=newcol)
-            idx = df.columns.get_loc(col)
-            df.insert(idx+1, newcol, x)
-        self.refresh()
+
+        def apply(df):
+            x = None
+            if func == 'split':
+                x = df[col].str.split(sep).apply(pd.Series)
+                x.columns = [col+'_'+str(i) for i in x.columns]
+            elif func == 'strip':
+                x = df[col].str.strip()
+            elif func == 'lstrip':
+                x = df[col].str.lstrip(pat)
+            elif func == 'upper':
+                x = df[col].str.upper()
+            elif func == 'lower':
+                x = df[col].str.lower()
+            elif func == 'title':
+                x = df[col].str.title()
+            elif func == 'swapcase':
+                x = df[col].str.swapcase()
+            elif func == 'len':
+                x = df[col].str.len()
+            elif func == 'slice':
+                x = df[col].str.slice(start,end)
+            elif func == 'replace':
+                x = df[col].replace(pat, repl, regex=True)
+            elif func == 'concat':
+                #x = df[col].str.cat(df[cols[1]].astype(str), sep=sep)
+                x = df[cols].astype(str).apply(lambda row: concatsep.join(row.values.astype(str)), axis=1)
+            return x
+        def done(x):
+            self.table.storeColumns([col])
+            df = self.table.model.df
+            if func == 'split':
+                self.table.model.updateFrame(pd.concat([df,x],1))
+                self.table.model.insertedColumns(len(df.columns), len(x.columns))
+                return
+            if inplace == 0:
+                newcol = col+'_'+func
+                if newcol in df.columns:
+                    df.drop(columns=newcol)
+                idx = df.columns.get_loc(col)
+                df.insert(idx+1, newcol, x)
+                self.table.model.insertedColumns(idx+1)
+            else:
+                df[col] = x
+                self.updateColumn(col)
+        self.table.runFrameJob('字符串操作', apply, done)
         return
 
     def resample(self):
@@ -1095,10 +1438,10 @@ class DataFrameWidget(QWidget):
 
     def merge(self):
 
-        dlg = dialogs.MergeDialog(self, self.table.model.df)
-        dlg.exec_()
-        if not dlg.accepted:
-            return
+        def show(df):
+            dlg = dialogs.MergeDialog(self, df)
+            dlg.exec_()
+        self.withSnapshotFrame('合并', show)
         return
 
     '''def runLastAction(self):
@@ -1117,34 +1460,35 @@ class DataFrameWidget(QWidget):
 
     def transpose(self):
 
-        self.table.model.df = self.table.model.df.T
+        self.table.model.df = self.table.model.viewFrame().T
         self.refresh()
         return
 
     def pivot(self):
         """透视表"""
 
-        dlg = dialogs.PivotDialog(self, self.table.model.df)
-        dlg.exec_()
-        if not dlg.accepted:
-            return
+        def show(df):
+            dlg = dialogs.PivotDialog(self, df)
+            dlg.exec_()
+        self.withSnapshotFrame('透视表', show)
         return
 
     def aggregate(self):
         """分组汇总操作"""
 
-        dlg = dialogs.AggregateDialog(self, self.table.model.df)
-        dlg.exec_()
-        if not dlg.accepted:
-            return
+        def show(df):
+            dlg = dialogs.AggregateDialog(self, df)
+            dlg.exec_()
+        self.withSnapshotFrame('分组汇总', show)
+        return
 
     def melt(self):
         """表格展开 (melt)"""
 
-        dlg = dialogs.MeltDialog(self, self.table.model.df)
-        dlg.exec_()
-        if not dlg.accepted:
-            return
+        def show(df):
+            dlg = dialogs.MeltDialog(self, df)
+            dlg.exec_()
+        self.withSnapshotFrame('展开', show)
         return
 
     def bin(self):
@@ -1200,6 +1544,24 @@ class DataFrameWidget(QWidget):
 
         return self.table.getSelectedDataFrame()
 
+    def getSnapshotFrame(self):
+        """表格当前数据的只读快照，表格之后的编辑不会改变它。内存映射的表
+        返回 None，见 withSnapshotFrame"""
+
+        snap = self.table.snapshot()
+        if snap is None:
+            return
+        return snap.df
+
+    def withSnapshotFrame(self, name, fn):
+        """以表格快照调用 fn(df)，内存映射的表先在后台任务中读入"""
+
+        if self.table.model.isMapped():
+            self.table.loadMapped(name, lambda: fn(self.getSnapshotFrame()))
+            return
+        fn(self.getSnapshotFrame())
+        return
+
     def subTableFromSelection(self):
 
         df = self.getSelectedDataFrame()
@@ -1327,7 +1689,7 @@ class DataFrameTable(QTableView):
     """基于 pandas DataFrame 的 QTableView。"""
     def __init__(self, parent=None, dataframe=None, font='Arial',
                     fontsize=12, columnwidth=80, timeformat='%m-%d-%Y',
-                    bg='#F4F4F3', **kwargs):
+                    bg='#F4F4F3', model=None, **kwargs):
 
         QTableView.__init__(self)
         self.parent = parent
@@ -1366,8 +1728,6 @@ class DataFrameTable(QTableView):
 
         #self.setDragDropMode(QAbstractItemView.InternalMove)
         self.setDropIndicatorShown(True)
-        self.resizeColumnsToContents()
-        self.resizeRowsToContents()
         self.setCornerButtonEnabled(True)
         #self.setSortingEnabled(True)
         self.updateFont()
@@ -1376,31 +1736,79 @@ class DataFrameTable(QTableView):
         #self.setWordWrap(True)
         #self.resizeRowsToContents()
 
-        tm = DataFrameModel(dataframe)
-        self.setModel(tm)
-        tm.bg = bg
-        self.model = tm
+        if model is None:
+            model = DataFrameModel(dataframe)
+        self.model = None
         self.filtered = False
         self.setWordWrap(True)
-
-        df = self.model.df
-        #disable column dragging for large tables
-        if len(df) > 1e5:
-            #print (len(df))
-            #hh.setHighlightSections(False)
-            hh.setSectionsClickable(False)
-            #hh.setStyle(HeaderProxyStyle())
+        self.setDataModel(model, bg)
 
         styledItemDelegate = QStyledItemDelegate()
         styledItemDelegate.setItemEditorFactory(ItemEditorFactory())
         self.setItemDelegate(styledItemDelegate)
+        return
 
-        #temp file for undo
-        file, self.undo_file = tempfile.mkstemp(suffix='.pkl')
-        try:
-            os.remove(self.undo_file)
-        except:
-            pass
+    def setDataModel(self, model, bg=None):
+        """设置表格使用的数据模型，例如内存映射的文件模型"""
+
+        hh = self.horizontalHeader()
+        old = self.model
+        if old is not None:
+            hh.sectionMoved.disconnect(old.schema.clearOrder)
+            if bg is None:
+                bg = old.bg
+        if bg is not None:
+            model.bg = bg
+        self.setModel(model)
+        self.model = model
+        self.filtered = False
+        self.filterrows = None
+        self.dataframe = None
+        if getattr(self, 'sortjob', None) is not None:
+            jobs.getManager().cancelJob(self.sortjob)
+        self.sortjob = None
+        self.indexengine = search.SearchEngine()
+        hh.sectionMoved.connect(model.schema.clearOrder)
+        model.structureChanged.connect(self.structureChanged)
+        if hasattr(self.parent, 'stateChanged'):
+            model.dataChanged.connect(self.parent.stateChanged)
+        #size from a sample of rows rather than scanning every row
+        self.resizeToSample()
+        if old is not None and hasattr(self.parent,'statusbar'):
+            self.parent.updateStatusBar()
+        self.buildSearchIndex()
+        return
+
+    def buildSearchIndex(self, df=None):
+        """在后台为大表的文本列建立搜索索引，供查找和过滤使用。
+        过滤时只为完整表 df 建立索引。"""
+
+        model = self.model
+        if SEARCHINDEX == False or model.isMapped():
+            return
+        if df is None:
+            if self.filtered == True:
+                return
+            df = model.df
+        if len(df) < search.MINROWS:
+            return
+        index = model.getSearchIndex(df)
+        if index is not None and len(index.stale) == 0:
+            return
+        engine = self.indexengine
+        generation = engine.start()
+        edits = model.edits
+        def done(index):
+            if index is None or self.getSourceFrame() is not df:
+                return
+            if model.edits != edits:
+                #edited while building
+                self.buildSearchIndex(df)
+                return
+            model.searchindex = index
+        worker = dialogs.Worker(engine.buildIndex, df, generation)
+        worker.signals.result.connect(done)
+        dialogs.getThreadPool().start(worker)
         return
 
     def updateFont(self):
@@ -1416,56 +1824,186 @@ class DataFrameTable(QTableView):
     def refresh(self):
         """当 DataFrame 更改时刷新表格"""
 
-        self.updateFont()
         #self.horizontalHeader().setDefaultSectionSize(COLUMNWIDTH)
+        self.model.cache.clear()
         self.model.beginResetModel()
+        replaced = self.model.updateWindow()
+        changed = self.model.updateSchema()
+        self.model.schema.clearOrder()
         index = self.model.index
         try:
             self.model.dataChanged.emit(0,0)
         except:
             self.model.dataChanged.emit(index(0,0),index(0,0))
         self.model.endResetModel()
+        #the header sizes its sections from the new columns
+        self.updateFont()
+        if replaced and changed:
+            self.resizeToSample()
+        if replaced:
+            self.buildSearchIndex()
         if hasattr(self.parent,'statusbar'):
             self.parent.updateStatusBar()
         return
 
+    def structureChanged(self):
+        """行或列增删后更新状态栏和绘图选项，无需重置模型"""
+
+        if hasattr(self.parent,'statusbar'):
+            self.parent.updateStatusBar()
+        if hasattr(self.parent, 'stateChanged'):
+            self.parent.stateChanged(None, None)
+        return
+
+    def resizeToSample(self, rows=100, maxcols=200, maxwidth=400):
+        """根据前若干行的样本设置列宽和行高，避免扫描所有行"""
+
+        model = self.model
+        schema = model.getSchema()
+        metrics = self.fontMetrics()
+        sample = model.getSample(rows)
+        lines = 1
+        for j in range(min(len(schema), maxcols)):
+            texts = formatValues(sample.iloc[:, j]) + [schema.labels[j]]
+            w = max(metrics.horizontalAdvance(t) for t in texts) + 12
+            lines = max(lines, max(t.count('\n')+1 for t in texts))
+            self.setColumnWidth(j, int(min(max(w, self.columnwidth), maxwidth)))
+        vh = self.verticalHeader()
+        h = metrics.height() * min(lines, 3) + 12
+        vh.setDefaultSectionSize(max(vh.defaultSectionSize(), h))
+        return
+
+    def selectAll(self):
+        """选择所有行，包括尚未载入视图的行"""
+
+        self.model.fetchAll()
+        QTableView.selectAll(self)
+        return
+
     def showAll(self):
         """重新显示未过滤内容"""
 
-        if hasattr(self, 'dataframe') and self.dataframe is not None:
-            self.model.df = self.dataframe
+        model = self.model
+        if model.isMapped():
+            model.setRowFilter(None)
+        else:
+            if self.filtered == True and getattr(self, 'dataframe', None) is not None \
+                and model.df is not self.dataframe:
+                model.updateFrame(self.dataframe)
+            model.showRows(None)
         self.filtered = False
+        self.filterrows = None
+        self.refresh()
+        return
+
+    def getSourceFrame(self):
+        """过滤前的完整 DataFrame"""
+
+        if self.filtered == True and getattr(self, 'dataframe', None) is not None:
+            return self.dataframe
+        return self.model.df
+
+    def filterRows(self, rows=None, cols=None):
+        """只显示完整表中给定位置的行和列，None 表示全部。不复制表格：
+        行号记录在模型中，按当前排序显示；选中的列与完整表共用数据。"""
+
+        model = self.model
+        df = self.getSourceFrame()
+        self.dataframe = df
+        self.filterrows = rows
+        if cols is None:
+            view = df
+        elif len(cols) == 0:
+            view = df.iloc[:, []]
+        else:
+            view = pd.concat([df.iloc[:, j] for j in cols], axis=1, copy=False)
+        if view is not model.df:
+            model.updateFrame(view)
+        model.showRows(rows)
+        self.filtered = True
         self.refresh()
         return
 
     def storeCurrent(self):
-        """在重大更改前保存当前表的版本"""
+        """在重大更改前记录当前表以便撤销，只保留表的浅拷贝，
+        列数据在被替换前与当前表共用"""
 
-        self.prevdf = self.model.df#.copy()
-        self.prevdf.to_pickle(self.undo_file)
-        #self.parent.updatesignal.speak.emit()
+        self.model.addUndo(journal.FrameEntry(self.model.df, self.model.roworder))
+        return
+
+    def storeColumns(self, names):
+        """在替换或新增给定列前记录这些列以便撤销，撤销时删除新增的列"""
+
+        df = self.model.df
+        if not df.columns.is_unique:
+            self.storeCurrent()
+            return
+        self.model.addUndo(journal.ColumnsEntry(df, names))
+        return
+
+    def storeCells(self, rows, cols):
+        """在就地修改给定行列位置的单元格前记录旧值以便撤销"""
+
+        model = self.model
+        if len(rows) == model.totalRows():
+            #whole columns are kept by reference instead of copied
+            self.storeColumns(model.df.columns[list(cols)])
+            return
+        model.addUndo(journal.CellsEntry(model, rows, cols))
+        return
+
+    def storeRows(self, rows, removed=False):
+        """在插入或删除给定位置的行前记录以便撤销，删除时保存被删的行"""
+
+        model = self.model
+        n = model.totalRows()
+        rows = np.unique(np.asarray(rows, dtype=np.int64))
+        if removed == True:
+            frame = model.getFrame(rows, range(model.columnCount()))
+            entry = journal.RowsEntry(rows, n-len(rows), frame)
+        else:
+            entry = journal.RowsEntry(rows, n+len(rows), dtypes=list(model.df.dtypes))
+        model.addUndo(entry)
         return
 
     def undo(self):
         """撤销对表的最后一次更改"""
 
-        if os.path.exists(self.undo_file):
-            print ('undo-ing')
-            self.model.df = pd.read_pickle(self.undo_file)
+        self.applyJournal(self.model.journal.undo)
+        return
+
+    def redo(self):
+        """重做上一次撤销的更改"""
+
+        self.applyJournal(self.model.journal.redo)
+        return
+
+    def applyJournal(self, func):
+
+        try:
+            entry = func(self.model)
+        except ValueError:
+            QMessageBox.information(self, '无法撤销',
+                                    '表格已被其他操作更改，撤销记录已清除。')
+            self.refresh()
+            return
+        if entry is not None and entry.replaces:
             self.refresh()
-            os.remove(self.undo_file)
         return
 
     def getMemory(self):
         """以字符串形式获取内存信息"""
 
-        m = self.model.df.memory_usage(deep=True).sum()
+        m, approx = self.model.memoryUsage()
+        approx = '~' if approx else ''
         if m>1e5:
             m = round(m/1048576,2)
             units='MB'
         else:
             units='Bytes'
-        s = "%s %s" %(m,units)
+        s = "%s%s %s" %(approx,m,units)
+        if self.model.isMapped():
+            s = '映射 ' + s
         return s
 
     def memory_usage(self):
@@ -1489,48 +2027,82 @@ class DataFrameTable(QTableView):
         """按显示顺序从表头获取列名"""
 
         hh = self.horizontalHeader()
-        df = self.model.df
-        logidx = [hh.logicalIndex(i) for i in range(0,self.model.columnCount())]
-        cols = [df.columns[i] for i in logidx]
-        return cols
+        return self.model.getSchema().getColumnOrder(hh)
 
     def checkColumnsUnique(self):
         """检查列名是否唯一"""
 
-        df = self.model.df
-        return len(df.columns) == len(set(df.columns))
+        return self.model.getSchema().unique
+
+    def getSelectionRanges(self):
+        """获取选中区域，返回 (top, bottom, left, right) 元组列表"""
+
+        sel = self.selectionModel().selection()
+        return [(r.top(), r.bottom(), r.left(), r.right()) for r in sel]
+
+    def setSelectionRanges(self, ranges):
+        """按 (top, bottom, left, right) 元组列表设置选中区域"""
+
+        if len(ranges) == 0:
+            return
+        self.model.fetchTo(max([r[1] for r in ranges]))
+        selection = QtCore.QItemSelection()
+        for top, bottom, left, right in ranges:
+            selection.select(self.model.index(top, left), self.model.index(bottom, right))
+        mode = QtCore.QItemSelectionModel.ClearAndSelect
+        self.selectionModel().select(selection, mode)
+        return
+
+    def getSelection(self):
+        """
+        获取选中的行和列位置，直接由选区范围计算而不逐个枚举单元格。
+        连续时返回 slice，否则返回按选择顺序排列的数组。
+        覆盖全部已载入行的区域视为整列选中，包括尚未载入的行。
+        """
+
+        loaded = self.model.rowCount()
+        total = self.model.totalRows()
+        rows = []
+        cols = []
+        for top, bottom, left, right in self.getSelectionRanges():
+            if top == 0 and bottom >= loaded-1:
+                bottom = total-1
+            rows.append((top, bottom+1))
+            cols.append((left, right+1))
+        return spansToPositions(rows), spansToPositions(cols)
 
     def getSelectedRows(self):
+        """获取选中行的索引"""
 
-        sm = self.selectionModel()
-        rows = [(i.row()) for i in sm.selectedIndexes()]
-        rows = list(dict.fromkeys(rows).keys())
-        return rows
+        rows, cols = self.getSelection()
+        return positionArray(rows).tolist()
 
     def getSelectedColumns(self):
         """获取选中列的索引"""
 
-        sm = self.selectionModel()
-        cols = [(i.column()) for i in sm.selectedIndexes()]
-        cols = list(dict.fromkeys(cols).keys())
-        return cols
+        rows, cols = self.getSelection()
+        return positionArray(cols).tolist()
 
     def getSelectedDataFrame(self):
         """将选择内容作为 DataFrame 获取"""
 
-        df = self.model.df
-        sm = self.selectionModel()
-        rows = [(i.row()) for i in sm.selectedIndexes()]
-        cols = [(i.column()) for i in sm.selectedIndexes()]
-        #get unique rows/cols keeping order
-        rows = list(dict.fromkeys(rows).keys())
-        cols = list(dict.fromkeys(cols).keys())
-        data = df.iloc[rows,cols]
+        rows, cols = self.getSelection()
+        return self.selectionFrame(rows, cols)
+
+    def selectionFrame(self, rows, cols, snapshot=None):
+        """取出给定行列位置的数据，尽量转换为数值以便绘图。
+        在后台运行时从快照 snapshot 中读取。"""
+
+        if snapshot is None:
+            data = self.model.getFrame(rows, cols)
+        else:
+            data = snapshot.getFrame(rows, cols)
         #try to get numeric data for plotting
         colnames = data.columns
         #for c in colnames:
         #try to get numeric values for plotting
         for c in range(len(data.columns)):
+            jobs.checkCancelled()
             #print (data.iloc[:,c])
             x = pd.to_numeric(data.iloc[:,c], errors='coerce').astype(float)
             if x.isnull().all():
@@ -1548,6 +2120,7 @@ class DataFrameTable(QTableView):
         #print (rows,cols)
         if len(rows)==0 or len(cols)==0:
             return
+        self.model.fetchTo(max(rows))
         topleft = self.model.index(rows[0], cols[0])
         bottomright = self.model.index(rows[-1], cols[-1])
         selection = QtCore.QItemSelection(topleft, bottomright)
@@ -1565,6 +2138,7 @@ class DataFrameTable(QTableView):
     def setScrollPosition(self, row, col):
         """移动到指定行/列位置"""
 
+        self.model.fetchTo(row)
         idx = self.model.index(row, col)
         self.scrollTo(idx)
         return
@@ -1577,7 +2151,6 @@ class DataFrameTable(QTableView):
     def columnClicked(self, col):
 
         hheader = self.horizontalHeader()
-        df = self.model.df
         #print (df[:2])
         #self.model.df = df.sort_values(df.columns[col])
         return
@@ -1585,16 +2158,156 @@ class DataFrameTable(QTableView):
     def selectColumn(self, event):
         print (self.model.df)
 
+    def goToValue(self, column=None, value=None):
+        """跳转到列中给定值所在的行，没有该值时跳到下一个更大的值"""
+
+        model = self.model
+        names = model.getSchema().names
+        if len(names) == 0:
+            return
+        if column is None:
+            current = self.currentIndex()
+            column = names[current.column() if current.isValid() else 0]
+        if value is None:
+            value, ok = QInputDialog.getText(self, '跳转到值', '列 %s 中的值:' %column)
+            if not ok or value == '':
+                return
+        row = model.findValue(column, value)
+        if row is None:
+            QMessageBox.information(self, '跳转到值', '没有找到不小于 %s 的值' %value)
+            return
+        model.fetchTo(row)
+        index = model.index(row, names.index(column))
+        self.setCurrentIndex(index)
+        self.scrollTo(index, QAbstractItemView.PositionAtCenter)
+        return
+
+    def runJob(self, name, fn, args=(), kwargs=None, done=None, error=None,
+               progress=False, partial=None):
+        """将耗时操作作为任务提交给任务管理器，在后台运行。同一表格的任务
+        依次运行，进度显示在所在控件的状态栏中，done 在界面线程中接收结果。"""
+
+        parent = self.parent
+        if isinstance(parent, DataFrameWidget):
+            key = parent
+        else:
+            key = self
+        label = getattr(parent, 'name', '')
+        return jobs.getManager().submit(name, fn, args, kwargs, key=key, label=label,
+                                        done=done, error=error, widget=parent,
+                                        progress=progress, partial=partial)
+
+    def snapshot(self, source=False):
+        """为后台任务取得表格当前版本的只读快照，附带列顺序。source 为 True
+        时取过滤前的完整表。内存映射的表没有快照，返回 None。"""
+
+        model = self.model
+        if model.isMapped():
+            return
+        meta = {'columnorder': None}
+        if self.checkColumnsUnique() == True:
+            meta['columnorder'] = self.getColumnOrder()
+        if source == True and self.filtered == True and \
+            getattr(self, 'dataframe', None) is not None:
+            #the full table is not edited while filtered
+            return Snapshot(self.dataframe, model.revision, meta=meta)
+        return model.snapshot(meta)
+
+    def loadMapped(self, name, done):
+        """在后台任务中把内存映射的整个文件按文件顺序读入内存，之后在界面
+        线程中调用 done()。视图的排序和过滤保留为表格的行顺序和显示的行，
+        隐藏的行仍在表中。"""
+
+        model = self.model
+        def args():
+            if model is not self.model or not model.isMapped():
+                return
+            return ()
+        def commit(df):
+            if model is not self.model or not model.isMapped():
+                return
+            model.setLoaded(df)
+            if hasattr(self.parent,'statusbar'):
+                self.parent.updateStatusBar()
+            done()
+        return self.runJob('读入 ' + name, model.loadFrame, args, done=commit)
+
+    def runFrameJob(self, name, fn, done, ordered=False):
+        """在后台对任务开始时的表格快照运行 fn(df)，done 在界面线程中写回
+        结果。任务运行期间表格被替换或修改时丢弃结果。df 为包括过滤隐藏行
+        在内的整个表，按表格本身的行序，结果与 model.df 对齐；ordered 为
+        True 时按排序顺序，排序后在任务中复制表格，结果需用
+        model.frameValues 放回。"""
+
+        model = self.model
+        if model.isMapped():
+            #jobs work on the whole table, load the file first
+            return self.loadMapped(name, lambda: self.runFrameJob(name, fn, done, ordered))
+        state = {}
+        def args():
+            if model is not self.model or model.isMapped():
+                return
+            state['snapshot'] = snap = model.snapshot()
+            state['order'] = model.roworder
+            return (snap,)
+        def commit(result):
+            if model is not self.model or not model.isCurrent(state['snapshot']):
+                QMessageBox.information(self, name, '任务运行时表格已被修改，结果已丢弃。')
+                return
+            done(result)
+        def run(snap):
+            #all rows, also those hidden by a filter
+            if ordered == True and state['order'] is not None:
+                return fn(snap.base.take(state['order']))
+            return fn(snap.base)
+        return self.runJob(name, run, args, done=commit)
+
     def sort(self, idx, ascending=True):
-        """按选中列排序"""
+        """按选中列排序，选中多列时一次按所有列排序。
+        大表作为任务在后台计算行顺序，不复制表格，排序中可以取消。"""
 
-        df = self.model.df
         sel = self.getSelectedColumns()
         if len(sel)>1:
-            for i in sel:
-                self.model.sort(i, ascending)
+            cols = list(sel)
         else:
-            self.model.sort(idx, ascending)
+            cols = [idx]
+        model = self.model
+        #a new sort replaces one still running
+        self.cancelSort()
+        if model.isMapped():
+            model.sort(cols, ascending)
+            return
+        if model.totalRows() < search.MINROWS:
+            entry = journal.OrderEntry(model.roworder, len(model.df))
+            model.sort(cols, ascending)
+            model.addUndo(entry)
+            return
+        state = {}
+        def args():
+            if model is not self.model or model.isMapped():
+                return
+            state['snapshot'] = snap = model.snapshot()
+            return (snap,)
+        def order(snap, progress_callback=None):
+            return model.sortOrder(cols, ascending, jobs.isCancelled, progress_callback,
+                                   df=snap.base)
+        def done(order):
+            #the frame was replaced or edited while sorting
+            if order is None or model is not self.model or \
+                not model.isCurrent(state['snapshot']):
+                return
+            entry = journal.OrderEntry(model.roworder, len(model.df))
+            model.setOrder(order)
+            model.addUndo(entry)
+        self.sortjob = self.runJob('排序', order, args, done=done, progress=True)
+        return
+
+    def cancelSort(self):
+        """取消后台排序"""
+
+        if self.sortjob is not None:
+            jobs.getManager().cancelJob(self.sortjob)
+            self.sortjob = None
         return
 
     def deleteCells(self, rows, cols, answer=None):
@@ -1605,9 +2318,16 @@ class DataFrameTable(QTableView):
                              '确定要清除选中单元格的内容吗？', QMessageBox.Yes, QMessageBox.No)
         if not answer:
             return
-        self.storeCurrent()
-        #print (rows, cols)
-        self.model.df.iloc[rows,cols] = np.nan
+        df = self.model.df
+        for j in positionArray(cols):
+            values = df.iloc[:, j]
+            editable = util.editableColumn(values, np.nan)
+            if editable is not values:
+                df.isetitem(j, editable)
+        self.storeCells(rows, cols)
+        self.model.detachColumns(positionArray(cols))
+        df.iloc[self.model.baseRows(rows),cols] = np.nan
+        self.model.updateCells(rows, cols)
         return
 
     def setRowColor(self, rowIndex, color):
@@ -1644,7 +2364,7 @@ class DataFrameTable(QTableView):
 
         hheader = self.horizontalHeader()
         idx = hheader.logicalIndexAt(pos)
-        column = self.model.df.columns[idx]
+        column = self.model.getSchema().names[idx]
         #model = self.model
         menu = QMenu(self)
 
@@ -1653,6 +2373,7 @@ class DataFrameTable(QTableView):
         iconw = QIcon.fromTheme("open")
         sortAction.setIcon(iconw)
         setIndexAction = menu.addAction("设为索引")
+        goToValueAction = menu.addAction("跳转到值")
 
         colmenu = QMenu("列",menu)
         deleteColumnAction = colmenu.addAction("删除列")
@@ -1691,6 +2412,8 @@ class DataFrameTable(QTableView):
             self.parent.convertNumeric()
         elif action == setIndexAction:
             self.setIndex(column)
+        elif action == goToValueAction:
+            self.goToValue(column)
         elif action == datetimeAction:
             self.parent.convertDates(column)
         elif action == filldataAction:
@@ -1709,9 +2432,10 @@ class DataFrameTable(QTableView):
 
     def keyPressEvent(self, event):
 
-        rows = self.getSelectedRows()
-        cols = self.getSelectedColumns()
         if event.key() == QtCore.Qt.Key_Delete:
+            #runs are passed as ranges so the cache drops whole blocks
+            rows, cols = [range(p.start, p.stop) if isinstance(p, slice) else p
+                            for p in self.getSelection()]
             self.deleteCells(rows, cols)
 
     def contextMenuEvent(self, event):
@@ -1723,12 +2447,6 @@ class DataFrameTable(QTableView):
         row = vheader.logicalIndexAt(vheader.mapFromGlobal(position))
         column = hheader.logicalIndexAt(hheader.mapFromGlobal(position))
 
-        # 将逻辑行索引映射为源模型的实际索引
-        df = self.model.df
-        if len(df) > 1:
-            row = df.iloc[row]
-        else:
-            row = None
         # 在表格底部的空白处显示上下文菜单...
         menu = QMenu(self)
         copyAction = menu.addAction("复制")
@@ -1755,6 +2473,7 @@ class DataFrameTable(QTableView):
         modegroup.setExclusive(True)
 
         memAction = menu.addAction("内存使用")
+        optimizeAction = menu.addAction("优化内存")
         action = menu.exec_(self.mapToGlobal(event.pos()))
 
         if action == copyAction:
@@ -1773,10 +2492,15 @@ class DataFrameTable(QTableView):
             self.addRows()
         elif action == memAction:
             self.memory_usage()
+        elif action == optimizeAction:
+            self.parent.optimizeMemory()
 
     def resetIndex(self):
 
-        self.model.df.reset_index(inplace=True)
+        #number the rows in the order shown
+        df = self.model.viewFrame()
+        df.reset_index(inplace=True)
+        self.model.df = df
         self.refresh()
         return
 
@@ -1827,11 +2551,12 @@ class DataFrameTable(QTableView):
         df = self.model.df
         if not name or name in df.columns:
             return
+        self.storeColumns([name])
         if fill != '':
             df[name] = fill
         else:
             df[name] = pd.Series()
-        self.refresh()
+        self.model.insertedColumns(len(df.columns)-1)
         return
 
     def deleteColumn(self, column=None):
@@ -1842,12 +2567,13 @@ class DataFrameTable(QTableView):
             cols = self.model.df.columns[idx]
         else:
             cols = [column]
+        pos = self.model.columnPositions(cols)
         reply = QMessageBox.question(self, '删除列？',
                      '确定要删除选中的列吗？', QMessageBox.Yes, QMessageBox.No)
         if reply == QMessageBox.No:
             return False
 
-        self.storeCurrent()
+        self.storeColumns(cols)
         df = self.model.df
         #treat duplicates as unique for deleting
         #dups = df.loc[:,df.columns.duplicated()].columns
@@ -1857,7 +2583,7 @@ class DataFrameTable(QTableView):
         #else:
         #    keep = [x for x in range(df.shape[1]) if x not in idx]
         #    self.model.df = df.iloc[:, keep]
-        self.refresh()
+        self.model.removedColumns(pos)
         return
 
     def addRows(self):
@@ -1867,14 +2593,15 @@ class DataFrameTable(QTableView):
                              "行数：", QLineEdit.Normal)
         if not ok:
             return
-        df = self.model.df
+        df = self.model.viewFrame()
         try:
             ind = self.df.index.max()+1
         except:
             ind = len(df)+1
         new = pd.DataFrame(np.nan, index=range(ind,ind+num), columns=df.columns)
+        self.storeRows(range(len(df), len(df)+num))
         self.model.df = pd.concat([df, new])
-        self.refresh()
+        self.model.insertedRows(len(df), num)
         return
 
     def deleteRows(self):
@@ -1885,9 +2612,13 @@ class DataFrameTable(QTableView):
                      '确定要删除选中的行吗？', QMessageBox.Yes, QMessageBox.No)
         if reply == QMessageBox.No:
             return False
-        idx = self.model.df.index[rows]
-        self.model.df = self.model.df.drop(idx)
-        self.refresh()
+        self.storeRows(rows, removed=True)
+        #drop by position so duplicate index labels are kept
+        model = self.model
+        keep = np.ones(model.totalRows(), dtype=bool)
+        keep[rows] = False
+        model.df = model.viewFrame(np.flatnonzero(keep))
+        self.model.removedRows(rows)
         return
 
     def viewRow(self):
@@ -1896,7 +2627,7 @@ class DataFrameTable(QTableView):
         pd.options.display.max_colwidth = 1000
         df = self.model.df
         rows = self.getSelectedRows()[0]
-        idx = df.index[rows]
+        idx = df.index[self.model.baseRows(rows)]
         row = df.loc[idx]
         text = '索引 %s 的行' %idx
         dlg = dialogs.TextDialog(self, row.to_string(), title=text, width=800, height=400)
@@ -1909,7 +2640,7 @@ class DataFrameTable(QTableView):
                              "名称：", QLineEdit.Normal, text=column)
         if ok and name:
             self.model.df.rename(columns={column:name},inplace=True)
-            self.refresh()
+            self.model.renamedColumns(self.model.columnPositions([name]))
         return
 
     def setColumnType(self, column=None):
@@ -1925,11 +2656,11 @@ class DataFrameTable(QTableView):
                              "类型：", types, 0, False)
         if not ok:
             return
-        self.storeCurrent()
+        self.storeColumns(cols)
         df = self.model.df
         for c in cols:
             df[c] = df[c].astype(newtype)
-        self.refresh()
+        self.model.updateCells(cols=self.model.columnPositions(cols))
         return
 
     def zoomIn(self, fontsize=None):
@@ -1957,13 +2688,13 @@ class DataFrameTable(QTableView):
     def changeColumnWidths(self, factor=1.1):
         """设置列宽"""
 
-        for col in range(len(self.model.df.columns)):
+        for col in range(self.model.columnCount()):
             wi = self.columnWidth(col)
             self.setColumnWidth(col,int(wi*factor))
 
     def setColumnWidths(self, widths):
 
-        for col in range(len(self.model.df.columns)):
+        for col in range(self.model.columnCount()):
             try:
                 self.setColumnWidth(col,widths[col])
             except:
@@ -1972,33 +2703,911 @@ class DataFrameTable(QTableView):
     def getColumnWidths(self):
 
         widths=[]
-        for col in range(len(self.model.df.columns)):
+        for col in range(self.model.columnCount()):
             widths.append(self.columnWidth(col))
         return widths
 
+class ColumnSchema(object):
+    """表格按列缓存的元数据：列名、类型种类、类型标志以及逻辑列到显示列的顺序。
+    只有表的列或类型真正变化时才增加版本号"""
+    def __init__(self):
+        self.version = 0
+        self.df = None
+        self.columns = None
+        self.dtypes = None
+        self.names = []
+        self.labels = []
+        self.kinds = []
+        self.numeric = []
+        self.datetime = []
+        self.categorical = []
+        self.multiindex = False
+        self.unique = True
+        self.order = None
+        return
+
+    def __len__(self):
+        return len(self.names)
+
+    def update(self, df):
+        """检查表格，列或类型变化时重建，重建时返回 True"""
+
+        self.df = df
+        columns = df.columns
+        dtypes = df.dtypes
+        if self.columns is not None and len(columns) == len(self.columns) \
+            and columns.equals(self.columns) and dtypes.equals(self.dtypes):
+            return False
+        self.columns = columns
+        self.dtypes = dtypes
+        self.names = list(columns)
+        self.labels = [str(c) for c in self.names]
+        self.kinds = [dt.kind for dt in dtypes]
+        self.numeric = [is_numeric_dtype(dt) and dt.kind != 'b' for dt in dtypes]
+        self.datetime = [is_datetime(dt) for dt in dtypes]
+        self.categorical = [isinstance(dt, pd.CategoricalDtype) for dt in dtypes]
+        self.multiindex = util.check_multiindex(columns) == 1
+        self.unique = columns.is_unique
+        self.order = None
+        self.version += 1
+        return True
+
+    def clearOrder(self, *args):
+        """清除显示顺序，例如移动了表头的列之后"""
+
+        self.order = None
+        return
+
+    def displayOrder(self, header):
+        """按显示顺序给出表头的逻辑列位置"""
+
+        if self.order is None or len(self.order) != len(self.names):
+            self.order = [header.logicalIndex(i) for i in range(len(self.names))]
+        return self.order
+
+    def getColumnOrder(self, header):
+        """按显示顺序给出列名"""
+
+        return [self.names[i] for i in self.displayOrder(header)]
+
+    def getLabels(self, kind=None):
+        """列名字符串，可只取数值、日期或分类列"""
+
+        if kind is None:
+            return self.labels
+        flags = getattr(self, kind)
+        return [l for l,f in zip(self.labels, flags) if f]
+
+class DisplayCache(object):
+    """DataFrameModel 显示文本的缓存。每次按列对一块行一次性向量化格式化，
+    按最近最少使用淘汰"""
+    def __init__(self, blocksize=256, maxblocks=512):
+        self.blocksize = blocksize
+        self.maxblocks = maxblocks
+        self.blocks = OrderedDict()
+        self.key = None
+        return
+
+    def clear(self):
+        """清空所有缓存块"""
+
+        self.blocks.clear()
+        return
+
+    def invalidate(self, rows=None, cols=None):
+        """丢弃涉及给定行位置和/或列位置的缓存块"""
+
+        if isinstance(rows, range):
+            rows = range(rows.start//self.blocksize, (rows.stop-1)//self.blocksize+1)
+        elif rows is not None:
+            rows = set(int(r)//self.blocksize for r in rows)
+        if cols is not None:
+            cols = set(cols)
+        for key in list(self.blocks.keys()):
+            b, j = key
+            if rows is not None and b not in rows:
+                continue
+            if cols is not None and j not in cols:
+                continue
+            del self.blocks[key]
+        return
+
+    def get(self, model, i, j):
+        """取单元格 i,j 的显示文本，需要时格式化所在的块"""
+
+        key = model.dataKey()
+        if key is not self.key:
+            #frame was replaced
+            self.clear()
+            self.key = key
+        b = i // self.blocksize
+        key = (b, j)
+        block = self.blocks.get(key)
+        if block is None:
+            start = b * self.blocksize
+            values = model.getBlock(start, start+self.blocksize, j)
+            block = formatValues(values)
+            self.blocks[key] = block
+            if len(self.blocks) > self.maxblocks:
+                self.blocks.popitem(last=False)
+        else:
+            self.blocks.move_to_end(key)
+        try:
+            return block[i - b * self.blocksize]
+        except IndexError:
+            return ''
+
+class HighlightLayers(object):
+    """DataFrameModel 的稀疏单元格高亮，分为命名的层，每层有自己的颜色。
+    每层按列保存排好序的行位置，或整行高亮的行位置，内存随命中数而不是
+    表的大小增长。查询使用按需生成的小块掩码，后面的层画在前面的层之上"""
+    def __init__(self, blocksize=256, maxblocks=1024):
+        self.blocksize = blocksize
+        self.maxblocks = maxblocks
+        self.layers = OrderedDict()
+        self.blocks = OrderedDict()
+        return
+
+    def __len__(self):
+        return len(self.layers)
+
+    def setLayer(self, name, cells=None, rows=None, color='lightblue'):
+        """添加或替换一层。cells 为列位置到行位置的字典，rows 为所有列都高亮的行"""
+
+        layer = {'color': QColor(color), 'cells': {}, 'rows': None}
+        if cells is not None:
+            for j in cells:
+                r = np.unique(np.asarray(cells[j], dtype=np.int64))
+                if len(r) > 0:
+                    layer['cells'][int(j)] = r
+        if rows is not None:
+            layer['rows'] = np.unique(np.asarray(rows, dtype=np.int64))
+        self.layers.pop(name, None)
+        self.layers[name] = layer
+        self.blocks.clear()
+        return
+
+    def addCells(self, name, rows, cols, color='lightblue'):
+        """把以行、列位置数组给出的命中追加到一层，需要时创建该层。
+        行必须在已添加的行之后"""
+
+        if name not in self.layers:
+            self.setLayer(name, color=color)
+        cells = self.layers[name]['cells']
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols)
+        for j in np.unique(cols):
+            r = rows[cols == j]
+            j = int(j)
+            if j in cells:
+                r = np.concatenate([cells[j], r])
+            cells[j] = r
+        self.blocks.clear()
+        return
+
+    def setMask(self, name, mask, color='lightblue'):
+        """由与表格形状相同的布尔 DataFrame 或二维数组添加一层"""
+
+        mask = np.asarray(mask, dtype=bool)
+        cells = {j: np.flatnonzero(mask[:,j]) for j in range(mask.shape[1])}
+        self.setLayer(name, cells, color=color)
+        return
+
+    def removeLayer(self, name):
+
+        if name in self.layers:
+            del self.layers[name]
+            self.blocks.clear()
+        return
+
+    def clear(self):
+
+        self.layers.clear()
+        self.blocks.clear()
+        return
+
+    def count(self, name):
+        """一层中高亮的单元格数，整行只算一次"""
+
+        if name not in self.layers:
+            return 0
+        layer = self.layers[name]
+        n = sum(len(r) for r in layer['cells'].values())
+        if layer['rows'] is not None:
+            n += len(layer['rows'])
+        return n
+
+    def getCells(self, name):
+        """按行顺序给出一层中高亮的 (行, 列) 位置"""
+
+        if name not in self.layers:
+            return []
+        cells = self.layers[name]['cells']
+        if len(cells) == 0:
+            return []
+        rows = np.concatenate([cells[j] for j in cells])
+        cols = np.concatenate([np.full(len(cells[j]), j) for j in cells])
+        order = np.lexsort((cols, rows))
+        return list(zip(rows[order].tolist(), cols[order].tolist()))
+
+    def getBlock(self, b, j):
+        """第 j 列第 b 块每行的颜色序号，未高亮处为 -1"""
+
+        key = (b, j)
+        block = self.blocks.get(key)
+        if block is not None:
+            self.blocks.move_to_end(key)
+            return block
+        start = b * self.blocksize
+        end = start + self.blocksize
+        block = np.full(self.blocksize, -1, dtype=np.int16)
+        for k, layer in enumerate(self.layers.values()):
+            for r in (layer['cells'].get(j), layer['rows']):
+                if r is None:
+                    continue
+                lo, hi = np.searchsorted(r, [start, end])
+                block[r[lo:hi] - start] = k
+        self.blocks[key] = block
+        if len(self.blocks) > self.maxblocks:
+            self.blocks.popitem(last=False)
+        return block
+
+    def get(self, i, j):
+        """单元格 i,j 的颜色，没有则为 None"""
+
+        if len(self.layers) == 0:
+            return None
+        b = i // self.blocksize
+        k = self.getBlock(b, j)[i - b * self.blocksize]
+        if k < 0:
+            return None
+        return list(self.layers.values())[k]['color']
+
+    def shiftRows(self, first, count):
+        """把 first 及之后的行上的命中后移 count 行，例如插入行之后"""
+
+        for layer in self.layers.values():
+            for r in list(layer['cells'].values()) + [layer['rows']]:
+                if r is not None:
+                    r[r >= first] += count
+        self.blocks.clear()
+        return
+
+    def permuteRows(self, order):
+        """跟随行的重排，order 为每个新行原来的位置"""
+
+        new = np.empty(len(order), dtype=np.int64)
+        new[order] = np.arange(len(order))
+        for layer in self.layers.values():
+            cells = layer['cells']
+            for j in cells:
+                cells[j] = np.sort(new[cells[j]])
+            if layer['rows'] is not None:
+                layer['rows'] = np.sort(new[layer['rows']])
+        self.blocks.clear()
+        return
+
+    def removeRows(self, rows):
+        """去掉被删行上的命中并合拢空位"""
+
+        rows = np.unique(np.asarray(rows, dtype=np.int64))
+        def remove(r):
+            r = r[~np.isin(r, rows)]
+            return r - np.searchsorted(rows, r)
+        for layer in self.layers.values():
+            cells = layer['cells']
+            for j in cells:
+                cells[j] = remove(cells[j])
+            if layer['rows'] is not None:
+                layer['rows'] = remove(layer['rows'])
+        self.blocks.clear()
+        return
+
+    def shiftColumns(self, first, count):
+        """把 first 及之后的列上的命中后移 count 列"""
+
+        for layer in self.layers.values():
+            layer['cells'] = {(j+count if j >= first else j): r
+                              for j, r in layer['cells'].items()}
+        self.blocks.clear()
+        return
+
+    def removeColumns(self, cols):
+        """去掉被删列上的命中并合拢空位"""
+
+        cols = sorted(set(cols))
+        for layer in self.layers.values():
+            layer['cells'] = {j - int(np.searchsorted(cols, j)): r
+                              for j, r in layer['cells'].items() if j not in cols}
+        self.blocks.clear()
+        return
+
+def formatValues(values):
+    """一次性格式化一个 series 用于显示，返回字符串列表。
+    浮点数按 PRECISION，日期按 TIMEFORMAT，缺失值为空"""
+
+    floatfmt = '%%.%sf' %PRECISION
+    if len(values) == 0:
+        return []
+    if isinstance(values.dtype, pd.SparseDtype):
+        values = values.sparse.to_dense()
+    dtype = values.dtype
+    if is_datetime(dtype):
+        return values.dt.strftime(TIMEFORMAT).fillna('').tolist()
+    elif isinstance(dtype, np.dtype) and dtype.kind == 'f':
+        arr = values.to_numpy()
+        text = np.char.mod(floatfmt, arr).astype(object)
+        text[np.isnan(arr)] = ''
+        return text.tolist()
+    elif isinstance(dtype, np.dtype) and dtype.kind in 'iub':
+        return values.to_numpy().astype(str).tolist()
+
+    def fmt(value):
+        if type(value) is str:
+            return value
+        elif type(value) in [float,np.float64]:
+            if np.isnan(value):
+                return ''
+            return floatfmt % value
+        elif value is pd.NaT or value is pd.NA:
+            return ''
+        return str(value)
+    return [fmt(v) for v in values.astype(object).to_numpy()]
+
+def toRanges(positions):
+    """把排好序的不重复位置分组为 (first, last) 连续段"""
+
+    ranges = []
+    for p in positions:
+        if len(ranges) > 0 and p == ranges[-1][1]+1:
+            ranges[-1][1] = p
+        else:
+            ranges.append([p, p])
+    return [tuple(r) for r in ranges]
+
+def spansToPositions(spans):
+    """半开区间 (start, stop) 覆盖的位置，按首次出现的顺序。
+    构成单个连续段时返回 slice"""
+
+    spans = [s for s in dict.fromkeys(spans) if s[1] > s[0]]
+    if len(spans) == 0:
+        return np.array([], dtype=np.int64)
+    if len(spans) == 1:
+        return slice(*spans[0])
+    pos = np.concatenate([np.arange(start, stop) for start, stop in spans])
+    first = np.unique(pos, return_index=True)[1]
+    pos = pos[np.sort(first)]
+    if pos[-1] - pos[0] == len(pos) - 1 and (np.diff(pos) == 1).all():
+        return slice(int(pos[0]), int(pos[-1])+1)
+    return pos
+
+def countPositions(positions):
+    """slice 或数组中的位置个数"""
+
+    if isinstance(positions, slice):
+        return max(positions.stop - positions.start, 0)
+    return len(positions)
+
+def positionArray(positions):
+    """把 slice 或列表形式的位置转为整数数组"""
+
+    if isinstance(positions, slice):
+        return np.arange(positions.start, positions.stop, dtype=np.int64)
+    return np.asarray(positions, dtype=np.int64)
+
+def runInBackground(func):
+    """在后台线程池中运行无参数的函数"""
+
+    worker = dialogs.Worker(lambda progress_callback: func())
+    dialogs.getThreadPool().start(worker)
+    return
+
+def sortKey(values, ascending=True):
+    """列用于 np.lexsort 的数值键，缺失值排在最后"""
+
+    dtype = values.dtype
+    if isinstance(dtype, np.dtype) and dtype.kind == 'f':
+        #nan already sorts last
+        arr = values.to_numpy()
+        return arr if ascending else -arr
+    try:
+        codes, uniques = pd.factorize(values, sort=True)
+    except TypeError:
+        #mixed types are compared as text
+        codes, uniques = pd.factorize(values.astype(str), sort=True)
+    codes = codes.astype(np.int64)
+    if ascending:
+        codes[codes < 0] = len(uniques)
+        return codes
+    return len(uniques) - 1 - codes
+
+class Snapshot(object):
+    """表格在模型某个版本时的只读副本，在 GUI 线程上取得，供后台任务使用。
+    表是共享列数据的浅拷贝，模型在写入共享的列之前先复制它，
+    见 DataFrameModel.detachColumns。尚未应用的排序在第一次使用表时才应用，
+    即在任务中而不是在 GUI 线程上。meta 保存同时取得的表格设置，例如列顺序"""
+    def __init__(self, df, version, order=None, meta=None):
+        self.base = df.copy(deep=False)
+        self.order = order
+        self.version = version
+        self.meta = meta or {}
+        self.frame = None
+        return
+
+    @property
+    def df(self):
+        """按视图顺序的表"""
+
+        if self.order is None:
+            return self.base
+        if self.frame is None:
+            self.frame = self.base.iloc[self.order]
+        return self.frame
+
+    def getFrame(self, rows, cols):
+        """以 DataFrame 取给定视图行和列位置的数据"""
+
+        if self.order is not None:
+            rows = self.order[rows]
+        return self.base.iloc[rows, cols]
+
 class DataFrameModel(QtCore.QAbstractTableModel):
     """
     DataFrame Model class.
     """
+    #emitted after rows or columns are inserted or removed
+    structureChanged = Signal()
+
     def __init__(self, dataframe=None, *args):
         super(DataFrameModel, self).__init__()
+        #rows of the frame shown, in view order, after a sort or filter,
+        #combined from the sort order and the filtered rows
+        self.vieworder = None
+        self.roworder = None
+        self.rowsubset = None
+        #changes on every edit or new frame, see snapshot
+        self.revision = 0
+        #frames of snapshots still in use with their column arrays
+        self.snapshots = []
         if dataframe is None:
             self.df = util.getEmptyData()
         else:
             self.df = dataframe
         self.bg = '#F4F4F3'
-        self.highlighted = None
+        self.highlights = HighlightLayers()
+        #text index of the frame, built in the background by the table
+        self.searchindex = None
+        self.edits = 0
+        #edit counts of the frame and of each column, see columnVersion
+        self.version = 0
+        self.versions = {}
+        #column indexes used by filters, see filters.IndexCache
+        self.colindexes = filters.IndexCache()
+        #undo and redo of edits, see addUndo
+        self.journal = journal.Journal()
+        self.journal.run = runInBackground
+        self.cache = DisplayCache()
+        self.schema = ColumnSchema()
+        #rows are exposed to the view in pages, see fetchMore
+        self.fetchsize = 10000
+        self.loaded = self.fetchsize
+        self.windowkey = self.dataKey()
+        #counts reported to the view while a change is being notified
+        self.rowsshown = None
+        self.columnsshown = None
+        return
+
+    @property
+    def df(self):
+        """按自身行顺序的表。排序只改变行显示的顺序，见 setOrder：
+        用 baseRows 把视图行映射到表的行，或使用 getFrame、getBlock 和 viewFrame"""
+
+        return self._df
+
+    @df.setter
+    def df(self, df):
+        if self.vieworder is not None:
+            #rows of the new frame no longer match the search index
+            self.searchindex = None
+        self._df = df
+        self.vieworder = None
+        self.roworder = None
+        self.rowsubset = None
+        self.revision += 1
+
+    def dataKey(self):
+        """标识当前数据的对象，显示的行或列被替换时随之替换"""
+
+        return self._df
+
+    def isMapped(self):
+        """数据不是以 DataFrame 保存在内存中时为 True"""
+
+        return False
+
+    def baseRows(self, rows):
+        """给定视图行在表中的位置"""
+
+        if self.vieworder is None:
+            return rows
+        if isinstance(rows, slice):
+            return self.vieworder[rows]
+        return self.vieworder[np.asarray(rows, dtype=np.int64)]
+
+    def getBlock(self, start, stop, j):
+        """以 series 取第 j 列的 start:stop 行"""
+
+        if self.vieworder is None:
+            return self._df.iloc[start:stop, j]
+        return self._df.iloc[self.vieworder[start:stop], j]
+
+    def getFrame(self, rows, cols):
+        """以 DataFrame 取给定行和列位置的数据"""
+
+        return self._df.iloc[self.baseRows(rows), cols]
+
+    def getSample(self, n=100):
+        """以 DataFrame 取前 n 行"""
+
+        if self.vieworder is None:
+            return self._df.iloc[:n]
+        return self._df.iloc[self.vieworder[:n]]
+
+    def viewFrame(self, rows=None):
+        """以视图顺序的 DataFrame 取给定视图行，默认全部行。
+        表按排序显示时复制这些行，按表自身顺序显示全部行时直接返回表"""
+
+        if rows is None:
+            if self.vieworder is None:
+                return self._df
+            return self._df.take(self.vieworder)
+        return self._df.iloc[self.baseRows(rows)]
+
+    def updateFrame(self, df):
+        """用行和顺序都相同的表替换当前表，例如增删或重命名了列的表。
+        与设置 df 不同，视图顺序和过滤的行保持不变"""
+
+        state = self.vieworder, self.roworder, self.rowsubset
+        self.vieworder = None
+        self.df = df
+        self.vieworder, self.roworder, self.rowsubset = state
+        return
+
+    def frameValues(self, values):
+        """把按排序顺序给出的每行的值转为表的顺序，用于给 df 的列赋值。
+        包括被过滤隐藏的行，series 保留原标签"""
+
+        order = self.roworder
+        if order is None or np.ndim(values) == 0 or len(values) != len(order):
+            return values
+        inverse = np.empty(len(order), dtype=np.int64)
+        inverse[order] = np.arange(len(order))
+        if isinstance(values, (pd.Series, pd.DataFrame)):
+            return values.iloc[inverse]
+        return np.asarray(values)[inverse]
+
+    def getRowLabel(self, i):
+        """第 i 行索引标签的显示文本"""
+
+        index = self._df.index
+        if self.vieworder is not None:
+            i = self.vieworder[i]
+        value = index[i]
+        if type(index) == pd.DatetimeIndex:
+            if value is pd.NaT:
+                return ''
+            try:
+                return value.strftime(TIMEFORMAT)
+            except:
+                return ''
+        return str(value)
+
+    def schemaFrame(self):
+        """用于建立列元数据的、带有列和类型的表"""
+
+        return self._df
+
+    def memoryUsage(self, maxrows=1e6):
+        """数据占用的内存字节数。返回大小以及是否由部分行的样本推算"""
+
+        df = self._df
+        extra = 0
+        if self.vieworder is not None:
+            extra = self.vieworder.nbytes
+        if len(df) > maxrows:
+            #deep usage of object columns is slow, extrapolate from a sample
+            sample = df.iloc[:100000]
+            m = sample.memory_usage(deep=True).sum() * len(df) / len(sample)
+            return m + extra, True
+        return df.memory_usage(deep=True).sum() + extra, False
+
+    def updateWindow(self):
+        """表被替换时回到第一页行，表有变化时返回 True"""
+
+        key = self.dataKey()
+        if self.windowkey is key:
+            return False
+        self.windowkey = key
+        self.loaded = self.fetchsize
+        return True
+
+    def totalRows(self):
+        """显示的行数，包括尚未取出的行"""
+
+        if self.vieworder is not None:
+            return len(self.vieworder)
+        return len(self._df.index)
+
+    def canFetchMore(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return False
+        return self.loaded < self.totalRows()
+
+    def fetchMore(self, parent=QtCore.QModelIndex(), rows=None):
+        """向视图开放下一页行"""
+
+        if parent.isValid():
+            return
+        total = self.totalRows()
+        start = min(self.loaded, total)
+        if rows is None:
+            rows = self.fetchsize
+        end = min(start + rows, total)
+        if end <= start:
+            return
+        self.beginInsertRows(QtCore.QModelIndex(), start, end-1)
+        self.loaded = end
+        self.endInsertRows()
+        return
+
+    def fetchTo(self, row):
+        """确保直到给定位置的行都可用"""
+
+        row = int(row)
+        if row >= self.rowCount():
+            self.fetchMore(rows=row - self.rowCount() + self.fetchsize)
+        return
+
+    def fetchAll(self):
+        """开放全部行"""
+
+        self.fetchMore(rows=self.totalRows())
+        return
+
+    def getSchema(self):
+        """取列元数据，表被替换时重建"""
+
+        df = self.schemaFrame()
+        if self.schema.df is not df:
+            self.schema.update(df)
+        return self.schema
+
+    def updateSchema(self):
+        """对照当前表检查列元数据，有变化时返回 True"""
+
+        return self.schema.update(self.schemaFrame())
+
+    def columnPositions(self, names):
+        """给定列名的位置，包括重复的列"""
+
+        return list(np.flatnonzero(self._df.columns.isin(names)))
+
+    def getSearchIndex(self, df=None):
+        """为此表建立的文本搜索索引，没有则为 None"""
+
+        if self.isMapped() or self.searchindex is None:
+            return
+        if df is None:
+            df = self._df
+        if self.searchindex.isFor(df):
+            return self.searchindex
+
+    def touchColumns(self, cols=None):
+        """记录这些位置上的列的值已改变，None 表示整张表的行都已改变"""
+
+        if cols is None:
+            self.version += 1
+            return
+        names = self._df.columns
+        for j in cols:
+            if j < len(names):
+                name = names[j]
+                self.versions[name] = self.versions.get(name, 0) + 1
+        return
+
+    def columnVersion(self, name):
+        """指定列的值每次改变时都会变化"""
+
+        return (self.version, self.versions.get(name, 0))
+
+    def findValue(self, name, text):
+        """在指定列中查找等于给定文本值的行，没有则取下一个更大的值。
+        使用该列的排序索引，列改变前一直保留。没有这样的行时为 None"""
+
+        index = self.colindexes.get(self._df, 'sorted', name, self.columnVersion(name))
+        if index is None:
+            return
+        if self.vieworder is None:
+            return index.find(text)
+        value = index.key(text)
+        if value is None:
+            return
+        found = index.order[index.first(value):]
+        if self.rowsubset is not None:
+            #first row in value order that is shown
+            shown = np.zeros(len(self._df), dtype=bool)
+            shown[self.rowsubset] = True
+            found = found[shown[found]]
+        if len(found) == 0:
+            return
+        return int(np.flatnonzero(self.vieworder == found[0])[0])
+
+    def followIndex(self, nrows=None, ncols=None):
+        """对报告的改变需要更新的搜索索引。表可能已被替换，
+        此时索引在改变前必须具有给定的行数和列数"""
+
+        self.edits += 1
+        self.revision += 1
+        index = self.searchindex
+        if index is None or self.isMapped():
+            return
+        if index.isFor(self._df):
+            return index
+        if (nrows is None or index.nrows == nrows) and \
+            (ncols is None or len(index.names) == ncols):
+            return index
+        self.searchindex = None
+        return
+
+    def updateCells(self, rows=None, cols=None, roles=None):
+        """报告值已原地改变，rows 和 cols 为位置，None 表示全部。
+        对视图中已显示的行发出外接范围的 dataChanged。
+        只有背景等角色改变时保留显示文本"""
+
+        if roles is None or QtCore.Qt.DisplayRole in roles:
+            self.cache.invalidate(rows=rows, cols=cols)
+            self.updateSchema()
+            self.touchColumns(range(self.columnCount()) if cols is None else cols)
+            index = self.followIndex(self.totalRows(), self.columnCount())
+            if index is not None:
+                index.setFrame(self._df)
+                index.updateCells(self._df, None if rows is None else self.baseRows(rows), cols)
+        def bounds(x, n):
+            if x is None:
+                return 0, n-1
+            if isinstance(x, range):
+                return x.start, min(x.stop-1, n-1)
+            if len(x) == 0:
+                return n, -1
+            return min(x), min(max(x), n-1)
+        top, bottom = bounds(rows, self.rowCount())
+        left, right = bounds(cols, self.columnCount())
+        if top > bottom or left > right:
+            return
+        topleft = self.index(top, left)
+        bottomright = self.index(bottom, right)
+        if roles is None:
+            self.dataChanged.emit(topleft, bottomright)
+        else:
+            self.dataChanged.emit(topleft, bottomright, roles)
+        return
+
+    def insertedColumns(self, first, count=1):
+        """报告表改变后在位置 first 插入了 count 列"""
+
+        total = len(self.schemaFrame().columns)
+        self.columnsshown = total - count
+        self.beginInsertColumns(QtCore.QModelIndex(), first, first+count-1)
+        self.columnsshown = None
+        self.updateSchema()
+        self.cache.invalidate(cols=range(first, total))
+        self.highlights.shiftColumns(first, count)
+        self.touchColumns(range(first, first+count))
+        index = self.followIndex(self.totalRows(), total-count)
+        if index is not None:
+            index.insertedColumns(self.df, first, count)
+        self.endInsertColumns()
+        self.structureChanged.emit()
+        return
+
+    def removedColumns(self, cols):
+        """报告给定原位置上的列已被删除"""
+
+        cols = sorted(set(cols))
+        if len(cols) == 0:
+            return
+        self.columnsshown = len(self.schemaFrame().columns) + len(cols)
+        self.cache.invalidate(cols=range(cols[0], self.columnsshown))
+        self.highlights.removeColumns(cols)
+        for first, last in reversed(toRanges(cols)):
+            self.beginRemoveColumns(QtCore.QModelIndex(), first, last)
+            self.columnsshown -= last-first+1
+            self.endRemoveColumns()
+        self.columnsshown = None
+        self.updateSchema()
+        index = self.followIndex(self.totalRows(), self.columnCount()+len(cols))
+        if index is not None:
+            index.removedColumns(self.df, cols)
+        self.structureChanged.emit()
+        return
+
+    def renamedColumns(self, cols=None):
+        """报告列名已改变"""
+
+        self.updateSchema()
+        n = self.columnCount()
+        if n == 0:
+            return
+        if cols is None:
+            cols = range(n)
+        self.touchColumns(cols)
+        index = self.followIndex(self.totalRows(), n)
+        if index is not None:
+            index.setFrame(self.df)
+        self.headerDataChanged.emit(QtCore.Qt.Horizontal, min(cols), max(cols))
+        return
+
+    def insertedRows(self, first, count=1):
+        """报告表改变后在位置 first 插入了 count 行。
+        显示范围之外的行由视图按需取出"""
+
+        total = self.totalRows()
+        self.cache.invalidate(rows=range(first, total))
+        self.highlights.shiftRows(first, count)
+        self.touchColumns()
+        index = self.followIndex(total-count, self.columnCount())
+        if index is not None:
+            index.insertedRows(self.df, first, count)
+        shown = min(total - count, self.loaded)
+        if first <= shown:
+            self.rowsshown = shown
+            self.beginInsertRows(QtCore.QModelIndex(), first, first+count-1)
+            self.loaded = shown + count
+            self.rowsshown = None
+            self.endInsertRows()
+        self.structureChanged.emit()
+        return
+
+    def removedRows(self, rows):
+        """报告给定原位置上的行已被删除"""
+
+        rows = sorted(set(rows))
+        if len(rows) == 0:
+            return
+        total = self.totalRows() + len(rows)
+        self.cache.invalidate(rows=range(rows[0], total))
+        self.highlights.removeRows(rows)
+        self.touchColumns()
+        index = self.followIndex(total, self.columnCount())
+        if index is not None:
+            index.removedRows(self.df, rows)
+        self.rowsshown = min(total, self.loaded)
+        for first, last in reversed(toRanges(rows)):
+            if first >= self.rowsshown:
+                continue
+            last = min(last, self.rowsshown-1)
+            self.beginRemoveRows(QtCore.QModelIndex(), first, last)
+            self.rowsshown -= last-first+1
+            self.loaded -= last-first+1
+            self.endRemoveRows()
+        self.rowsshown = None
+        self.structureChanged.emit()
         return
 
     def update(self, df):
         #print('Updating Model')
         self.df = df
+        self.cache.clear()
 
     def rowCount(self, parent=QtCore.QModelIndex()):
-        return len(self.df.index)
+        if self.rowsshown is not None:
+            return self.rowsshown
+        return min(self.totalRows(), self.loaded)
 
     def columnCount(self, parent=QtCore.QModelIndex()):
-        return len(self.df.columns.values)
+        if self.columnsshown is not None:
+            return self.columnsshown
+        return len(self.getSchema())
 
     def data(self, index, role=QtCore.Qt.DisplayRole):
         """Edit or display roles. Handles what happens when the Cells
@@ -2006,33 +3615,12 @@ class DataFrameModel(QtCore.QAbstractTableModel):
         https://www.pythonguis.com/tutorials/pyside-qtableview-modelviews-numpy-pandas/
         """
 
-        floatfmt = '{0:.%sf}' %PRECISION
         i = index.row()
         j = index.column()
-        #print (self.df.dtypes)
-        try:
-            coltype = self.df.dtypes[j]
-        except:
-            coltype = self.df[self.df.columns[j]].dtype
-        isdate = is_datetime(coltype)
         if role == QtCore.Qt.DisplayRole:
-            value = self.df.iloc[i, j]
-            if isdate and not value is pd.NaT:
-                try:
-                    return value.strftime(TIMEFORMAT)
-                except:
-                    return ''
-            elif type(value) != str:
-                if type(value) in [float,np.float64] and np.isnan(value):
-                    return ''
-                elif type(value) in [float,np.float64]:
-                    return floatfmt.format(value)
-                else:
-                    return (str(value))
-            else:
-                return '{0}'.format(value)
+            return self.cache.get(self, i, j)
         elif (role == QtCore.Qt.EditRole):
-            value = self.df.iloc[i, j]
+            value = self._df.iloc[self.baseRows(i), j]
             #print (coltype)
             #print (value,type(value))
             if type(value) is str:
@@ -2048,30 +3636,19 @@ class DataFrameModel(QtCore.QAbstractTableModel):
                     return str(value)
 
         elif role == QtCore.Qt.BackgroundRole:
-            if self.highlighted is None:
-                return QColor(self.bg)
-            value = self.highlighted.iloc[i, j]
-            if value == True:
-                return QColor('lightblue')
-            else:
+            color = self.highlights.get(i, j)
+            if color is None:
                 return QColor(self.bg)
+            return color
 
     def headerData(self, col, orientation, role):
         """表头显示内容"""
 
         if role == QtCore.Qt.DisplayRole:
             if orientation == QtCore.Qt.Horizontal:
-                return str(self.df.columns[col])
+                return self.getSchema().labels[col]
             if orientation == QtCore.Qt.Vertical:
-                value = self.df.index[col]
-                if type( self.df.index) == pd.DatetimeIndex:
-                    if not value is pd.NaT:
-                        try:
-                            return value.strftime(TIMEFORMAT)
-                        except:
-                            return ''
-                else:
-                    return str(value)
+                return self.getRowLabel(col)
         return None
 
     def setData(self, index, value, role=QtCore.Qt.EditRole):
@@ -2079,24 +3656,165 @@ class DataFrameModel(QtCore.QAbstractTableModel):
 
         i = index.row()
         j = index.column()
-        curr = self.df.iloc[i,j]
-        #print (curr, value)
-        self.df.iloc[i,j] = value
+        #sparse and category columns from optimize memory become plain
+        #columns when they cannot hold the value
+        values = self._df.iloc[:, j]
+        editable = util.editableColumn(values, value)
+        if editable is not values:
+            self._df.isetitem(j, editable)
+        entry = journal.CellsEntry(self, [i], [j])
+        #edit the frame in place, also when it is shown sorted
+        r = self.baseRows(i)
+        self.detachColumns([j])
+        try:
+            self._df.iloc[r,j] = value
+        except (TypeError, ValueError):
+            return False
+        self.addUndo(entry)
+        self.cache.invalidate(cols=[j])
+        self.touchColumns([j])
+        index = self.followIndex()
+        if index is not None:
+            index.updateCells(self._df, [r], [j])
         return True
 
+    def putValues(self, rows, cols, values):
+        """把一个表的值原地写入给定的视图行和列位置。
+        编辑时改变了类型的列恢复为原值的类型"""
+
+        self.detachColumns(cols)
+        df = self._df
+        r = self.baseRows(rows)
+        for k, j in enumerate(cols):
+            col = values.iloc[:, k]
+            df.iloc[r, j] = col.to_numpy()
+            if df.dtypes.iloc[j] != col.dtype:
+                try:
+                    df.isetitem(j, df.iloc[:, j].astype(col.dtype))
+                except (TypeError, ValueError):
+                    pass
+        return
+
+    def snapshot(self, meta=None):
+        """当前版本表的只读副本，供后台任务使用，见 Snapshot。
+        开销很小，不复制列数据"""
+
+        snap = Snapshot(self._df, self.revision, self.vieworder, meta)
+        self.snapshots = [(r, k) for r, k in self.snapshots if r() is not None]
+        self.snapshots.append((weakref.ref(snap.base), journal.frameKeys(snap.base)))
+        return snap
+
+    def isCurrent(self, snapshot):
+        """取快照后没有任何改变时为 True"""
+
+        return snapshot.version == self.revision
+
+    def detachColumns(self, cols):
+        """就地写入前复制这些位置上仍被快照或撤销记录共享的列"""
+
+        self.snapshots = [(r, k) for r, k in self.snapshots if r() is not None]
+        shared = self.journal.keys()
+        for r, keys in self.snapshots:
+            shared.update(keys)
+        if len(shared) == 0:
+            return
+        df = self._df
+        for j in cols:
+            if journal.arrayKey(df.iloc[:, j]) in shared:
+                df.isetitem(j, df.iloc[:, j].copy())
+        return
+
+    def addUndo(self, entry):
+        """记录如何撤销即将进行的操作"""
+
+        j = self.journal
+        j.levels = int(UNDOLEVELS)
+        j.budget = float(UNDOMEMORY) * 1048576
+        j.push(entry, self._df)
+        return
+
     def flags(self, index):
 
         return QtCore.Qt.ItemIsEnabled | QtCore.Qt.ItemIsSelectable | QtCore.Qt.ItemIsEditable
 
-    def sort(self, idx, ascending=True):
-        """按给定列号排序表格"""
+    def sortOrder(self, cols, ascending=True, cancelled=None, progress_callback=None,
+                  df=None):
+        """按给定位置的列排序后表的行，第一列优先，一次稳定的 lexsort。
+        缺失值排在最后。可以在工作线程中对快照的表运行，取消时返回 None"""
+
+        if df is None:
+            df = self._df
+        keys = []
+        for k, j in enumerate(cols):
+            if cancelled is not None and cancelled():
+                return
+            if progress_callback is not None:
+                progress_callback.emit('%s/%s' %(k+1, len(cols)))
+            keys.append(sortKey(df.iloc[:, j], ascending))
+        if cancelled is not None and cancelled():
+            return
+        return np.lexsort(keys[::-1])
+
+    def updateRowMap(self):
+        """把排序顺序和过滤的行合并为视图顺序"""
+
+        if self.roworder is None:
+            self.vieworder = self.rowsubset
+        elif self.rowsubset is None:
+            self.vieworder = self.roworder
+        else:
+            keep = np.zeros(len(self._df), dtype=bool)
+            keep[self.rowsubset] = True
+            self.vieworder = self.roworder[keep[self.roworder]]
+        return
+
+    def setOrder(self, order):
+        """按给定的全部行的顺序显示表的行，None 为表自身的顺序。
+        不复制表，视图行通过该顺序映射，见 baseRows。
+        返回显示的每行原来的视图位置"""
 
         self.layoutAboutToBeChanged.emit()
-        col = self.df.columns[idx]
-        self.df = self.df.sort_values(col, ascending=ascending)
+        old = self.vieworder
+        if order is not None:
+            order = np.asarray(order, dtype=np.int64)
+        self.roworder = order
+        self.updateRowMap()
+        #old view position of each row in the new order, for highlights
+        new = self.vieworder
+        if new is None:
+            new = np.arange(len(self._df))
+        if old is None:
+            moved = new
+        else:
+            inverse = np.empty(len(self._df), dtype=np.int64)
+            inverse[old] = np.arange(len(old))
+            moved = inverse[new]
+        self.revision += 1
+        self.cache.clear()
+        self.highlights.permuteRows(moved)
         self.layoutChanged.emit()
+        return moved
+
+    def showRows(self, rows=None):
+        """只显示表的给定行，按当前排序顺序。不复制任何数据，
+        行以位置保存。None 显示全部行"""
+
+        if rows is not None:
+            rows = np.unique(np.asarray(rows, dtype=np.int64))
+        self.rowsubset = rows
+        self.updateRowMap()
+        self.revision += 1
+        self.cache.clear()
+        self.highlights.clear()
         return
 
+    def sort(self, idx, ascending=True):
+        """按给定列号排序表格，idx 可以是多个列号"""
+
+        if not isinstance(idx, (list, tuple)):
+            idx = [idx]
+        return self.setOrder(self.sortOrder(idx, ascending))
+
 class SubTableWidget(DataFrameWidget):
     """子表控件"""
     def __init__(self, parent=None, dataframe=None, **args):
@@ -25,13 +25,14 @@ import os, types, io
 import traceback
 import string, copy
 from collections import OrderedDict
+import numpy as np
 import pandas as pd
 try:
     import configparser
 except:
     import ConfigParser as configparser
 from .qt import *
-from . import util, core
+from . import util, core, search, filters, jobs, readers
 
 module_path = os.path.dirname(os.path.abspath(__file__))
 iconpath = os.path.join(module_path, 'icons')
@@ -368,6 +369,19 @@ class ProgressWidget(QDialog):
 
         return
 
+threadpool = None
+
+def getThreadPool():
+    """Thread pool for background jobs. Qt uses the global pool itself,
+    e.g. for image conversion, and waits on it while holding the GIL so
+    long Python jobs there can freeze the GUI."""
+
+    global threadpool
+    if threadpool is None:
+        threadpool = QtCore.QThreadPool()
+        threadpool.setMaxThreadCount(max(4, QtCore.QThread.idealThreadCount()))
+    return threadpool
+
 #https://www.learnpyqt.com/courses/concurrent-execution/multithreading-pyqt-applications-qthreadpool/
 class Worker(QtCore.QRunnable):
     """Worker thread for running background tasks."""
@@ -498,6 +512,14 @@ class ImportDialog(QDialog):
         self.parent = parent
         self.filename = filename
         self.df = None
+        self.dtypes = None
+        #the head of the file is read once, previews parse this buffer
+        try:
+            self.head = readers.headBytes(filename)
+        except Exception as e:
+            print (e)
+            self.head = b''
+        self.estimates = {}
         self.setGeometry(QtCore.QRect(250, 250, 900, 600))
         self.setGeometry(
                 QStyle.alignedRect(
@@ -508,6 +530,7 @@ class ImportDialog(QDialog):
                 ))
         self.setWindowTitle('导入文件')
         self.createWidgets()
+        setWidgetValues(self.widgets, readers.sniff(self.head))
         self.update()
         self.show()
         return
@@ -516,21 +539,26 @@ class ImportDialog(QDialog):
         """创建控件"""
 
         delimiters = [',',r'\t',' ','\s+',';','/','&','|','^','+','-']
-        encodings = ['utf-8','ascii','latin-1','iso8859_15','cp037','cp1252','big5','euc_jp',
+        encodings = ['utf-8','utf-8-sig','utf-16','gb18030','ascii','latin-1','iso8859_15','cp037','cp1252','big5','euc_jp',
                      'koi8_r','mac_latin2','utf_32']
-        engines = ['python','c','pyarrow']
+        engines = ['auto','python','c','pyarrow']
         timeformats = ['infer','%d/%m/%Y','%Y/%m/%d','%Y/%d/%m',
                         '%Y-%m-%d %H:%M:%S','%Y-%m-%d %H:%M',
                         '%d-%m-%Y %H:%M:%S','%d-%m-%Y %H:%M']
-        grps = {'formats':['sep','decimal','comment'],
+        grps = {'formats':['sep','quotechar','header','decimal','comment'],
                 'data':['skiprows','skipinitialspace',
-                        'skip_blank_lines','parse_dates','encoding','engine','time format'],
+                        'skip_blank_lines','parse_dates','encoding','engine','arrowstrings',
+                        'time format'],
                 'other':['rowsperfile']}
         grps = OrderedDict(sorted(grps.items()))
         opts = self.opts = {'sep':{'type':'combobox','default':',','editable':True,
                 'items':delimiters, 'tooltip':'分隔符'},
                      #'header':{'type':'entry','default':0,'label':'header',
                      #          'tooltip':'position of column header'},
+                     'quotechar':{'type':'combobox','default':'"','items':['"',"'"],
+                                'label':'引号','tooltip':'引号字符'},
+                     'header':{'type':'checkbox','default':1,'label':'首行为列名',
+                                'tooltip':'第一行是列名'},
                      'decimal':{'type':'combobox','default':'.','items':['.',','],
                                 'tooltip':'小数点符号'},
                      'comment':{'type':'entry','default':'#','label':'注释',
@@ -547,8 +575,10 @@ class ImportDialog(QDialog):
                                 'tooltip':'日期/时间格式'},
                      'encoding':{'type':'combobox','default':'utf-8','items':encodings,
                                 'tooltip':'文件编码'},
-                     'engine':{'type':'combobox','default':'python','items':engines,
-                                'tooltip':'导入引擎'},
+                     'engine':{'type':'combobox','default':'auto','items':engines,
+                                'tooltip':'导入引擎，auto 按选项选择最快的引擎'},
+                     'arrowstrings':{'type':'checkbox','default':0,'label':'Arrow 文本列',
+                                'tooltip':'文本列以 Arrow 字符串保存，占用内存少得多'},
                      'rowsperfile':{'type':'spinbox','default':0,'label':'每文件行数',
                                 'tooltip':'读取的行数'},
                      }
@@ -592,6 +622,8 @@ class ImportDialog(QDialog):
         button = QPushButton("取消")
         button.clicked.connect(self.quit)
         vbox.addWidget(button)
+        self.enginelabel = QLabel(bw)
+        vbox.addWidget(self.enginelabel)
         return bw
 
     def showText(self, encoding='utf-8'):
@@ -599,10 +631,8 @@ class ImportDialog(QDialog):
 
         self.textarea.clear()
         try:
-            file = open(self.filename, 'r', encoding=encoding)
-            for i in range(100):
-                 line = file.readline()
-                 self.textarea.insertPlainText(line)
+            lines = self.head.decode(encoding).splitlines(True)
+            self.textarea.insertPlainText(''.join(lines[:100]))
             self.textarea.verticalScrollBar().setValue(1)
         except Exception as e:
             print(e)
@@ -628,21 +658,30 @@ class ImportDialog(QDialog):
         for k in self.values:
             if self.values[k] == '':
                 self.values[k] = None
+        self.values['header'] = 0 if self.values['header'] else None
+        kwargs = dict(self.values)
+        del kwargs['arrowstrings']
+        parsedates = kwargs.pop('parse_dates')
+        engine, kwargs = readers.chooseEngine(self.filename, kwargs, self.head)
+        self.showEstimate(engine, kwargs)
+        if engine == 'pyarrow':
+            #nrows is not supported by the pyarrow parser
+            kwargs['engine'] = 'c'
         try:
-            f = pd.read_csv(self.filename, chunksize=400, on_bad_lines='skip',
-                            date_parser=dateparse, **self.values)
-        except Exception as e:
-            print ('read csv error')
-            print (e)
-            return
-        try:
-            df = f.get_chunk()
+            df = pd.read_csv(io.BytesIO(self.head), nrows=400, on_bad_lines='skip',
+                             date_parser=dateparse, **kwargs)
+            if parsedates:
+                readers.sniffDates(df)
         except UnicodeDecodeError:
             print ('unicode error')
             df = pd.DataFrame()
         except pd.errors.ParserError:
             print ('parser error')
             df = pd.DataFrame()
+        except Exception as e:
+            print ('read csv error')
+            print (e)
+            return
 
         self.previewtable.model.df = df
         self.previewtable.refresh()
@@ -653,26 +692,33 @@ class ImportDialog(QDialog):
         tdf['dtype'] = tdf.dtype.astype(str)
         self.typestable.model.df = tdf
         self.typestable.refresh()
-        items = ['int64','float64','object']
+        items = ['int64','float64','object','datetime64[ns]']
         self.typestable.setItemDelegateForColumn(1,ComboDelegate(self.typestable, items))
         self.typestable.setEditTriggers(QAbstractItemView.CurrentChanged)
         return
 
+    def showEstimate(self, engine, kwargs):
+        """Show the engine chosen and the load time estimated from parsing
+        the head of the file, estimates are kept for each set of options"""
+
+        text = '引擎: %s' %engine
+        key = repr(sorted(kwargs.items()))
+        if key not in self.estimates:
+            self.estimates[key] = readers.estimateTime(self.filename, kwargs, self.head)
+        seconds = self.estimates[key]
+        if seconds is not None:
+            text += '\n预计用时: %.1f 秒' %seconds
+        self.enginelabel.setText(text)
+        return
+
     def doImport(self):
-        """Do the import"""
+        """Accept the options. The file is read in chunks in the background
+        with the column types of the preview, see readers.readCSV."""
 
-        #self.update()
-        #get types if changed?
+        #types may have been changed in the types table
         tf = self.typestable.model.df
-        dtypes = dict(zip(tf.name, tf.dtype))
-        #print (dtypes)
-        #dtmap = {'int32':int32,'float32':float64}
-        #for i in dtypes:
-        #    dtypes[i] = dtmap[i]
-        try:
-            self.df = pd.read_csv(self.filename, dtype=dtypes, **self.values)
-        except:
-            self.df = pd.read_csv(self.filename)
+        if 'name' in tf.columns:
+            self.dtypes = dict(zip(tf.name, tf.dtype))
         self.close()
         return
 
@@ -684,6 +730,142 @@ class ImportDialog(QDialog):
         self.close()
         return
 
+class ParquetDialog(QDialog):
+    """Dialog listing the schema and row groups of a Parquet file to pick
+    the columns and row filters used when reading it"""
+
+    def __init__(self, parent=None, filename=None):
+
+        super(ParquetDialog, self).__init__(parent)
+        self.parent = parent
+        self.filename = filename
+        self.columns = None
+        self.filters = []
+        self.accepted = False
+        self.schema, self.groups = readers.parquetInfo(filename)
+        self.setWindowTitle('导入 Parquet: %s' %os.path.basename(filename))
+        self.resize(800, 500)
+        self.createWidgets()
+        self.show()
+        return
+
+    def createWidgets(self):
+        """创建控件"""
+
+        layout = QHBoxLayout(self)
+        left = QWidget(self)
+        vbox = QVBoxLayout(left)
+        vbox.addWidget(QLabel('列'))
+        w = self.columnlist = QListWidget(left)
+        w.setSelectionMode(QAbstractItemView.ExtendedSelection)
+        for name, t in self.schema.values:
+            w.addItem('%s (%s)' %(name, t))
+        w.selectAll()
+        vbox.addWidget(w)
+        layout.addWidget(left)
+
+        right = QWidget(self)
+        vbox = QVBoxLayout(right)
+        vbox.addWidget(QLabel('行组: %s 行' %self.groups.rows.sum()))
+        t = self.groupstable = core.DataFrameTable(right, self.groups, font=core.FONT)
+        vbox.addWidget(t)
+        vbox.addWidget(QLabel('行过滤'))
+        names = [''] + list(self.schema.name)
+        self.filterwidgets = []
+        for i in range(3):
+            fw = QWidget(right)
+            hbox = QHBoxLayout(fw)
+            hbox.setContentsMargins(0,0,0,0)
+            col = QComboBox(fw)
+            col.addItems(names)
+            hbox.addWidget(col)
+            op = QComboBox(fw)
+            op.addItems(readers.PARQUETOPS)
+            hbox.addWidget(op)
+            value = QLineEdit(fw)
+            value.setToolTip('in 和 not in 的多个值用逗号分隔')
+            hbox.addWidget(value)
+            vbox.addWidget(fw)
+            self.filterwidgets.append((col, op, value))
+        buttonbox = QDialogButtonBox(right)
+        buttonbox.setStandardButtons(QDialogButtonBox.Cancel|QDialogButtonBox.Ok)
+        buttonbox.button(QDialogButtonBox.Ok).setText('导入')
+        buttonbox.button(QDialogButtonBox.Ok).clicked.connect(self.accept)
+        buttonbox.button(QDialogButtonBox.Cancel).clicked.connect(self.close)
+        vbox.addWidget(buttonbox)
+        layout.addWidget(right)
+        return
+
+    def accept(self):
+        """Keep the selected columns and filters"""
+
+        rows = sorted([self.columnlist.row(i) for i in self.columnlist.selectedItems()])
+        if len(rows) < len(self.schema):
+            self.columns = list(self.schema.name.iloc[rows])
+        self.filters = [(col.currentText(), op.currentText(), value.text())
+                        for col, op, value in self.filterwidgets
+                        if col.currentText() != '']
+        self.accepted = True
+        self.close()
+        return
+
+class ExcelDialog(QDialog):
+    """列出工作簿的工作表及其大小，选择要导入的工作表"""
+
+    def __init__(self, parent=None, filename=None):
+
+        super(ExcelDialog, self).__init__(parent)
+        self.parent = parent
+        self.filename = filename
+        self.sheets = []
+        self.accepted = False
+        self.info, self.error = readers.excelSheets(filename)
+        self.setWindowTitle('导入 Excel: %s' %os.path.basename(filename))
+        self.resize(450, 400)
+        self.createWidgets()
+        self.show()
+        return
+
+    def createWidgets(self):
+        """创建控件"""
+
+        vbox = QVBoxLayout(self)
+        t = self.sheetstable = QTableWidget(len(self.info), 3, self)
+        t.setHorizontalHeaderLabels(['工作表','行','列'])
+        t.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        t.verticalHeader().setVisible(False)
+        t.horizontalHeader().setStretchLastSection(True)
+        for i, (name, rows, cols) in enumerate(self.info):
+            item = QTableWidgetItem(name)
+            item.setFlags(item.flags() | QtCore.Qt.ItemIsUserCheckable)
+            item.setCheckState(QtCore.Qt.Checked if i == 0 else QtCore.Qt.Unchecked)
+            t.setItem(i, 0, item)
+            for j, value in enumerate([rows, cols]):
+                t.setItem(i, j+1, QTableWidgetItem('' if value is None else str(value)))
+        vbox.addWidget(t)
+        if self.error is not None:
+            l = QLabel('无法读取工作表大小: %s' %self.error)
+            l.setWordWrap(True)
+            vbox.addWidget(l)
+        vbox.addWidget(QLabel('每个工作表导入为一个表单，多个工作表并行读取'))
+        buttonbox = QDialogButtonBox(self)
+        buttonbox.setStandardButtons(QDialogButtonBox.Cancel|QDialogButtonBox.Ok)
+        buttonbox.button(QDialogButtonBox.Ok).setText('导入')
+        buttonbox.button(QDialogButtonBox.Ok).clicked.connect(self.accept)
+        buttonbox.button(QDialogButtonBox.Cancel).clicked.connect(self.close)
+        vbox.addWidget(buttonbox)
+        return
+
+    def accept(self):
+        """保留勾选的工作表"""
+
+        t = self.sheetstable
+        self.sheets = [self.info[i][0] for i in range(t.rowCount())
+                       if t.item(i, 0).checkState() == QtCore.Qt.Checked]
+        self.accepted = len(self.sheets) > 0
+        self.close()
+        return
+
 class ComboDelegate(QItemDelegate):
     """
     A delegate to add QComboBox in every cell of the given column
@@ -814,10 +996,19 @@ class BasicDialog(QDialog):
         """子类应重写以执行应用操作"""
         return
 
+    def runJob(self, name, fn, *args, **kwargs):
+        """在后台计算结果表，完成后显示在对话框的表格中"""
+
+        def done(res):
+            self.table.model.df = res
+            self.table.refresh()
+        error = lambda e: showMessage(self, str(e))
+        return self.table.runJob(name, fn, args, kwargs, done=done, error=error)
+
     def copy_to_subtable(self):
         """Do the operation"""
 
-        df = self.table.model.df
+        df = self.table.model.viewFrame()
         self.parent.showSubTable(df)
         return
 
@@ -829,20 +1020,20 @@ class BasicDialog(QDialog):
         name, ok = QInputDialog().getText(self, "输入工作表名称",
                              "名称：", QLineEdit.Normal)
         if ok and name:
-            self.app.addSheet(name=name, df=self.table.model.df)
+            self.app.addSheet(name=name, df=self.table.model.viewFrame())
         return
 
     def copy_to_clipboard(self):
         """Copy result to clipboard"""
 
-        df = self.table.model.df
+        df = self.table.model.viewFrame()
         df.to_clipboard()
         return
 
     def export(self):
         """export result to file"""
 
-        df = self.table.model.df
+        df = self.table.model.viewFrame()
         options = QFileDialog.Options()
         filename, _ = QFileDialog.getSaveFileName(self,"Export File",
                              "","CSV files (*.csv);;",
@@ -915,9 +1106,9 @@ class AggregateDialog(BasicDialog):
         for a in aggcols:
             aggdict[a] = funcs
 
-        res = self.df.groupby(grpcols).agg(aggdict).reset_index()
-        self.table.model.df = res
-        self.table.refresh()
+        def aggregate(df):
+            return df.groupby(grpcols).agg(aggdict).reset_index()
+        self.runJob('分组汇总', aggregate, self.df)
         return
 
 class PivotDialog(BasicDialog):
@@ -970,16 +1161,16 @@ class PivotDialog(BasicDialog):
         vals =[i.text() for i in self.valuesw.selectedItems()]
         idx = [i.text() for i in self.idxw.selectedItems()]
         aggfuncs = [i.text() for i in self.aggw.selectedItems()]
-        res = pd.pivot_table(self.df, index=idx, columns=cols, values=vals, aggfunc=aggfuncs)
-        names = res.index.names
-        #res = res.reset_index(col_level=2)
-        #print (res)
-        if util.check_multiindex(res.columns) == 1:
-            l = res.columns.nlevels
-            res.columns = res.columns.get_level_values(l-1)
-
-        self.table.model.df = res
-        self.table.refresh()
+        def pivot(df):
+            res = pd.pivot_table(df, index=idx, columns=cols, values=vals, aggfunc=aggfuncs)
+            names = res.index.names
+            #res = res.reset_index(col_level=2)
+            #print (res)
+            if util.check_multiindex(res.columns) == 1:
+                l = res.columns.nlevels
+                res.columns = res.columns.get_level_values(l-1)
+            return res
+        self.runJob('透视', pivot, self.df)
         return
 
 class MeltDialog(BasicDialog):
@@ -1026,10 +1217,7 @@ class MeltDialog(BasicDialog):
         idvars = [i.text() for i in self.idvarsw.selectedItems()]
         value_vars =[i.text() for i in self.valuevarsw .selectedItems()]
         varname = self.varnamew.text()
-        res = pd.melt(self.df, idvars, value_vars, varname)
-
-        self.table.model.df = res
-        self.table.refresh()
+        self.runJob('展开', pd.melt, self.df, idvars, value_vars, varname)
         return
 
 class MergeDialog(BasicDialog):
@@ -1126,21 +1314,16 @@ class MergeDialog(BasicDialog):
         how = self.how_w.currentText()
         op = self.ops_w.currentText()
         if op == 'merge':
-            try:
-                res = pd.merge(self.df, self.df2,
-                                left_on=lefton,
-                                right_on=righton,
-                                left_index=left_index,
-                                right_index=right_index,
-                                how=how,
-                                suffixes=(self.left_suffw .text(),self.right_suffw.text())
-                                )
-            except Exception as e:
-                showMessage(self, str(e))
+            self.runJob('合并', pd.merge, self.df, self.df2,
+                            left_on=lefton,
+                            right_on=righton,
+                            left_index=left_index,
+                            right_index=right_index,
+                            how=how,
+                            suffixes=(self.left_suffw .text(),self.right_suffw.text())
+                            )
         else:
-            res = pd.concat([self.df, self.df2])
-        self.table.model.df = res
-        self.table.refresh()
+            self.runJob('连接', pd.concat, [self.df, self.df2])
         return
 
 class ConvertTypesDialog(BasicDialog):
@@ -1276,10 +1459,10 @@ class ManageColumnsDialog(BasicDialog):
 
     def delete(self):
 
-        self.table.storeCurrent()
         names = [i.text() for i in self.cols_w.selectedItems()]
+        self.table.storeColumns(names)
         df = self.table.model.df
-        self.table.model.df = df.drop(columns=names)
+        self.table.model.updateFrame(df.drop(columns=names))
         self.table.refresh()
         self.update()
         return
@@ -1288,7 +1471,7 @@ class ManageColumnsDialog(BasicDialog):
 
         df=self.table.model.df
         cols = df.columns
-        self.table.model.df = df[sorted(cols)]
+        self.table.model.updateFrame(df[sorted(cols)])
         self.update()
         self.table.refresh()
         return
@@ -1301,7 +1484,7 @@ class ManageColumnsDialog(BasicDialog):
         cols = df.columns
         if len(df.columns) == len(set(df.columns)) is True:
             return
-        self.table.model.df = df.rename(columns=Renamer())
+        self.table.model.updateFrame(df.rename(columns=Renamer()))
         self.table.refresh()
         self.update()
         return
@@ -1383,6 +1566,13 @@ class PreferencesDialog(QDialog):
                 'PRECISION':{'type':'spinbox','default':options['PRECISION'], 'range':(0,10),
                         'interval':1,'label':'精度'},
                 'SHOWPLOTTER': {'type':'checkbox','default':bool(options['SHOWPLOTTER']), 'label':'显示绘图'},
+                'SEARCHINDEX': {'type':'checkbox','default':bool(options['SEARCHINDEX']), 'label':'大表建立搜索索引'},
+                'BITMAPINDEX': {'type':'checkbox','default':bool(options['BITMAPINDEX']), 'label':'取值较少的列建立位图索引'},
+                'UNDOLEVELS':{'type':'spinbox','default':options['UNDOLEVELS'],'range':(1,1000),
+                        'interval':1,'label':'撤销步数'},
+                'UNDOMEMORY':{'type':'spinbox','default':options['UNDOMEMORY'],'range':(0,100000),
+                        'interval':100,'label':'撤销内存上限 (MB)'},
+                'OPTIMIZETYPES': {'type':'checkbox','default':bool(options['OPTIMIZETYPES']), 'label':'导入后优化内存'},
                 'PLOTSTYLE':{'type':'combobox','default':options['PLOTSTYLE'],
                         'items':plotstyles,'label':'绘图样式'},
                 'DPI':{'type':'entry','default':options['DPI'],#'range':(20,300),'interval':10,
@@ -1392,7 +1582,8 @@ class PreferencesDialog(QDialog):
                     'label': '默认主题'}
                 }
         sections = {'table':['ALIGNMENT','FONT','FONTSIZE',
-                        'TIMEFORMAT','PRECISION','BGCOLOR'],
+                        'TIMEFORMAT','PRECISION','BGCOLOR','SEARCHINDEX','BITMAPINDEX',
+                        'UNDOLEVELS','UNDOMEMORY','OPTIMIZETYPES'],
                     'view':['ICONSIZE','PLOTSTYLE','DPI','THEME','SHOWPLOTTER']
                     }
 
@@ -1430,6 +1621,11 @@ class PreferencesDialog(QDialog):
         core.TIMEFORMAT = kwds['TIMEFORMAT']
         core.PRECISION = kwds['PRECISION']
         core.SHOWPLOTTER = kwds['SHOWPLOTTER']
+        core.SEARCHINDEX = kwds['SEARCHINDEX']
+        core.BITMAPINDEX = kwds['BITMAPINDEX']
+        core.UNDOLEVELS = kwds['UNDOLEVELS']
+        core.UNDOMEMORY = kwds['UNDOMEMORY']
+        core.OPTIMIZETYPES = kwds['OPTIMIZETYPES']
         core.PLOTSTYLE = kwds['PLOTSTYLE']
         core.DPI = kwds['DPI']
         core.ICONSIZE = kwds['ICONSIZE']
@@ -1475,6 +1671,12 @@ class FindReplaceDialog(QWidget):
         self.resize(400,200)
         self.case = True
         self.current = 0 #coords of found cells
+        self.coords = []
+        self.search_changed = True
+        self.searching = False
+        self.shownext = False
+        self.engine = search.SearchEngine()
+        self.threadpool = getThreadPool()
         self.createWidgets()
         self.setMaximumHeight(180)
         return
@@ -1490,6 +1692,7 @@ class FindReplaceDialog(QWidget):
         self.layout.addWidget(QLabel('查询内容'))
         self.layout.addWidget(self.query_w )
         self.query_w.returnPressed.connect(self.findAll)
+        self.query_w.textChanged.connect(self.queryChanged)
         self.replace_w = QLineEdit()
         self.layout.addWidget(QLabel('替换为'))
         self.layout.addWidget(self.replace_w )
@@ -1515,24 +1718,38 @@ class FindReplaceDialog(QWidget):
         """查找所有匹配项"""
 
         self.find()
-        self.table.refresh()
+        return
+
+    def queryChanged(self, text):
+        """Stop a running search when the query is edited"""
+
+        self.engine.cancel()
+        self.searching = False
+        self.search_changed = True
         return
 
     def findNext(self):
-        """Show next cell of search results"""
+        """Show next cell of search results, the first hit is shown as soon
+        as a running search finds it"""
 
-        table = self.table
-        s = self.query_w.text()
-        if len(self.coords)==0  or self.search_changed == True:
+        if self.search_changed == True or (len(self.coords)==0 and not self.searching):
             self.find()
         if len(self.coords)==0:
+            self.shownext = self.searching
             return
+        self.showNext()
+        return
+
+    def showNext(self):
+        """Select the current search result and move to the next one"""
+
+        table = self.table
         idx = self.current
         i,j = self.coords[idx]
+        table.model.fetchTo(i)
         index = table.model.index(i,j)
         #table.scrollTo(index, QAbstractItemView.EnsureVisible)
         table.selectRow(i)
-        table.refresh()
         self.current+=1
         if self.current>=len(self.coords):
             self.current=0
@@ -1542,37 +1759,55 @@ class FindReplaceDialog(QWidget):
 
         sender = self.sender()
         self.case = sender.isChecked()
+        self.search_changed = True
         return
 
     def find(self):
-        """Do string search. Creates a masked dataframe for results and then stores each cell
-        coordinate in a list."""
+        """Start a string search in a worker thread. Hits arrive in batches
+        in row order and are added to the 'search' highlight layer and the
+        list of cell coordinates."""
 
         table = self.table
         df = table.model.df
-        df = df.astype('object').astype('str')
         s = self.query_w.text()
-        self.search_changed = False
         self.clear()
+        self.search_changed = False
+        self.current = 0
         if s == '':
             return
-        found = pd.DataFrame()
-        for col in df:
-            found[col] = df[col].str.contains(s, na=False, case=self.case)
-        #set the masked dataframe so that highlighted cells are shown on redraw
-        table.model.highlighted = found
-        i=0
-        self.coords = []
-        for r,row in found.iterrows():
-            j=0
-            for col,val in row.iteritems():
-                if val is True:
-                    #print (r,col,val, i, j)
-                    self.coords.append((i,j))
-                j+=1
-            i+=1
-        self.current = 0
-        #print (self.coords)
+        generation = self.engine.start()
+        index = table.model.getSearchIndex(df)
+        #index is built in the background for the next search
+        table.buildSearchIndex()
+        worker = Worker(self.engine.search, df, s, self.case, generation, index,
+                        table.model.vieworder)
+        worker.signals.progress.connect(self.addResults)
+        worker.signals.finished.connect(lambda: self.searchDone(generation))
+        self.searching = True
+        self.threadpool.start(worker)
+        return
+
+    def addResults(self, n=None):
+        """Take new batches of hits from the search engine"""
+
+        model = self.table.model
+        for rows, cols in self.engine.take():
+            model.highlights.addCells('search', rows, cols, color='lightblue')
+            self.coords.extend(zip(rows.tolist(), cols.tolist()))
+            model.updateCells(range(rows[0], rows[-1]+1), sorted(set(cols.tolist())),
+                              roles=[QtCore.Qt.BackgroundRole])
+        if self.shownext == True and len(self.coords)>0:
+            self.shownext = False
+            self.showNext()
+        return
+
+    def searchDone(self, generation):
+
+        if generation != self.engine.generation:
+            return
+        self.addResults()
+        self.searching = False
+        self.shownext = False
         return
 
     def replace(self):
@@ -1584,15 +1819,18 @@ class FindReplaceDialog(QWidget):
         s=self.query_w.text()
         r=self.replace_w.text()
         case = self.case
-        table.model.df = df.replace(s,r,regex=True)
-        table.refresh()
+        table.model.updateFrame(df.replace(s,r,regex=True))
+        table.model.updateCells()
         self.search_changed = True
         return
 
     def clear(self):
 
-        self.table.model.highlighted = None
-        self.table.refresh()
+        self.engine.cancel()
+        self.searching = False
+        self.coords = []
+        self.table.model.highlights.removeLayer('search')
+        self.table.model.updateCells(roles=[QtCore.Qt.BackgroundRole])
 
     def onClose(self):
 
@@ -1610,9 +1848,20 @@ class FilterDialog(QWidget):
         self.app = app
         self.setWindowTitle(title)
         self.resize(400,200)
+        self.schemaversion = self.table.model.getSchema().version
         self.createWidgets()
         self.filters = []
         self.ignorecase = True
+        #clause masks reused between applies
+        self.masks = filters.MaskCache()
+        #live mode filters as the user types, see inputChanged
+        self.live = False
+        self.generation = 0
+        self.livetimer = QtCore.QTimer(self)
+        self.livetimer.setSingleShot(True)
+        self.livetimer.setInterval(300)
+        self.livetimer.timeout.connect(self.applyLive)
+        self.threadpool = getThreadPool()
         #self.setMinimumHeight(200)
         #self.show()
         return
@@ -1620,11 +1869,13 @@ class FilterDialog(QWidget):
     def createToolBar(self, parent):
 
         items = {'应用': {'action':self.apply,'file':'filter'},
+             '高亮': {'action':self.highlight,'file':'findall'},
              '添加': {'action':self.addFilter,'file':'add'},
              '重置': {'action':self.refresh,'file':'table-refresh'},
              '复制到新表': {'action':self.copyResult,'file':'subtable'},
              '减去': {'action':self.removeFiltered,'file':'table-remove'},
-             '忽略大小写': {'action':self.togglecase,'file':'lowercase','checkable':True}
+             '忽略大小写': {'action':self.togglecase,'file':'lowercase','checkable':True},
+             '实时过滤': {'action':self.toggleLive,'file':'table-filter','checkable':True}
              }
         toolbar = QToolBar("工具栏")
         toolbar.setOrientation(QtCore.Qt.Horizontal)
@@ -1634,16 +1885,22 @@ class FilterDialog(QWidget):
     def createWidgets(self):
         """创建小部件"""
 
-        df = self.table.model.df
-        cols = list(df.columns)
+        cols = self.table.model.getSchema().labels
         self.layout = QVBoxLayout(self)
         self.setLayout(self.layout)
         self.query_w = QLineEdit()
         self.layout.addWidget(QLabel('字符串过滤'))
         self.layout.addWidget(self.query_w )
         self.query_w.returnPressed.connect(self.apply)
+        self.query_w.textChanged.connect(self.inputChanged)
+        self.error_w = QLabel()
+        self.error_w.setStyleSheet('color: red')
+        self.error_w.setWordWrap(True)
+        self.error_w.hide()
+        self.layout.addWidget(self.error_w)
         w = self.column_w = QListWidget()
         w.setSelectionMode(QAbstractItemView.MultiSelection)
+        w.itemSelectionChanged.connect(self.inputChanged)
         #w.setFixedHeight(60)
         w.addItems(cols)
         self.layout.addWidget(QLabel('显示列'))
@@ -1657,25 +1914,164 @@ class FilterDialog(QWidget):
         """Reset the table"""
 
         table = self.table
-        if table.filtered == True and hasattr(table, 'dataframe'):
-            table.model.df = table.dataframe
-            table.filtered = False
-            table.refresh()
+        table.model.highlights.removeLayer('filter')
+        if table.filtered == True:
+            table.showAll()
+        else:
+            table.model.updateCells(roles=[QtCore.Qt.BackgroundRole])
         return
 
     def update(self):
         """Update the column widgets if table has changed"""
 
-        df = self.table.model.df
-        cols = list(df.columns)
+        schema = self.table.model.getSchema()
+        if self.schemaversion == schema.version:
+            return
+        self.schemaversion = schema.version
         self.column_w.clear()
-        self.column_w.addItems(cols)
+        self.column_w.addItems(schema.labels)
         return
 
     def togglecase(self):
 
         sender = self.sender()
         self.ignorecase = sender.isChecked()
+        self.inputChanged()
+        return
+
+    def toggleLive(self):
+        """Switch filtering as you type on or off"""
+
+        sender = self.sender()
+        self.live = sender.isChecked()
+        if self.live == True:
+            self.inputChanged()
+        else:
+            self.cancel()
+        return
+
+    def cancel(self):
+        """Stop a pending or running live filter"""
+
+        self.livetimer.stop()
+        self.generation += 1
+        return
+
+    def inputChanged(self, *args):
+        """Restart the debounce timer in live mode, a running evaluation
+        becomes stale and its result is dropped"""
+
+        if self.live == False:
+            return
+        self.generation += 1
+        self.livetimer.start()
+        return
+
+    def applyLive(self):
+        """Evaluate the filters on a worker thread. The plan, a snapshot of
+        the full table and the column versions are taken now, only the
+        result of the latest input is applied to the table."""
+
+        table = self.table
+        model = table.model
+        self.generation += 1
+        generation = self.generation
+        plan = self.compile()
+        if model.isMapped():
+            snap = None
+            df = None
+            index = None
+            versions = None
+        else:
+            snap = table.snapshot(source=True)
+            df = table.getSourceFrame()
+            index = model.getSearchIndex(df)
+            if index is not None:
+                #cell edits update the index in place
+                index = index.freeze()
+            versions = {c: model.columnVersion(c) for c in plan.columns(df.columns)}
+        worker = Worker(self.evaluate, plan, snap, df, index, versions, generation)
+        worker.signals.progress.connect(self.showCount)
+        worker.signals.result.connect(self.liveResult)
+        worker.signals.error.connect(lambda e: self.liveError(generation, e))
+        self.showCount(None)
+        self.threadpool.start(worker)
+        return
+
+    def evaluate(self, plan, snap, df, index, versions, generation, progress_callback=None):
+        """Compute the mask of a plan on a snapshot of the full frame df,
+        runs in a worker. Masks and column indexes are kept for df.
+        Returns None if a newer input arrived meanwhile."""
+
+        cancelled = lambda: generation != self.generation
+        if snap is None:
+            model = self.table.model
+            names = plan.columns(model.getSchema().names)
+            mask = None
+            if len(names) > 0:
+                mask = plan.evaluate(model.getColumns(names), cancelled=cancelled)
+        else:
+            #column indexes are built from the snapshot and kept for df
+            mask = plan.evaluate(snap.base, index, self.masks, versions.get, cancelled,
+                                 self.getIndexes(df, versions.get, snap.base), frame=df)
+        if cancelled():
+            return
+        if mask is not None and progress_callback is not None:
+            progress_callback.emit(str(np.count_nonzero(mask)))
+        return generation, df, versions, mask
+
+    def liveError(self, generation, error):
+        """Show why the live filter failed, e.g. a query that does not parse"""
+
+        if generation != self.generation:
+            return
+        parent = self.table.parent
+        if hasattr(parent, 'clearFilterCount'):
+            parent.clearFilterCount()
+        self.error_w.setText(str(error[1]))
+        self.error_w.show()
+        return
+
+    def showCount(self, count=None):
+        """Show the number of matching rows in the status bar"""
+
+        parent = self.table.parent
+        if not hasattr(parent, 'showFilterCount'):
+            return
+        model = self.table.model
+        if model.isMapped():
+            total = model.fileRows()
+        else:
+            total = len(self.table.getSourceFrame())
+        if count is not None:
+            count = int(count)
+        parent.showFilterCount(count, total)
+        return
+
+    def liveResult(self, result):
+        """Apply a live filter result if it is still current"""
+
+        if result is None:
+            return
+        generation, df, versions, mask = result
+        if generation != self.generation:
+            return
+        self.error_w.hide()
+        table = self.table
+        model = table.model
+        if df is None:
+            if not model.isMapped():
+                return
+            self.setRowFilter(mask)
+            return
+        if table.getSourceFrame() is not df:
+            self.inputChanged()
+            return
+        if any(model.columnVersion(c) != v for c, v in versions.items()):
+            #edited while evaluating
+            self.inputChanged()
+            return
+        self.showMask(df, mask)
         return
 
     def copyResult(self):
@@ -1683,7 +2079,7 @@ class FilterDialog(QWidget):
         table = self.table
         if table.filtered == False:
             return
-        df = table.model.df
+        df = table.model.viewFrame()
         self.app.addSheet(None, df)
         return
 
@@ -1696,95 +2092,142 @@ class FilterDialog(QWidget):
         self.filters.append(fb)
         return
 
+    def compile(self):
+        """Compile the query string and widget filters into a filter plan"""
+
+        clauses = []
+        for f in self.filters:
+            col, val, op, b = f.getFilter()
+            clauses.append(filters.Clause(col, op, val, b, not self.ignorecase))
+        return filters.FilterPlan(self.query_w.text(), clauses)
+
+    def getColumns(self, df):
+        """Positions of the columns selected for display, None for all"""
+
+        names = [i.text() for i in self.column_w.selectedItems()]
+        if len(names) == 0:
+            return
+        return [j for j, c in enumerate(df.columns) if str(c) in names]
+
     def apply(self):
         """Apply filters"""
 
         table = self.table
-        if table.filtered == True and hasattr(table, 'dataframe'):
-            table.model.df = table.dataframe
-        df = table.model.df
-        mask = None
+        if table.model.isMapped():
+            return self.applyMapped()
+        #the full frame is kept so its search index stays valid
+        self.cancel()
+        df = table.getSourceFrame()
+        index = table.model.getSearchIndex(df)
+        mask = self.getMask(df, index, cache=True)
+        self.showMask(df, mask)
+        if index is None:
+            table.buildSearchIndex(df)
+        return
 
-        s = self.query_w.text()
-        cols = [i.text() for i in self.column_w.selectedItems()]
-        if len(cols)>0:
-            df = df[cols]
-        if s!='':
-            try:
-                mask = df.eval(s)
-            except:
-                mask = df.eval(s, engine='python')
-
-        #add widget based filters
-        if len(self.filters)>0:
-            mask = self.applyWidgetFilters(df, mask)
-        #apply mask
+    def showMask(self, df, mask):
+        """Show the rows of the full frame df selected by mask"""
+
+        table = self.table
+        rows = None
         if mask is not None:
-            df = df[mask]
-        self.filtdf = df
-        table.dataframe = table.model.df.copy()
-        table.filtered = True
-        table.model.df = df
-        table.model.layoutChanged.emit()
-        table.refresh()
+            rows = np.flatnonzero(mask)
+        cols = self.getColumns(df)
+        if rows is None and cols is None:
+            table.showAll()
+        else:
+            table.filterRows(rows, cols)
+        return
+
+    def applyMapped(self):
+        """Apply filters to a memory mapped table as a row filter on the model"""
+
+        self.cancel()
+        self.setRowFilter(self.getMappedMask())
         return
 
-    def applyWidgetFilters(self, df, mask=None):
-        """Apply the widget based filters, returns a boolean mask"""
+    def setRowFilter(self, mask):
+        """Show the rows of a memory mapped table selected by mask"""
 
+        table = self.table
+        model = table.model
         if mask is None:
-            mask = df.index==df.index
+            model.setRowFilter(None)
+            table.filtered = False
+        else:
+            model.setRowFilter(np.flatnonzero(mask))
+            table.filtered = True
+        table.refresh()
+        return
 
-        for f in self.filters:
-            col, val, op, b = f.getFilter()
-            try:
-                val = float(val)
-            except:
-                pass
-            #print (col, val, op, b)
-            print (self.ignorecase)
-            if self.ignorecase == True:
-                strval = "(?i)"+str(val).lower()
-            else:
-                strval = str(val)
-
-            if op == 'contains':
-                m = df[col].astype(str).str.contains(strval)
-            elif op == 'equals':
-                m = df[col]==val
-            elif op == 'not equals':
-                m = df[col]!=val
-            elif op == '>':
-                m = df[col]>val
-            elif op == '<':
-                m = df[col]<val
-            elif op == 'is empty':
-                m = df[col].isnull()
-            elif op == 'not empty':
-                m = ~df[col].isnull()
-            elif op == 'excludes':
-                m = -df[col].str.contains(strval)
-            elif op == 'starts with':
-                m = df[col].str.startswith(strval)
-            elif op == 'ends with':
-                m = df[col].str.endswith(strval)
-            elif op == 'has length':
-                m = df[col].str.len()>val
-            elif op == 'is number':
-                m = df[col].astype('object').str.isnumeric()
-            elif op == 'is lowercase':
-                m = df[col].astype('object').str.islower()
-            elif op == 'is uppercase':
-                m = df[col].astype('object').str.isupper()
-            else:
-                continue
-            if b == 'AND':
-                mask = mask & m
-            elif b == 'OR':
-                mask = mask | m
-            elif b == 'NOT':
-                mask = mask ^ m
-        return mask
+    def getMask(self, df, index=None, cache=False):
+        """Boolean mask from the query and widget filters, None if there are none.
+        index is an optional search index for the rows of df. With cache,
+        masks of clauses whose columns did not change are reused."""
+
+        plan = self.compile()
+        if cache == False:
+            return plan.evaluate(df, index)
+        version = self.table.model.columnVersion
+        return plan.evaluate(df, index, self.masks, version,
+                             indexes=self.getIndexes(df, version))
+
+    def getIndexes(self, df, version, source=None):
+        """Column index getter for the full frame df, built from the
+        snapshot source when given"""
+
+        kinds = ['sorted']
+        if core.BITMAPINDEX == True:
+            kinds.append('bitmap')
+        return self.table.model.colindexes.getter(df, version, kinds, source)
+
+    def getValueCounts(self, col):
+        """Row counts of the values of a column in the full table, from the
+        bitmap index when the column has one"""
+
+        table = self.table
+        model = table.model
+        if model.isMapped():
+            values = model.getColumns([col])[col]
+        else:
+            df = table.getSourceFrame()
+            b = self.getIndexes(df, model.columnVersion)('bitmap', col)
+            if b is not None:
+                return b.valueCounts()
+            values = df[col]
+        return values.value_counts().head(1000)
+
+    def getMappedMask(self):
+        """Mask over the rows of a memory mapped file, only the columns used
+        by the query and widget filters are loaded"""
+
+        model = self.table.model
+        plan = self.compile()
+        names = plan.columns(model.getSchema().names)
+        if len(names) == 0:
+            return
+        return plan.evaluate(model.getColumns(names))
+
+    def highlight(self):
+        """Highlight matching rows in the current view instead of filtering"""
+
+        model = self.table.model
+        if model.isMapped():
+            mask = self.getMappedMask()
+            if mask is not None and model.rowmap is not None:
+                mask = mask[model.rowmap]
+        else:
+            mask = self.getMask(model.df, model.getSearchIndex(), cache=True)
+            if mask is not None:
+                #rows of the frame in view order
+                mask = mask[model.baseRows(slice(None))]
+        if mask is None:
+            model.highlights.removeLayer('filter')
+        else:
+            rows = np.flatnonzero(mask)
+            model.highlights.setLayer('filter', rows=rows, color='#ffe08a')
+        model.updateCells(roles=[QtCore.Qt.BackgroundRole])
+        return
 
     def removeFiltered(self):
         """Subtract current filtered result from original table"""
@@ -1797,12 +2240,28 @@ class FilterDialog(QWidget):
         table = self.table
         if table.filtered == False:
             return
-        idx = list(self.filtdf.index)
+        if table.model.isMapped():
+            model = table.model
+            keep = np.ones(model.fileRows(), dtype=bool)
+            keep[model.rowfilter] = False
+            model.setRowFilter(np.flatnonzero(keep))
+            table.refresh()
+            return
         df = table.dataframe
+        model = table.model
+        keep = np.ones(len(df), dtype=bool)
+        if table.filterrows is not None:
+            keep[table.filterrows] = False
+        order = model.roworder
         table.dataframe = None
         table.filtered = False
-        table.model.df = df.loc[~df.index.isin(idx)]
-        table.model.layoutChanged.emit()
+        table.filterrows = None
+        model.df = df[keep]
+        if order is not None and len(order) == len(df):
+            #the remaining rows keep their sort order
+            position = np.cumsum(keep) - 1
+            model.setOrder(position[order[keep[order]]])
+        model.layoutChanged.emit()
         table.refresh()
         return
 
@@ -1823,11 +2282,9 @@ class FilterBar(QWidget):
     def createWidgets(self):
         """创建小部件"""
 
-        operators = ['contains','excludes','equals','not equals','>','<','is empty','not empty',
-                     'starts with','ends with','has length','is number','is lowercase','is uppercase']
-        booleanops = ['AND','OR','NOT']
-        df = self.table.model.df
-        cols = list(df.columns)
+        operators = filters.OPERATORS
+        booleanops = filters.BOOLEANOPS
+        cols = self.table.model.getSchema().labels
         l = self.layout = QHBoxLayout(self)
         self.setLayout(self.layout)
         w = self.boolean_w = QComboBox()
@@ -1845,6 +2302,14 @@ class FilterBar(QWidget):
         self.term_w = QLineEdit()
         self.term_w.returnPressed.connect(self.parent.apply)
         l.addWidget(self.term_w )
+        btn = QPushButton('值')
+        btn.setToolTip('按取值选择')
+        btn.setMaximumWidth(30)
+        btn.clicked.connect(self.pickValues)
+        l.addWidget(btn)
+        self.term_w.textChanged.connect(self.parent.inputChanged)
+        for w in [self.boolean_w, self.column_w, self.operator_w]:
+            w.currentIndexChanged.connect(self.parent.inputChanged)
         icon = QIcon(os.path.join(iconpath,'remove.png'))
         btn = QPushButton()
         btn.setIcon(icon)
@@ -1862,6 +2327,73 @@ class FilterBar(QWidget):
         booleanop = self.boolean_w.currentText()
         return col, val, op, booleanop
 
+    def pickValues(self):
+        """从列的取值及行数中选择过滤值"""
+
+        col = self.column_w.currentText()
+        counts = self.parent.getValueCounts(col)
+        selected = []
+        if self.operator_w.currentText() in ['in','not in']:
+            selected = filters.splitValues(self.term_w.text())
+        dlg = FacetDialog(self, counts, selected, title=col)
+        dlg.exec_()
+        if dlg.values is None:
+            return
+        if self.operator_w.currentText() not in ['in','not in']:
+            self.operator_w.setCurrentText('in')
+        self.term_w.setText(', '.join(dlg.values))
+        return
+
     def onClose(self, ce):
         self.parent.filters.remove(self)
         self.close()
+        self.parent.inputChanged()
+
+class FacetDialog(QDialog):
+    """选择列取值的对话框，显示每个取值的行数"""
+    def __init__(self, parent, counts, selected=None, title='取值'):
+        super(FacetDialog, self).__init__(parent)
+        self.values = None
+        self.setWindowTitle(title)
+        self.resize(300, 400)
+        selected = selected or []
+        vbox = QVBoxLayout(self)
+        self.search_w = QLineEdit()
+        self.search_w.setPlaceholderText('查找')
+        self.search_w.textChanged.connect(self.updateList)
+        vbox.addWidget(self.search_w)
+        w = self.list_w = QListWidget()
+        for value, count in counts.items():
+            item = QListWidgetItem('{v}  ({c})'.format(v=value, c=count))
+            item.setData(QtCore.Qt.UserRole, str(value))
+            item.setFlags(item.flags() | QtCore.Qt.ItemIsUserCheckable)
+            if str(value) in selected:
+                item.setCheckState(QtCore.Qt.Checked)
+            else:
+                item.setCheckState(QtCore.Qt.Unchecked)
+            w.addItem(item)
+        vbox.addWidget(w)
+        buttonbox = QDialogButtonBox(self)
+        buttonbox.setStandardButtons(QDialogButtonBox.Cancel|QDialogButtonBox.Ok)
+        buttonbox.button(QDialogButtonBox.Ok).clicked.connect(self.accept)
+        buttonbox.button(QDialogButtonBox.Cancel).clicked.connect(self.close)
+        vbox.addWidget(buttonbox)
+        return
+
+    def updateList(self, text):
+        """只显示包含查找文本的取值"""
+
+        text = text.lower()
+        for i in range(self.list_w.count()):
+            item = self.list_w.item(i)
+            item.setHidden(text not in item.data(QtCore.Qt.UserRole).lower())
+        return
+
+    def accept(self):
+        self.values = []
+        for i in range(self.list_w.count()):
+            item = self.list_w.item(i)
+            if item.checkState() == QtCore.Qt.Checked:
+                self.values.append(item.data(QtCore.Qt.UserRole))
+        self.close()
+        return
@@ -0,0 +1,559 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    tablexplore 的过滤计划
+    创建于 2026 年 10 月
+    版权所有 (C) Damien Farrell
+
+    把查询字符串和各个过滤条件编译为一个计划。每个条件的布尔掩码按条件参数
+    和所读列的版本缓存，修改一个条件时只重新计算它自己的掩码。
+    数值比较在安装了 numexpr 时用 numexpr 计算。
+    取值较少的列可建立位图索引，相等、IN 列表和 NOT 条件直接由压缩的
+    行位图按位运算得到，同一索引也提供各取值的行数。
+    大表的数值、日期和文本列可建立排序索引，范围条件只需两次二分查找，
+    也用于跳转到给定值所在的行。
+"""
+
+from __future__ import absolute_import, division, print_function
+import threading
+import weakref
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from . import search
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+OPERATORS = ['contains','excludes','equals','not equals','in','not in','>','<','is empty','not empty',
+             'starts with','ends with','has length','is number','is lowercase','is uppercase']
+BOOLEANOPS = ['AND','OR','NOT']
+#operators that can be answered from a text search index
+TEXTOPS = ['contains','excludes','starts with','ends with','equals']
+COMPARE = {'equals':'==', 'not equals':'!=', '>':'>', '<':'<'}
+#operators answered from a bitmap index
+BITMAPOPS = ['equals','not equals','in','not in']
+#columns with more distinct values get no bitmap index
+MAXBITMAP = 64
+#range filters on smaller frames scan the column
+MINSORTED = 50000
+
+def isNumeric(dtype):
+    return isinstance(dtype, np.dtype) and dtype.kind in 'iufb'
+
+def splitValues(text, numeric=False):
+    """逗号分隔的 IN 列表的值，数值列转为数字"""
+
+    values = [v.strip() for v in text.split(',')]
+    if not numeric:
+        return values
+    nums = []
+    for v in values:
+        try:
+            nums.append(float(v))
+        except ValueError:
+            pass
+    return nums
+
+def toMask(m):
+    """由掩码得到普通布尔数组，缺失值为 False"""
+
+    if isinstance(m, Bitmap):
+        return m.toMask()
+    if isinstance(m, pd.Series):
+        if m.dtype != bool:
+            m = m.fillna(False)
+        m = m.to_numpy()
+    return np.asarray(m, dtype=bool)
+
+def compareNumbers(arr, op, val):
+    """把数值数组与一个数比较，有 numexpr 时使用它"""
+
+    expr = 'x %s v' %COMPARE[op]
+    if numexpr is not None and len(arr) > 100000:
+        return numexpr.evaluate(expr, local_dict={'x': arr, 'v': val})
+    if op == 'equals':
+        return arr == val
+    elif op == 'not equals':
+        return arr != val
+    elif op == '>':
+        return arr > val
+    return arr < val
+
+def combine(mask, m, op):
+    """以 AND、OR 或 NOT (异或) 合并两个掩码。位图以压缩形式合并，
+    None 表示全部行"""
+
+    if mask is None:
+        if op == 'AND':
+            return m
+        elif op == 'OR':
+            return np.ones(len(m), dtype=bool)
+        return ~m
+    if isinstance(mask, Bitmap) != isinstance(m, Bitmap):
+        mask, m = toMask(mask), toMask(m)
+    if op == 'AND':
+        return mask & m
+    elif op == 'OR':
+        return mask | m
+    elif op == 'NOT':
+        return mask ^ m
+    return mask
+
+class Bitmap(object):
+    """以压缩位数组表示的行集合，每字节 8 行"""
+    def __init__(self, bits, n):
+        self.bits = bits
+        self.n = n
+        return
+
+    @classmethod
+    def fromMask(cls, mask):
+        return cls(np.packbits(mask), len(mask))
+
+    @classmethod
+    def empty(cls, n):
+        return cls(np.zeros((n+7)//8, dtype=np.uint8), n)
+
+    def __len__(self):
+        return self.n
+
+    def __and__(self, other):
+        return Bitmap(self.bits & other.bits, self.n)
+
+    def __or__(self, other):
+        return Bitmap(self.bits | other.bits, self.n)
+
+    def __xor__(self, other):
+        return Bitmap(self.bits ^ other.bits, self.n)
+
+    def __invert__(self):
+        #bits past n are ignored when unpacking
+        return Bitmap(~self.bits, self.n)
+
+    def toMask(self):
+        return np.unpackbits(self.bits, count=self.n).astype(bool)
+
+    def count(self):
+        return int(np.count_nonzero(self.toMask()))
+
+class BitmapIndex(object):
+    """
+    低基数列每个不同取值的行位图，以及每个取值的行数。
+    """
+    def __init__(self, values, codes, uniques):
+        self.n = len(values)
+        self.numeric = isNumeric(values.dtype)
+        self.values = list(uniques)
+        self.lookup = {}
+        for k, v in enumerate(self.values):
+            self.lookup.setdefault(v, k)
+        self.counts = np.bincount(codes[codes >= 0], minlength=len(self.values))
+        self.bitmaps = [Bitmap.fromMask(codes == k) for k in range(len(self.values))]
+        return
+
+    @classmethod
+    def build(cls, values):
+        """列的索引，不同值太多时为 None"""
+
+        dtype = values.dtype
+        if isinstance(dtype, pd.DatetimeTZDtype) or (isinstance(dtype, np.dtype) and dtype.kind in 'mM'):
+            #dates compare equal to date strings, left to pandas
+            return
+        if values.iloc[:10000].nunique() > MAXBITMAP:
+            return
+        codes, uniques = pd.factorize(values)
+        if len(uniques) > MAXBITMAP:
+            return
+        return cls(values, codes, uniques)
+
+    def get(self, value):
+        """保存该值的行"""
+
+        k = self.lookup.get(value)
+        if k is None:
+            return Bitmap.empty(self.n)
+        return self.bitmaps[k]
+
+    def isin(self, values):
+        """保存任一给定值的行"""
+
+        b = Bitmap.empty(self.n)
+        for v in values:
+            b = b | self.get(v)
+        return b
+
+    def valueCounts(self):
+        """每个值的行数，从多到少"""
+
+        counts = pd.Series(self.counts, index=self.values)
+        return counts.sort_values(ascending=False)
+
+class SortedIndex(object):
+    """
+    按取值排序的列的行位置，不含缺失值，取值相同的行保持表格顺序。
+    """
+    def __init__(self, values):
+        arr = values.to_numpy()
+        rows = np.flatnonzero(values.notna().to_numpy())
+        self.order = rows[np.argsort(arr[rows], kind='stable')]
+        self.sorted = arr[self.order]
+        self.n = len(values)
+        dtype = values.dtype
+        self.kind = dtype.kind if dtype.kind in 'iufmM' else 'O'
+        return
+
+    @classmethod
+    def build(cls, values):
+        """数值、日期和文本列的索引，其他列为 None"""
+
+        dtype = values.dtype
+        if not isinstance(dtype, np.dtype):
+            return
+        if dtype.kind == 'O':
+            if pd.api.types.infer_dtype(values, skipna=True) != 'string':
+                return
+        elif dtype.kind not in 'iufmM':
+            return
+        return cls(values)
+
+    def key(self, text):
+        """把条件值转为可与列比较的值，不是该列类型时为 None"""
+
+        try:
+            if self.kind in 'iuf':
+                return float(text)
+            elif self.kind in 'mM':
+                if self.kind == 'm':
+                    return np.timedelta64(pd.Timedelta(text))
+                return np.datetime64(pd.Timestamp(text))
+        except (ValueError, TypeError):
+            return
+        try:
+            float(text)
+            #numbers are compared as numbers with text columns
+            return
+        except ValueError:
+            return text
+
+    def first(self, value):
+        """第一个不小于 value 的值在排序中的位置"""
+
+        return int(np.searchsorted(self.sorted, value, 'left'))
+
+    def greater(self, value):
+        return self.order[np.searchsorted(self.sorted, value, 'right'):]
+
+    def less(self, value):
+        return self.order[:np.searchsorted(self.sorted, value, 'left')]
+
+    def find(self, text):
+        """保存该值的行，没有则取下一个更大的值。没有这样的行或文本
+        不是该列类型的值时为 None"""
+
+        value = self.key(text)
+        if value is None:
+            return
+        i = self.first(value)
+        if i >= len(self.order):
+            return
+        return int(self.order[i])
+
+#builders for each kind of column index
+INDEXTYPES = {'bitmap': BitmapIndex.build, 'sorted': SortedIndex.build}
+
+class IndexCache(object):
+    """
+    最近使用的表格的列索引，首次使用时建立，列的版本改变前一直保留。
+    """
+    def __init__(self, frames=2):
+        self.size = frames
+        self.frames = OrderedDict()
+        self.lock = threading.Lock()
+        return
+
+    def clear(self):
+
+        with self.lock:
+            self.frames.clear()
+        return
+
+    def getIndexes(self, df):
+        """表的索引，调用时必须持有锁"""
+
+        key = id(df)
+        entry = self.frames.get(key)
+        if entry is None or entry[0]() is not df:
+            entry = self.frames[key] = (weakref.ref(df), {})
+            while len(self.frames) > self.size:
+                self.frames.popitem(last=False)
+        self.frames.move_to_end(key)
+        return entry[1]
+
+    def get(self, df, kind, name, version=None, source=None):
+        """列的给定种类的索引，列不适合时为 None。df 可能同时被编辑时，
+        source 为用来建立索引的 df 快照"""
+
+        key = (kind, name)
+        with self.lock:
+            indexes = self.getIndexes(df)
+            if key in indexes and indexes[key][0] == version:
+                return indexes[key][1]
+        values = (df if source is None else source)[name]
+        if not isinstance(values, pd.Series):
+            #duplicate column names
+            return
+        index = INDEXTYPES[kind](values)
+        with self.lock:
+            self.getIndexes(df)[key] = (version, index)
+        return index
+
+    def getter(self, df, version=None, kinds=(), source=None):
+        """对启用的种类，返回按列名取该种类索引的函数"""
+
+        def get(kind, name):
+            if kind not in kinds:
+                return
+            return self.get(df, kind, name, version(name) if version else None, source)
+        return get
+
+class Clause(object):
+    """单列上的一个控件过滤条件"""
+    def __init__(self, column, op, term, boolop='AND', case=True):
+        self.column = column
+        self.op = op
+        self.term = str(term)
+        self.boolop = boolop
+        self.case = case
+        return
+
+    def key(self):
+        return ('clause', self.column, self.op, self.term, self.case)
+
+    def columns(self):
+        return [self.column]
+
+    def evaluate(self, df, index=None, indexes=None):
+        """df 中匹配该条件的行的布尔数组或 Bitmap。
+        indexes(kind, column) 在启用时返回列索引"""
+
+        col, op, text = self.column, self.op, self.term
+        try:
+            val = float(text)
+        except:
+            val = text
+        b = None
+        if indexes is not None and op in BITMAPOPS:
+            b = indexes('bitmap', col)
+        if b is not None:
+            if op in ['equals','not equals']:
+                m = b.get(val)
+            else:
+                m = b.isin(splitValues(text, b.numeric))
+            if op in ['not equals','not in']:
+                m = ~m
+            return m
+        if self.case == False:
+            strval = "(?i)"+text.lower()
+        else:
+            strval = text
+        c = None
+        if index is not None and op in TEXTOPS and (op != 'equals' or type(val) is str):
+            c = index.getColumn(col)
+        if c is not None:
+            literal = search.isLiteral(text)
+            if op == 'equals':
+                rows = c.match(text, 'equals')
+            elif op == 'excludes':
+                rows = c.match(text, 'contains', self.case, literal)
+            else:
+                rows = c.match(text, op, self.case, literal)
+            m = np.zeros(len(df), dtype=bool)
+            m[rows] = True
+            if op == 'excludes':
+                m = ~m
+            return m
+        if indexes is not None and op in ['>','<'] and len(df) >= MINSORTED:
+            b = indexes('sorted', col)
+            value = None if b is None else b.key(text)
+            if value is not None:
+                m = np.zeros(len(df), dtype=bool)
+                if op == '>':
+                    m[b.greater(value)] = True
+                else:
+                    m[b.less(value)] = True
+                return m
+        s = df[col]
+        if op in COMPARE and type(val) is float and isinstance(s.dtype, np.dtype) \
+            and s.dtype.kind in 'iuf':
+            return compareNumbers(s.to_numpy(), op, val)
+        if op == 'contains':
+            m = s.astype(str).str.contains(strval)
+        elif op == 'equals':
+            m = s==val
+        elif op == 'not equals':
+            m = s!=val
+        elif op == 'in':
+            m = s.isin(splitValues(text, isNumeric(s.dtype)))
+        elif op == 'not in':
+            m = ~s.isin(splitValues(text, isNumeric(s.dtype)))
+        elif op == '>':
+            m = s>val
+        elif op == '<':
+            m = s<val
+        elif op == 'is empty':
+            m = s.isnull()
+        elif op == 'not empty':
+            m = ~s.isnull()
+        elif op == 'excludes':
+            m = ~s.astype(str).str.contains(strval)
+        elif op == 'starts with':
+            if self.case == False:
+                m = s.str.lower().str.startswith(text.lower())
+            else:
+                m = s.str.startswith(text)
+        elif op == 'ends with':
+            if self.case == False:
+                m = s.str.lower().str.endswith(text.lower())
+            else:
+                m = s.str.endswith(text)
+        elif op == 'has length':
+            m = s.str.len()>val
+        elif op == 'is number':
+            m = s.astype('object').str.isnumeric()
+        elif op == 'is lowercase':
+            m = s.astype('object').str.islower()
+        elif op == 'is uppercase':
+            m = s.astype('object').str.isupper()
+        else:
+            return
+        return toMask(m)
+
+class QueryClause(object):
+    """pandas 查询字符串，例如 'x > 1 & y < 2'"""
+    def __init__(self, query):
+        self.query = query
+        return
+
+    def key(self):
+        return ('query', self.query)
+
+    def columns(self, names=()):
+        """查询可能引用的列"""
+
+        return [c for c in names if str(c) in self.query]
+
+    def evaluate(self, df, index=None, indexes=None):
+
+        try:
+            m = df.eval(self.query)
+        except:
+            m = df.eval(self.query, engine='python')
+        return toMask(m)
+
+class MaskCache(object):
+    """
+    一个表格的条件掩码。掩码按条件键和条件读取的列的版本保存，编辑其他
+    列时仍然有效。其他表格的掩码被丢弃。
+    """
+    def __init__(self, size=32):
+        self.size = size
+        self.frame = None
+        self.masks = OrderedDict()
+        #masks may be computed in worker threads
+        self.lock = threading.Lock()
+        return
+
+    def clear(self):
+
+        with self.lock:
+            self.frame = None
+            self.masks.clear()
+        return
+
+    def get(self, df, key):
+
+        with self.lock:
+            if self.frame is None or self.frame() is not df:
+                self.frame = weakref.ref(df)
+                self.masks.clear()
+                return
+            m = self.masks.get(key)
+            if m is None or len(m) != len(df):
+                return
+            self.masks.move_to_end(key)
+            return m
+
+    def put(self, df, key, mask):
+
+        with self.lock:
+            if self.frame is None or self.frame() is not df:
+                return
+            self.masks[key] = mask
+            while len(self.masks) > self.size:
+                self.masks.popitem(last=False)
+        return
+
+class FilterPlan(object):
+    """
+    把过滤的查询字符串和控件条件编译为一个计划。查询掩码依次与每个条件
+    按 AND、OR 或 NOT（异或）组合。
+    """
+    def __init__(self, query='', clauses=None):
+        self.query = QueryClause(query) if query != '' else None
+        self.clauses = clauses or []
+        return
+
+    def isEmpty(self):
+        return self.query is None and len(self.clauses) == 0
+
+    def columns(self, names=()):
+        """过滤读取的列，名称为表的列"""
+
+        cols = [c.column for c in self.clauses]
+        if self.query is not None:
+            cols += self.query.columns(names)
+        return list(dict.fromkeys(cols))
+
+    def getClauseMask(self, clause, df, index=None, cache=None, version=None,
+                      indexes=None, frame=None):
+
+        if cache is None:
+            return clause.evaluate(df, index, indexes)
+        if frame is None:
+            frame = df
+        cols = clause.columns() if isinstance(clause, Clause) else clause.columns(df.columns)
+        key = clause.key()
+        if version is not None:
+            key = (key, tuple(version(c) for c in cols))
+        m = cache.get(frame, key)
+        if m is None:
+            m = clause.evaluate(df, index, indexes)
+            if m is not None:
+                cache.put(frame, key, m)
+        return m
+
+    def evaluate(self, df, index=None, cache=None, version=None, cancelled=None,
+                 indexes=None, frame=None):
+        """匹配行的布尔数组，过滤为空或已取消时为 None。version(column)
+        给出列的当前版本，与 cache 一起用于复用未改变条件的掩码。indexes 为
+        取列索引的函数，见 IndexCache.getter。df 为某表的快照时，frame 为
+        缓存掩码所对应的表"""
+
+        if self.isEmpty():
+            return
+        mask = None
+        if self.query is not None:
+            mask = self.getClauseMask(self.query, df, index, cache, version, frame=frame)
+        for c in self.clauses:
+            if cancelled is not None and cancelled():
+                return
+            m = self.getClauseMask(c, df, index, cache, version, indexes, frame)
+            if m is None:
+                continue
+            mask = combine(mask, m, c.boolop)
+        if mask is None:
+            return np.ones(len(df), dtype=bool)
+        return toMask(mask)
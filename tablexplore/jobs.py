@@ -0,0 +1,403 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    tablexplore 的后台任务管理
+    创建于 2026 年 10 月
+    版权所有 (C) Damien Farrell
+
+    耗时的表格操作作为任务提交给任务管理器，在后台线程池中运行。
+    同一表格的任务依次运行，前一个任务的结果写回表格后才开始下一个，
+    因此两个任务不会同时修改同一个表。任务结果在界面线程中交给完成
+    函数。任务可以报告进度，取消是协作式的：任务函数在步骤之间调用
+    checkCancelled，无法中断的任务在取消后丢弃结果。
+"""
+
+from __future__ import absolute_import, division, print_function
+import threading
+import time
+import traceback
+from .qt import *
+from . import dialogs
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+STATES = {QUEUED: '等待', RUNNING: '运行中', DONE: '完成', FAILED: '失败', CANCELLED: '已取消'}
+#finished jobs kept for the queue panel
+MAXFINISHED = 50
+
+local = threading.local()
+manager = None
+
+class Cancelled(Exception):
+    """在被取消的任务中抛出，见 checkCancelled"""
+    pass
+
+def current():
+    """在此线程中运行的任务，任务之外为 None"""
+
+    return getattr(local, 'job', None)
+
+def isCancelled():
+    """在此线程中运行的任务已取消时为 True"""
+
+    job = current()
+    return job is not None and job.cancelled
+
+def checkCancelled():
+    """在此线程中运行的任务已取消时抛出 Cancelled，耗时的任务函数在各步之间调用"""
+
+    if isCancelled():
+        raise Cancelled()
+    return
+
+def report(text, fraction=None):
+    """报告在此线程中运行的任务的进度，已知时 fraction 为完成的比例，
+    在 0 和 1 之间。任务已取消时抛出 Cancelled"""
+
+    checkCancelled()
+    job = current()
+    if job is not None:
+        job.report(text, fraction)
+    return
+
+def publish(data):
+    """把在此线程中运行的任务的部分结果交给 GUI 线程上的 partial 函数，
+    例如到目前为止读到的行"""
+
+    job = current()
+    if job is not None:
+        job.published.emit(data)
+    return
+
+class Job(QtCore.QObject):
+    """
+    在后台运行的函数。args 可以是返回参数的函数，在任务开始时于界面
+    线程中调用，因此任务能看到同一键的前面任务的结果；返回 None 时
+    丢弃任务。设置 progress 时任务作为 progress_callback 传给函数。
+    partial 接收任务运行中发布的数据。
+    """
+    progressed = Signal()
+    published = Signal(object)
+
+    def __init__(self, name, fn, args=(), kwargs=None, key=None, label='',
+                 done=None, error=None, widget=None, progress=False, partial=None):
+        super(Job, self).__init__()
+        self.name = name
+        self.fn = fn
+        self.args = args
+        self.kwargs = dict(kwargs or {})
+        if progress == True:
+            self.kwargs['progress_callback'] = self
+        self.key = key
+        self.label = label
+        self.done = done
+        self.error = error
+        self.partial = partial
+        self.widget = widget
+        self.state = QUEUED
+        self.cancelled = False
+        self.text = ''
+        self.fraction = None
+        self.message = ''
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        return
+
+    def cancel(self):
+        """请求任务停止，排队中的任务不再启动"""
+
+        self.cancelled = True
+        return
+
+    def report(self, text, fraction=None):
+
+        self.text = text
+        self.fraction = fraction
+        self.progressed.emit()
+        return
+
+    def emit(self, text):
+        """以文本报告进度，使任务可以作为 progress_callback 传入"""
+
+        self.report(text)
+        return
+
+    def elapsed(self):
+
+        if self.started is None:
+            return 0
+        end = self.finished or time.time()
+        return end - self.started
+
+    def isFinished(self):
+        return self.state in [DONE, FAILED, CANCELLED]
+
+    def run(self, progress_callback=None):
+        """在工作线程中运行函数"""
+
+        local.job = self
+        try:
+            checkCancelled()
+            return self.fn(*self.args, **self.kwargs)
+        except Cancelled:
+            return Cancelled
+        finally:
+            local.job = None
+
+class JobManager(QtCore.QObject):
+    """
+    在后台线程池中运行任务。相同键（通常是一个表单）的任务依次运行，
+    没有键的任务立即开始。结果在界面线程中传给任务的 done 函数，错误传给
+    它的 error 函数或显示在消息框中。
+    """
+    #emitted when jobs are added, started, finish or report progress
+    changed = Signal()
+
+    def __init__(self):
+        super(JobManager, self).__init__()
+        self.jobs = []
+        self.queues = {}
+        self.running = {}
+        return
+
+    def submit(self, name, fn, args=(), kwargs=None, key=None, label='',
+               done=None, error=None, widget=None, progress=False, partial=None):
+        """添加任务，返回 Job"""
+
+        job = Job(name, fn, args, kwargs, key, label, done, error, widget, progress, partial)
+        job.progressed.connect(lambda job=job: self.progress(job))
+        job.published.connect(lambda data, job=job: self.published(job, data))
+        self.jobs.append(job)
+        self.queues.setdefault(key, []).append(job)
+        self.schedule(key)
+        self.changed.emit()
+        return job
+
+    def schedule(self, key):
+        """该键没有运行中的任务时启动下一个排队的任务"""
+
+        queue = self.queues.get(key, [])
+        while len(queue) > 0:
+            if key is not None and key in self.running:
+                return
+            job = queue.pop(0)
+            if job.cancelled:
+                self.finish(job, CANCELLED)
+                continue
+            self.start(job)
+        self.queues.pop(key, None)
+        return
+
+    def start(self, job):
+
+        if callable(job.args):
+            try:
+                args = job.args()
+            except Exception as e:
+                job.message = str(e)
+                self.finish(job, FAILED)
+                self.showError(job)
+                return
+            if args is None:
+                self.finish(job, CANCELLED)
+                return
+            job.args = args
+        job.state = RUNNING
+        job.started = time.time()
+        if job.key is not None:
+            self.running[job.key] = job
+        if job.widget is not None and hasattr(job.widget, 'showProgress'):
+            job.widget.showProgress(job.name, job.cancel)
+        worker = dialogs.Worker(job.run)
+        worker.signals.result.connect(lambda result, job=job: self.result(job, result))
+        worker.signals.error.connect(lambda err, job=job: self.failed(job, err))
+        dialogs.getThreadPool().start(worker)
+        return
+
+    def progress(self, job):
+
+        if job.state == RUNNING and job.widget is not None and \
+            hasattr(job.widget, 'showProgress'):
+            text = job.name
+            if job.text != '':
+                text += ' ' + job.text
+            job.widget.showProgress(text, job.cancel)
+        self.changed.emit()
+        return
+
+    def published(self, job, data):
+
+        if job.state == RUNNING and not job.cancelled and job.partial is not None:
+            job.partial(data)
+        return
+
+    def result(self, job, result):
+
+        if job.cancelled or result is Cancelled:
+            self.finish(job, CANCELLED)
+            return
+        #the result is committed before the next job for the key starts
+        state = DONE
+        if job.done is not None:
+            try:
+                job.done(result)
+            except Exception as e:
+                traceback.print_exc()
+                state = FAILED
+                job.message = str(e)
+        self.finish(job, state)
+        if state == FAILED:
+            self.showError(job)
+        return
+
+    def failed(self, job, err):
+
+        exctype, value, trace = err
+        job.message = str(value)
+        error = job.error
+        self.finish(job, FAILED)
+        if job.cancelled:
+            return
+        if error is not None:
+            error(value)
+        else:
+            self.showError(job)
+        return
+
+    def finish(self, job, state):
+        """把任务标记为完成并启动该键的下一个任务"""
+
+        running = job.state == RUNNING
+        job.state = state
+        job.finished = time.time()
+        #finished jobs are kept for the panel, not their data
+        job.fn = job.done = job.error = job.partial = None
+        job.args = ()
+        job.kwargs = {}
+        if job.key is not None and self.running.get(job.key) is job:
+            del self.running[job.key]
+        if running and job.widget is not None and hasattr(job.widget, 'hideProgress'):
+            job.widget.hideProgress()
+        done = [j for j in self.jobs if j.isFinished()]
+        for j in done[:-MAXFINISHED]:
+            self.jobs.remove(j)
+        self.schedule(job.key)
+        self.changed.emit()
+        return
+
+    def showError(self, job):
+
+        parent = job.widget if isinstance(job.widget, QWidget) else None
+        QMessageBox.warning(parent, '任务失败', '%s: %s' %(job.name, job.message))
+        return
+
+    def cancel(self, key=None):
+        """取消所有任务，或给定键的任务"""
+
+        for job in self.jobs:
+            if not job.isFinished() and (key is None or job.key is key):
+                self.cancelJob(job)
+        return
+
+    def cancelJob(self, job):
+        """取消一个任务，排队中的任务从队列中移除"""
+
+        job.cancel()
+        queue = self.queues.get(job.key, [])
+        if job in queue:
+            queue.remove(job)
+            self.finish(job, CANCELLED)
+        self.changed.emit()
+        return
+
+    def waitForDone(self):
+        """阻塞直到所有任务完成，关闭时使用"""
+
+        pool = dialogs.getThreadPool()
+        while len([j for j in self.jobs if not j.isFinished()]) > 0:
+            pool.waitForDone(100)
+            QApplication.processEvents()
+        return
+
+    def isBusy(self, key):
+        """该键有运行中或排队的任务时为 True"""
+
+        return key in self.running or len(self.queues.get(key, [])) > 0
+
+    def clearFinished(self):
+
+        self.jobs = [j for j in self.jobs if not j.isFinished()]
+        self.changed.emit()
+        return
+
+def getManager():
+    """所有表单共享的任务管理器"""
+
+    global manager
+    if manager is None:
+        manager = JobManager()
+    return manager
+
+class JobsPanel(QWidget):
+    """任务队列面板，列出排队、运行中和最近的任务"""
+
+    def __init__(self, parent=None, manager=None):
+
+        super(JobsPanel, self).__init__(parent)
+        self.manager = manager or getManager()
+        layout = QVBoxLayout(self)
+        layout.setContentsMargins(2,2,2,2)
+        t = self.table = QTableWidget(0, 5, self)
+        t.setHorizontalHeaderLabels(['任务','表','状态','进度','用时'])
+        t.setSelectionBehavior(QAbstractItemView.SelectRows)
+        t.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        t.verticalHeader().setVisible(False)
+        t.horizontalHeader().setStretchLastSection(True)
+        layout.addWidget(t)
+        bw = QWidget(self)
+        hbox = QHBoxLayout(bw)
+        hbox.setContentsMargins(0,0,0,0)
+        button = QPushButton('取消所选')
+        button.clicked.connect(self.cancelSelected)
+        hbox.addWidget(button)
+        button = QPushButton('全部取消')
+        button.clicked.connect(lambda: self.manager.cancel())
+        hbox.addWidget(button)
+        button = QPushButton('清除已完成')
+        button.clicked.connect(self.manager.clearFinished)
+        hbox.addWidget(button)
+        layout.addWidget(bw)
+        self.manager.changed.connect(self.update)
+        self.update()
+        return
+
+    def update(self):
+        """显示当前的任务，最新的在前"""
+
+        jobs = self.jobs = list(reversed(self.manager.jobs))
+        t = self.table
+        t.setRowCount(len(jobs))
+        for i, job in enumerate(jobs):
+            progress = job.text
+            if job.fraction is not None:
+                progress = '%d%% %s' %(job.fraction*100, job.text)
+            if job.state == FAILED:
+                progress = job.message
+            values = [job.name, job.label, STATES[job.state], progress,
+                      '%.1fs' %job.elapsed()]
+            for j, value in enumerate(values):
+                t.setItem(i, j, QTableWidgetItem(value))
+        return
+
+    def cancelSelected(self):
+
+        rows = set([i.row() for i in self.table.selectionModel().selectedRows()])
+        for i in rows:
+            if i < len(self.jobs) and not self.jobs[i].isFinished():
+                self.manager.cancelJob(self.jobs[i])
+        return
@@ -0,0 +1,459 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    tablexplore 的撤销/重做日志
+    创建于 2026 年 10 月
+    版权所有 (C) Damien Farrell
+
+    每个修改表格的操作记录一条日志，只保存撤销该操作所需的旧数据：
+    被替换的列保存为旧列数组的引用，插入或删除的行保存为行位置数组
+    (删除时另存被删的行)，单元格编辑保存为稀疏补丁，排序保存为行的排列。
+    撤销一条记录时生成对应的重做记录。超出内存预算的旧记录写入临时
+    文件，撤销时再读回。
+"""
+
+from __future__ import absolute_import, division, print_function
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import weakref
+import numpy as np
+import pandas as pd
+
+def columnBytes(values):
+    """一个 series 占用的近似内存，object 列按部分值的样本估算"""
+
+    n = len(values)
+    if values.dtype == object and n > 1000:
+        sample = values.iloc[:1000]
+        return int(sample.memory_usage(index=False, deep=True) * n / len(sample))
+    return int(values.memory_usage(index=False, deep=True))
+
+def arrayKey(values):
+    """保存 series 值的数组的标识，共享数据的 series 相同"""
+
+    if isinstance(values.dtype, np.dtype):
+        arr = values.values
+        return (arr.__array_interface__['data'][0], arr.dtype.str, len(arr))
+    return id(values.array)
+
+def frameKeys(df):
+    """表所有列的数组标识"""
+
+    return set(arrayKey(df.iloc[:, j]) for j in range(len(df.columns)))
+
+def ownColumn(values):
+    """持有自己数据的 series。表的列通常是与其他列共享的块的视图，
+    保留这样的视图会使整个块无法释放，因此复制一份"""
+
+    if isinstance(values.dtype, np.dtype):
+        base = values.values.base
+        if base is not None and getattr(base, 'size', 0) > len(values):
+            return values.copy()
+    return values
+
+def restoreTypes(df, dtypes):
+    """把类型改变了的列转换回给定类型，例如添加了缺失值行后变成浮点的整数列"""
+
+    for j in range(min(len(df.columns), len(dtypes))):
+        if df.dtypes.iloc[j] != dtypes[j]:
+            try:
+                df.isetitem(j, df.iloc[:, j].astype(dtypes[j]))
+            except (TypeError, ValueError):
+                pass
+    return
+
+class Entry(object):
+    """
+    一个可撤销的操作，保存撤销它所需的旧状态。apply() 把模型恢复到该状态，
+    并返回重做该操作的记录。nrows 为操作后的行数，用于检查表格此后
+    没有被其他方式修改。
+    """
+    #attributes written to disk when the entry is spilled
+    state = []
+    #True if applying replaces the frame and the table must be reset
+    replaces = False
+
+    def __init__(self, nrows):
+        self.nrows = nrows
+        self.file = None
+        self.lock = threading.Lock()
+        self.discarded = False
+        #set while the entry is being written to disk
+        self.spilling = False
+        return
+
+    def held(self):
+        """记录保存的 series，用于估算其内存"""
+
+        return []
+
+    def size(self, keys=()):
+        """内存中保存的、不与给定数组标识的列共享的字节数"""
+
+        if self.file is not None:
+            return 0
+        return sum([columnBytes(s) for s in self.held() if arrayKey(s) not in keys])
+
+    def spill(self, path):
+        """把保存的状态写入文件夹 path 中的新文件并释放"""
+
+        with self.lock:
+            if self.file is not None or self.discarded:
+                return
+            #made here so a discarded entry leaves no file behind
+            fd, filename = tempfile.mkstemp(suffix='.pkl', dir=path)
+            os.close(fd)
+            data = dict([(a, getattr(self, a)) for a in self.state])
+            try:
+                with open(filename, 'wb') as f:
+                    pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+            except:
+                os.remove(filename)
+                raise
+            for a in self.state:
+                setattr(self, a, None)
+            self.file = filename
+            self.spilling = False
+        return
+
+    def load(self):
+        """状态已写入文件时读回"""
+
+        with self.lock:
+            if self.file is None:
+                return
+            with open(self.file, 'rb') as f:
+                data = pickle.load(f)
+            for a in data:
+                setattr(self, a, data[a])
+            os.remove(self.file)
+            self.file = None
+        return
+
+    def discard(self):
+        """丢弃记录及其文件"""
+
+        with self.lock:
+            self.discarded = True
+            if self.file is not None and os.path.exists(self.file):
+                os.remove(self.file)
+            self.file = None
+        return
+
+    def check(self, model):
+
+        if model.totalRows() != self.nrows:
+            raise ValueError('table was changed since this operation')
+        return
+
+    def apply(self, model):
+        raise NotImplementedError
+
+class FrameEntry(Entry):
+    """操作前的整个表格及其排序。保存浅复制，重命名或删除当前表的列
+    不影响它，列数据在操作替换之前是共享的。"""
+
+    state = ['df']
+    replaces = True
+
+    def __init__(self, df, order=None):
+        Entry.__init__(self, None)
+        self.df = df.copy(deep=False)
+        self.order = order
+        return
+
+    def held(self):
+        return [self.df.iloc[:, j] for j in range(len(self.df.columns))]
+
+    def check(self, model):
+        return
+
+    def apply(self, model):
+
+        self.load()
+        current = FrameEntry(model.df, model.roworder)
+        model.df = self.df
+        if self.order is not None:
+            model.setOrder(self.order)
+        return current
+
+class ColumnsEntry(Entry):
+    """操作替换或添加列之前的列。旧的列数组按引用保存，撤销时删除
+    操作添加的列。"""
+
+    state = ['columns']
+
+    def __init__(self, df, names):
+        Entry.__init__(self, len(df))
+        #column names in order before the operation
+        self.names = list(df.columns)
+        self.columns = {}
+        for name in names:
+            if name in self.columns or name not in df.columns:
+                continue
+            self.columns[name] = ownColumn(df[name])
+        return
+
+    def held(self):
+        return list(self.columns.values())
+
+    def apply(self, model):
+
+        self.load()
+        self.check(model)
+        df = model.df
+        added = [c for c in df.columns if c not in self.names]
+        inverse = ColumnsEntry(df, list(self.columns.keys()) + added)
+        if len(added) > 0:
+            pos = model.columnPositions(added)
+            df.drop(columns=added, inplace=True)
+            model.removedColumns(pos)
+        changed = []
+        for name in self.names:
+            if name not in self.columns:
+                continue
+            values = self.columns[name]
+            if name in df.columns:
+                #assign the array so the values are not aligned on the index
+                df[name] = values.array
+                changed.append(name)
+            else:
+                loc = min(self.names.index(name), len(df.columns))
+                df.insert(loc, name, values.array)
+                model.insertedColumns(loc)
+        if len(changed) > 0:
+            model.updateCells(cols=model.columnPositions(changed))
+        return inverse
+
+class CellsEntry(Entry):
+    """原地编辑前视图行和列位置上单元格值的稀疏补丁"""
+
+    state = ['values']
+
+    def __init__(self, model, rows, cols):
+        Entry.__init__(self, model.totalRows())
+        self.rows = np.asarray(rows, dtype=np.int64)
+        self.cols = list(cols)
+        self.values = model.getFrame(self.rows, self.cols)
+        return
+
+    def held(self):
+        return [self.values.iloc[:, k] for k in range(len(self.cols))]
+
+    def apply(self, model):
+
+        self.load()
+        self.check(model)
+        inverse = CellsEntry(model, self.rows, self.cols)
+        model.putValues(self.rows, self.cols, self.values)
+        model.updateCells(self.rows, self.cols)
+        return inverse
+
+class RowsEntry(Entry):
+    """在给定视图位置插入或删除的行。删除时保存被删的行以便放回，
+    插入时保存插入前的列类型。"""
+
+    state = ['removed']
+
+    def __init__(self, rows, nrows, removed=None, dtypes=None):
+        Entry.__init__(self, nrows)
+        self.rows = np.unique(np.asarray(rows, dtype=np.int64))
+        self.removed = removed
+        self.dtypes = dtypes
+        return
+
+    def held(self):
+        if self.removed is None:
+            return []
+        return [self.removed.iloc[:, k] for k in range(len(self.removed.columns))]
+
+    def apply(self, model):
+
+        self.load()
+        self.check(model)
+        rows = self.rows
+        nrows = model.totalRows()
+        if self.removed is None:
+            #undo an insert by removing the rows again
+            removed = model.getFrame(rows, range(len(model.df.columns)))
+            keep = np.ones(nrows, dtype=bool)
+            keep[rows] = False
+            new = model.viewFrame(np.flatnonzero(keep))
+            if self.dtypes is not None:
+                restoreTypes(new, self.dtypes)
+            model.df = new
+            model.removedRows(rows.tolist())
+            return RowsEntry(rows, nrows-len(rows), removed)
+        #put removed rows back at their view positions
+        n = nrows + len(rows)
+        keep = np.ones(n, dtype=bool)
+        keep[rows] = False
+        order = np.empty(n, dtype=np.int64)
+        order[keep] = np.arange(nrows)
+        order[rows] = nrows + np.arange(len(rows))
+        df = model.viewFrame()
+        dtypes = list(df.dtypes)
+        model.df = pd.concat([df, self.removed]).iloc[order]
+        if rows[-1] - rows[0] == len(rows) - 1:
+            model.insertedRows(int(rows[0]), len(rows))
+        else:
+            self.replaces = True
+        return RowsEntry(rows, n, dtypes=dtypes)
+
+class OrderEntry(Entry):
+    """一次排序，order 为排序前表格所有行的顺序，按表格顺序显示时为 None"""
+
+    state = []
+
+    def __init__(self, order, nrows):
+        Entry.__init__(self, nrows)
+        self.order = order
+        return
+
+    def size(self, keys=()):
+        if self.order is None:
+            return 0
+        return self.order.nbytes
+
+    def check(self, model):
+
+        #rows hidden by a filter keep their place in the order
+        if len(model.df) != self.nrows:
+            raise ValueError('table was changed since this operation')
+        return
+
+    def apply(self, model):
+
+        self.check(model)
+        inverse = OrderEntry(model.roworder, self.nrows)
+        model.setOrder(self.order)
+        return inverse
+
+class Journal(object):
+    """
+    一个表格的撤销和重做记录栈，最多保留 levels 条。记录占用的内存
+    合计超过 budget 字节时从最旧的开始写入磁盘，run 设为在工作线程中
+    运行函数的函数时在后台写入。
+    """
+    def __init__(self, levels=20, budget=500*1048576):
+        self.levels = levels
+        self.budget = budget
+        self.undos = []
+        self.redos = []
+        self.path = None
+        self.finalizer = None
+        self.run = None
+        return
+
+    def canUndo(self):
+        return len(self.undos) > 0
+
+    def canRedo(self):
+        return len(self.redos) > 0
+
+    def push(self, entry, df=None):
+        """为即将对表 df 进行的操作添加记录"""
+
+        for e in self.redos:
+            e.discard()
+        self.redos = []
+        self.undos.append(entry)
+        while len(self.undos) > max(self.levels, 1):
+            self.undos.pop(0).discard()
+        if df is not None:
+            #the new entry still shares its data with df
+            self.enforce(df, self.undos[:-1])
+        return
+
+    def undo(self, model):
+        """撤销模型的上一个操作，返回应用的记录，没有可撤销的操作时返回 None"""
+
+        if len(self.undos) == 0:
+            return
+        entry = self.undos.pop()
+        try:
+            inverse = entry.apply(model)
+        except:
+            self.clear()
+            raise
+        entry.discard()
+        self.redos.append(inverse)
+        self.enforce(model.df, self.undos + self.redos)
+        return entry
+
+    def redo(self, model):
+        """重做上一个撤销的操作，返回应用的记录"""
+
+        if len(self.redos) == 0:
+            return
+        entry = self.redos.pop()
+        try:
+            inverse = entry.apply(model)
+        except:
+            self.clear()
+            raise
+        entry.discard()
+        self.undos.append(inverse)
+        self.enforce(model.df, self.undos + self.redos)
+        return entry
+
+    def keys(self):
+        """记录在内存中保存的列的数组键，这些数组不能就地修改"""
+
+        keys = set()
+        for e in self.undos + self.redos:
+            #wait for a spill in progress, it still reads the arrays
+            with e.lock:
+                if e.file is None:
+                    keys.update([arrayKey(v) for v in e.held()])
+        return keys
+
+    def enforce(self, df, entries):
+        """把给定记录中最旧的写入文件，直到它们在 df 的列之外保存的内存不超过预算"""
+
+        keys = frameKeys(df)
+        total = 0
+        for entry in reversed(entries):
+            if entry.file is not None or entry.spilling:
+                continue
+            total += entry.size(keys)
+            if total > self.budget and len(entry.state) > 0:
+                self.spill(entry)
+        return
+
+    def spill(self, entry):
+
+        if self.path is None:
+            self.path = tempfile.mkdtemp(prefix='tablexplore-undo')
+            #remove the files when the journal goes away
+            self.finalizer = weakref.finalize(self, shutil.rmtree, self.path, True)
+        path = self.path
+        entry.spilling = True
+        if self.run is None:
+            entry.spill(path)
+        else:
+            self.run(lambda: entry.spill(path))
+        return
+
+    def clear(self):
+        """丢弃所有记录"""
+
+        for e in self.undos + self.redos:
+            e.discard()
+        self.undos = []
+        self.redos = []
+        return
+
+    def close(self):
+        """丢弃所有记录并删除临时文件夹"""
+
+        self.clear()
+        if self.finalizer is not None:
+            self.finalizer()
+            self.finalizer = None
+            self.path = None
+        return
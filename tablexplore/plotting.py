@@ -11,6 +11,7 @@
 
 from __future__ import absolute_import, division, print_function
 import sys,os,random,platform
+import weakref
 from collections import OrderedDict
 
 import matplotlib as mpl
@@ -38,6 +39,9 @@ settingspath = os.path.join(homepath, '.config','tablexplore')
 cmapsfile = os.path.join(settingspath, 'cmaps.pkl')
 
 colormaps = sorted(m for m in plt.cm.datad if not m.endswith("_r"))
+#schema and version that last filled each column combo box, weak on both
+#so closed sheets and deleted widgets are not kept
+filledschemas = weakref.WeakKeyDictionary()
 markers = ['','o','.','^','v','>','<','s','+','x','p','d','h','*']
 linestyles = ['-','--','-.',':']
 plotkinds = ['line', 'bar', 'barh', 'scatter', 'pie', 'histogram', 'boxplot', 'violinplot', 'dotplot',
@@ -380,8 +384,8 @@ class PlotViewer(QWidget):
 
         if self.table is None:
             return
-        df = self.table.model.df
-        self.opts['general'].update(df)
+        schema = self.table.model.getSchema()
+        self.opts['general'].update(schema)
         #self.opts['series'].update(df)
         return
 
@@ -1528,19 +1532,25 @@ class MPLBaseOptions(BaseOptions):
         self.setDefaults()
         return
 
-    def update(self, df):
-        """当 DataFrame 更改时更新数据控件"""
+    def update(self, schema):
+        """当列结构更改时更新数据控件"""
 
-        if util.check_multiindex(df.columns) == 1:
-            cols = list(df.columns.get_level_values(0))
+        #widgets are shared between sheets so remember which schema and
+        #version filled them
+        by = self.widgets['by']
+        filled = filledschemas.get(by)
+        if filled is not None and filled[0]() is schema and filled[1] == schema.version:
+            return
+        if schema.multiindex == True:
+            cols = [str(c[0]) for c in schema.names]
         else:
-            cols = list(df.columns)
+            cols = schema.labels
         #add empty value
-        cols = [str(c) for c in cols]
         cols = ['']+cols
         for name in ['by','by2','labelcol','clrcol']:
             self.widgets[name].clear()
             self.widgets[name].addItems(cols)
+        filledschemas[by] = (weakref.ref(schema), schema.version)
         return
 
 class FormatOptions(BaseOptions):
@@ -24,8 +24,9 @@ import sys,os,platform,time,traceback
 import pickle, gzip, random
 from collections import OrderedDict
 from tablexplore.qt import *
+import numpy as np
 import pandas as pd
-from tablexplore import util, core, dialogs
+from tablexplore import util, core, dialogs, search
 from tablexplore.plugin import Plugin
 import pylab as plt
 
@@ -78,6 +79,9 @@ class ExamplePlugin(Plugin):
         button = QPushButton("生成测试数据")
         button.clicked.connect(self.tableTests)
         vbox.addWidget(button)
+        button = QPushButton("搜索测试")
+        button.clicked.connect(self.searchTests)
+        vbox.addWidget(button)
         button = QPushButton("调色板演示")
         button.clicked.connect(self.colorMapDemo)
         vbox.addWidget(button)
@@ -141,6 +145,28 @@ class ExamplePlugin(Plugin):
         self.table.refresh()
         return
 
+    def searchTests(self):
+        """测试跨多个行块的搜索，按表格顺序和排序后、扫描和索引都应找到
+        所有匹配的行"""
+
+        n = 500000
+        pos = np.arange(n)
+        df = pd.DataFrame({'a': np.where(pos % 1000 == 0, 'hit', 'x').astype(object)})
+        order = pos[::-1].copy()
+        engine = search.SearchEngine(chunksize=200000)
+        index = engine.buildIndex(df, engine.start())
+        results = []
+        for name, idx, o in [('扫描', None, None), ('索引', index, None),
+                             ('排序扫描', None, order), ('排序索引', index, order)]:
+            engine.search(df, 'hit', generation=engine.start(), index=idx, order=o)
+            rows = np.concatenate([r for r, c in engine.take()])
+            shown = pos if o is None else o
+            expected = np.flatnonzero(shown % 1000 == 0)
+            ok = np.array_equal(rows, expected)
+            results.append('%s: %d/%d %s' %(name, len(rows), len(expected), '通过' if ok else '失败'))
+        QMessageBox.information(self.main, '搜索测试', '\n'.join(results))
+        return
+
     def quit(self, evt=None):
         """重写以处理面板关闭"""
 
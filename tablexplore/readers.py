@@ -0,0 +1,999 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    tablexplore 的分块文件导入
+    创建于 2026 年 10 月
+    版权所有 (C) Damien Farrell
+
+    大文件在后台任务中分块读取，每块追加到按列增长的缓冲区中，不反复
+    拼接表格。已读的行随时可以取出为表格用于显示，数值列不复制。
+    预览得到的列类型用于所有块，后面的块不再推断类型；某块与这些类型
+    不符时从头改为逐块推断，并在需要时放宽列的类型。
+"""
+
+from __future__ import absolute_import, division, print_function
+import io
+import os
+import bz2
+import gzip
+import lzma
+import time
+import numpy as np
+import pandas as pd
+from . import jobs
+
+#rows read per chunk
+CHUNKROWS = 100000
+#seconds between showing the rows read so far
+PUBLISHINTERVAL = 1.0
+#files read at the same time by a multi-file import
+FILEWORKERS = max(2, min(8, os.cpu_count() or 1))
+#bytes parsed to choose the engine and estimate the load time
+SAMPLEBYTES = 1048576
+#read_csv options the pyarrow parser does not support when set
+ARROWUNSUPPORTED = ['skipinitialspace','skiprows','comment','thousands','skipfooter',
+                    'nrows','converters','date_parser','on_bad_lines','delim_whitespace']
+#compressions the pyarrow engine streams, others are read with c
+ARROWSTREAMS = [None, 'gzip', 'bz2', 'xz']
+#bytes of the file in each record batch read by pyarrow
+ARROWBLOCKBYTES = 4*1048576
+COMPRESSION = {'.gz': 'gzip', '.bz2': 'bz2', '.zip': 'zip', '.xz': 'xz', '.zst': 'zstd'}
+
+def formatBytes(n):
+    """字节数的简短文本"""
+
+    for unit in ['B','KB','MB','GB']:
+        if abs(n) < 1024 or unit == 'GB':
+            break
+        n /= 1024.0
+    if unit == 'B':
+        return '%d B' %n
+    return '%.1f %s' %(n, unit)
+
+def commonType(a, b):
+    """能容纳两种 numpy 类型取值的类型，与 concat 的结果相同：
+    数值类型取较宽的一种，其他组合为 object"""
+
+    if a == b:
+        return a
+    if a.kind in 'iuf' and b.kind in 'iuf':
+        return np.result_type(a, b)
+    if a.kind == 'M' and b.kind == 'M':
+        return np.result_type(a, b)
+    return np.dtype(object)
+
+class ColumnBuffer(object):
+    """
+    可增长的单列数组。数据块复制到末尾，满时容量增加一半。view()
+    不复制地返回已有的值，之后的追加不会改变它们。
+    """
+    def __init__(self, dtype, capacity=0):
+        self.data = np.empty(capacity, dtype=dtype)
+        self.n = 0
+        return
+
+    def reserve(self, capacity):
+        """预留总共 capacity 个值的空间"""
+
+        if capacity <= len(self.data):
+            return
+        new = np.empty(capacity, dtype=self.data.dtype)
+        new[:self.n] = self.data[:self.n]
+        self.data = new
+        return
+
+    def append(self, values):
+        """追加一个序列，需要时放宽缓冲区的类型"""
+
+        values = values.to_numpy()
+        dtype = self.data.dtype
+        if values.dtype != dtype:
+            common = commonType(dtype, values.dtype)
+            if common != dtype:
+                self.data = self.data.astype(common)
+            values = values.astype(common)
+        end = self.n + len(values)
+        if end > len(self.data):
+            self.reserve(max(end, int(len(self.data)*1.5)))
+        self.data[self.n:end] = values
+        self.n = end
+        return
+
+    def view(self):
+        return self.data[:self.n]
+
+    def trim(self):
+        """释放末尾未用的空间"""
+
+        if len(self.data) > self.n * 1.05 + 16:
+            self.data = self.data[:self.n].copy()
+        return
+
+class ExtensionBuffer(object):
+    """分类等 pandas 扩展类型的列，按块保存为列表，取出时再合并"""
+
+    def __init__(self):
+        self.chunks = []
+        self.n = 0
+        return
+
+    def reserve(self, capacity):
+        return
+
+    def append(self, values):
+        self.chunks.append(values.reset_index(drop=True))
+        self.n += len(values)
+        return
+
+    def view(self):
+        if len(self.chunks) > 1:
+            self.chunks = [pd.concat(self.chunks, ignore_index=True)]
+        if len(self.chunks) == 0:
+            return np.empty(0, dtype=object)
+        return self.chunks[0].array
+
+    def trim(self):
+        return
+
+class FrameBuffer(object):
+    """
+    按列追加的表格数据块。frame() 以范围索引的 DataFrame 返回已有的行，
+    numpy 列是缓冲区的视图，不复制。
+    """
+    def __init__(self):
+        self.columns = None
+        self.buffers = []
+        self.n = 0
+        return
+
+    def append(self, chunk):
+
+        if self.columns is None:
+            self.columns = list(chunk.columns)
+            for j in range(len(self.columns)):
+                dtype = chunk.dtypes.iloc[j]
+                if isinstance(dtype, np.dtype):
+                    self.buffers.append(ColumnBuffer(dtype, len(chunk)))
+                else:
+                    self.buffers.append(ExtensionBuffer())
+        for j, b in enumerate(self.buffers):
+            b.append(chunk.iloc[:, j])
+        self.n += len(chunk)
+        return
+
+    def reserve(self, rows):
+        """按预计的行数预先分配缓冲区"""
+
+        for b in self.buffers:
+            b.reserve(rows)
+        return
+
+    def frame(self):
+
+        if self.columns is None:
+            return pd.DataFrame()
+        data = dict([(j, b.view()) for j, b in enumerate(self.buffers)])
+        #not copied or consolidated, each column stays a view of its buffer
+        df = pd.DataFrame(data, index=pd.RangeIndex(self.n), copy=False)
+        df.columns = self.columns
+        return df
+
+    def trim(self):
+        for b in self.buffers:
+            b.trim()
+        return
+
+def csvTypes(dtypes):
+    """由预览的列类型得到 read_csv 的列类型，日期列单独返回，按日期解析"""
+
+    types = {}
+    dates = []
+    for name, dtype in dtypes.items():
+        if dtype is None or str(dtype) in ['', 'None']:
+            continue
+        if str(dtype).startswith('datetime64'):
+            dates.append(name)
+        else:
+            types[name] = dtype
+    return types, dates
+
+def relaxTypes(types):
+    """后面的块有缺失值或小数时也能读取的类型：整数列读为 float，
+    布尔列读为 object"""
+
+    relaxed = {}
+    for name, dtype in types.items():
+        try:
+            kind = np.dtype(dtype).kind
+        except TypeError:
+            #pandas types such as category
+            kind = None
+        if kind in ['i', 'u']:
+            relaxed[name] = 'float64'
+        elif kind == 'b':
+            relaxed[name] = 'object'
+        else:
+            relaxed[name] = dtype
+    return relaxed
+
+def hasPyarrow():
+
+    try:
+        import pyarrow.csv
+    except ImportError:
+        return False
+    return True
+
+def sampleBytes(filename, size=SAMPLEBYTES):
+    """文件开头 size 字节，截到最后一个完整行，压缩文件返回 None"""
+
+    if os.path.splitext(filename)[1].lower() in COMPRESSION:
+        return None
+    with open(filename, 'rb') as f:
+        data = f.read(size)
+    if len(data) == size:
+        end = data.rfind(b'\n')
+        if end > 0:
+            data = data[:end+1]
+    return data
+
+def headBytes(filename, size=SAMPLEBYTES):
+    """文件内容开头 size 字节，截到最后一个完整行，压缩文件先解压"""
+
+    compression = COMPRESSION.get(os.path.splitext(filename)[1].lower())
+    if compression is None:
+        return sampleBytes(filename, size)
+    if compression == 'gzip':
+        import gzip
+        f = gzip.open(filename, 'rb')
+    elif compression == 'bz2':
+        import bz2
+        f = bz2.open(filename, 'rb')
+    elif compression == 'xz':
+        import lzma
+        f = lzma.open(filename, 'rb')
+    elif compression == 'zip':
+        import zipfile
+        z = zipfile.ZipFile(filename)
+        f = z.open(z.namelist()[0])
+    else:
+        import zstandard
+        f = zstandard.open(filename, 'rb')
+    with f:
+        data = f.read(size)
+    if len(data) == size:
+        end = data.rfind(b'\n')
+        if end > 0:
+            data = data[:end+1]
+    return data
+
+def sniffEncoding(data):
+    """由字节顺序标记判断编码，否则取 utf-8、gb18030、cp1252 中
+    第一个能解码的"""
+
+    boms = [(b'\xff\xfe\x00\x00', 'utf_32'), (b'\x00\x00\xfe\xff', 'utf_32'),
+            (b'\xef\xbb\xbf', 'utf-8-sig'), (b'\xff\xfe', 'utf-16'), (b'\xfe\xff', 'utf-16')]
+    for bom, encoding in boms:
+        if data.startswith(bom):
+            return encoding
+    #the sample may end inside a character
+    end = data.rfind(b'\n') + 1 or len(data)
+    for encoding in ['utf-8', 'gb18030', 'cp1252']:
+        try:
+            data[:end].decode(encoding)
+            return encoding
+        except UnicodeDecodeError:
+            pass
+    return 'latin-1'
+
+def sniff(data, lines=50):
+    """
+    由文件开头的字节推测 read_csv 选项：编码、分隔符、引号字符、
+    首行是否为表头以及小数点。只返回能推测出的选项。
+    """
+
+    import csv, re
+    opts = {}
+    if not data:
+        return opts
+    encoding = opts['encoding'] = sniffEncoding(data)
+    text = data.decode(encoding, 'replace')
+    head = '\n'.join(text.splitlines()[:lines])
+    sniffer = csv.Sniffer()
+    try:
+        dialect = sniffer.sniff(head, delimiters=',\t;| ')
+        opts['sep'] = r'\t' if dialect.delimiter == '\t' else dialect.delimiter
+        opts['quotechar'] = dialect.quotechar
+    except csv.Error:
+        pass
+    try:
+        opts['header'] = sniffer.has_header(head)
+    except csv.Error:
+        pass
+    if opts.get('sep', ',') != ',':
+        commas = len(re.findall(r'\d,\d', head))
+        points = len(re.findall(r'\d\.\d', head))
+        opts['decimal'] = ',' if commas > points else '.'
+    return opts
+
+def sniffDates(df):
+    """把预览表中全部为日期的文本列解析为日期，返回转换的列名"""
+
+    dates = []
+    for j in range(len(df.columns)):
+        values = df.iloc[:, j]
+        if values.dtype != object or values.isnull().all():
+            continue
+        if pd.api.types.infer_dtype(values, skipna=True) != 'string':
+            continue
+        try:
+            parsed = pd.to_datetime(values, errors='raise')
+        except (ValueError, TypeError, OverflowError):
+            continue
+        df.isetitem(j, parsed)
+        dates.append(df.columns[j])
+    return dates
+
+def chooseEngine(filename, kwargs, sample=None):
+    """
+    选项 kwargs 的 engine 为 'auto' 或未给出时 read_csv 使用的解析器：
+    已安装且支持这些选项时用 pyarrow，只在选项需要时用 python，否则用 c。
+    文件样本中没有出现的注释字符会被去掉，不妨碍使用 pyarrow。
+    返回解析器和与之配用的选项。
+    """
+
+    kwargs = dict(kwargs)
+    engine = kwargs.get('engine') or 'auto'
+    sep = kwargs.get('sep')
+    if sep == r'\t':
+        sep = kwargs['sep'] = '\t'
+    if engine != 'auto':
+        return engine, kwargs
+    if kwargs.get('skipfooter') or (sep is not None and len(sep) > 1 and sep != r'\s+'):
+        #regular expression separators
+        engine = 'python'
+    else:
+        comment = kwargs.get('comment')
+        if comment:
+            if sample is None:
+                sample = sampleBytes(filename)
+            encoding = kwargs.get('encoding') or 'utf-8'
+            if sample is not None and comment.encode(encoding, 'ignore') not in sample:
+                kwargs['comment'] = None
+        unsupported = [k for k in ARROWUNSUPPORTED if kwargs.get(k)]
+        if kwargs.get('decimal') not in ['.', None]:
+            unsupported.append('decimal')
+        if kwargs.get('quotechar') not in ['"', None]:
+            unsupported.append('quotechar')
+        if len(unsupported) == 0 and sep != r'\s+' and hasPyarrow():
+            engine = 'pyarrow'
+        else:
+            engine = 'c'
+    kwargs['engine'] = engine
+    return engine, kwargs
+
+def estimateTime(filename, kwargs, sample=None):
+    """由解析样本的时间估计按 read_csv 选项读取整个文件的秒数，
+    无法估计时返回 None"""
+
+    if os.path.splitext(filename)[1].lower() in COMPRESSION:
+        return
+    if sample is None:
+        sample = sampleBytes(filename)
+    if not sample:
+        return
+    start = time.time()
+    try:
+        pd.read_csv(io.BytesIO(sample), **kwargs)
+    except Exception:
+        return
+    return (time.time() - start) * os.path.getsize(filename) / len(sample)
+
+def arrowStrings(df):
+    """文本列改用 Arrow 字符串保存，比 python 字符串对象省内存得多"""
+
+    for j in range(len(df.columns)):
+        values = df.iloc[:, j]
+        if values.dtype == object and \
+            pd.api.types.infer_dtype(values, skipna=True) == 'string':
+            df.isetitem(j, values.astype('string[pyarrow]'))
+    return df
+
+def readCSV(filename, dtypes=None, chunksize=CHUNKROWS, publish=None,
+            arrowstrings=False, **kwargs):
+    """
+    分块把 CSV 文件读入 FrameBuffer 并返回表格。在任务中运行：报告已读
+    字节和每秒行数，任务取消时停止，并把已读的行传给 publish(frame)，
+    第一块立即传，之后每 PUBLISHINTERVAL 秒一次。dtypes 为预览得到的
+    列类型，用于所有块。kwargs 传给 read_csv，默认解析器见 chooseEngine。
+    pyarrow 解析器的记录批次也进入同一缓冲区，出现与预览类型不符以外的
+    错误时改用 c 解析器重新读取。arrowstrings 为 True 时文本列保存为
+    Arrow 字符串。
+    """
+
+    engine, kwargs = chooseEngine(filename, kwargs)
+    total = os.path.getsize(filename)
+    compression = COMPRESSION.get(os.path.splitext(filename)[1].lower())
+    def chunked(options):
+        return readChunks(filename, total, compression, chunksize, publish, options)
+    df = None
+    if engine == 'pyarrow' and compression not in ARROWSTREAMS:
+        engine = kwargs['engine'] = 'c'
+    if engine == 'pyarrow':
+        try:
+            df = readArrowTyped(filename, total, compression, publish, dtypes, kwargs)
+        except jobs.Cancelled:
+            raise
+        except Exception:
+            jobs.report('pyarrow 无法读取，改用 c 引擎')
+            kwargs['engine'] = 'c'
+    if df is None:
+        df = readTyped(chunked, dtypes, kwargs)
+    if arrowstrings == True:
+        df = arrowStrings(df)
+    return df
+
+def readTyped(read, dtypes, kwargs):
+    """按 read_csv 选项调用 read，先用预览类型，再用放宽的类型，最后自行
+    推断类型。只有按给定类型转换取值出错时才重试。"""
+
+    if not dtypes:
+        return read(kwargs)
+    types, dates = csvTypes(dtypes)
+    kwargs = dict(kwargs, parse_dates=dates or False)
+    relaxed = relaxTypes(types)
+    for attempt in [types, relaxed]:
+        try:
+            return read(dict(kwargs, dtype=attempt))
+        except (pd.errors.ParserError, UnicodeError):
+            raise
+        except (ValueError, TypeError, OverflowError):
+            #a later chunk does not fit the preview types
+            jobs.report('类型与预览不符，重新读取')
+        if relaxed == types:
+            break
+    return read(kwargs)
+
+def readChunks(filename, total, compression, chunksize, publish, kwargs):
+    """按给定的 read_csv 选项读取文件的所有块"""
+
+    with open(filename, 'rb') as handle:
+        reader = pd.read_csv(handle, chunksize=chunksize, compression=compression, **kwargs)
+        with reader:
+            return bufferChunks(reader, handle, total, publish)
+
+def bufferChunks(chunks, handle, total, publish):
+    """把 chunks 中的表追加到 FrameBuffer，按读取它们的文件句柄位置
+    报告进度"""
+
+    buffer = FrameBuffer()
+    start = last = time.time()
+    for chunk in chunks:
+        buffer.append(chunk)
+        done = handle.tell()
+        if buffer.n == len(chunk) and done > 0 and done < total:
+            #preallocate for the rows expected from the size read so far
+            buffer.reserve(int(buffer.n * total / done * 1.05))
+        rate = buffer.n / max(time.time() - start, 1e-6)
+        jobs.report('%s / %s, %d 行/秒' %(formatBytes(done), formatBytes(total), rate),
+                    min(done / max(total, 1), 1.0))
+        now = time.time()
+        if publish is not None and (buffer.n == len(chunk) or now - last > PUBLISHINTERVAL):
+            publish(buffer.frame())
+            last = now
+    buffer.trim()
+    return buffer.frame()
+
+def arrowType(dtype):
+    """预览列类型对应的 pyarrow 类型，返回 None 时由 pyarrow 推断"""
+
+    import pyarrow as pa
+    try:
+        kind = np.dtype(dtype).kind
+    except TypeError:
+        return
+    return {'i': pa.int64(), 'u': pa.uint64(), 'f': pa.float64(),
+            'b': pa.bool_(), 'O': pa.string()}.get(kind)
+
+def arrowOptions(kwargs, types):
+    """由 read_csv 选项和按列名的列类型得到 pyarrow.csv 的读取、解析和
+    转换选项"""
+
+    import pyarrow.csv as pacsv
+    encoding = kwargs.get('encoding') or 'utf8'
+    if encoding.lower().replace('-', '').replace('_', '') in ['utf8', 'utf8sig', 'ascii']:
+        encoding = 'utf8'
+    header = kwargs.get('header', 'infer')
+    noheader = header is None
+    read = pacsv.ReadOptions(block_size=ARROWBLOCKBYTES, encoding=encoding,
+                             autogenerate_column_names=noheader)
+    parse = pacsv.ParseOptions(delimiter=kwargs.get('sep') or ',',
+                               quote_char=kwargs.get('quotechar') or '"',
+                               ignore_empty_lines=kwargs.get('skip_blank_lines', True) != False)
+    columns = {}
+    for name, dtype in types.items():
+        t = arrowType(dtype)
+        if t is None:
+            continue
+        if noheader:
+            #autogenerated names are f0, f1, ...
+            name = 'f%s' %name
+        columns[str(name)] = t
+    convert = pacsv.ConvertOptions(column_types=columns, strings_can_be_null=True)
+    return read, parse, convert
+
+def readArrowChunks(filename, total, compression, publish, kwargs, types, dates):
+    """用 pyarrow.csv.open_csv 流式读取文件，每个记录批次像 read_csv 的块
+    一样追加到 FrameBuffer。dates 中的列在每批读入后解析为日期。"""
+
+    import pyarrow.csv as pacsv
+    read, parse, convert = arrowOptions(kwargs, types)
+    noheader = kwargs.get('header', 'infer') is None
+    with open(filename, 'rb') as handle:
+        stream = handle
+        if compression == 'gzip':
+            stream = gzip.GzipFile(fileobj=handle)
+        elif compression == 'bz2':
+            stream = bz2.BZ2File(handle)
+        elif compression == 'xz':
+            stream = lzma.LZMAFile(handle)
+        jobs.report('pyarrow 读取 %s' %formatBytes(total))
+        reader = pacsv.open_csv(stream, read_options=read, parse_options=parse,
+                                convert_options=convert)
+        def frames():
+            for batch in reader:
+                df = batch.to_pandas()
+                if noheader:
+                    df.columns = range(len(df.columns))
+                for name in dates:
+                    if name in df.columns and not pd.api.types.is_datetime64_any_dtype(df[name]):
+                        try:
+                            df[name] = pd.to_datetime(df[name])
+                        except (ValueError, TypeError, OverflowError):
+                            pass
+                yield df
+        return bufferChunks(frames(), handle, total, publish)
+
+def readArrowTyped(filename, total, compression, publish, dtypes, kwargs):
+    """用预览类型以 pyarrow 读取，只有某批的值无法转换为这些类型时才
+    放宽类型重读，其他错误直接抛出"""
+
+    import pyarrow as pa
+    types, dates = csvTypes(dtypes or {})
+    relaxed = relaxTypes(types)
+    for attempt in [types, relaxed]:
+        try:
+            return readArrowChunks(filename, total, compression, publish, kwargs,
+                                   attempt, dates)
+        except pa.ArrowInvalid as e:
+            if 'conversion error' not in str(e) or relaxed == types or attempt is relaxed:
+                raise
+            jobs.report('类型与预览不符，重新读取')
+
+def iterFiles(filenames, read=pd.read_csv, workers=FILEWORKERS, processes=False):
+    """
+    在线程池中读取文件，同时最多 workers 个。文件读完时产生
+    (位置, 文件名, 表格, 错误)，无法读取时错误为消息文本。报告已完成的
+    文件，任务取消时停止。processes 为 True 时在工作进程中读取，用于
+    占用 GIL 的读取函数，此时 read 必须可以 pickle。filenames 可以是
+    传给 read 的任意键，例如工作表名。
+    """
+
+    from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, \
+        wait, FIRST_COMPLETED
+    files = iter(enumerate(filenames))
+    pending = {}
+    done = 0
+    if processes == True:
+        import multiprocessing
+        #forking a process running Qt threads is not safe
+        pool = ProcessPoolExecutor(max(1, workers), mp_context=multiprocessing.get_context('spawn'))
+    else:
+        pool = ThreadPoolExecutor(max(1, workers))
+    try:
+        while True:
+            #start files until workers are in flight
+            while len(pending) < workers:
+                item = next(files, None)
+                if item is None:
+                    break
+                pending[pool.submit(read, item[1])] = item
+            if len(pending) == 0:
+                break
+            finished, rest = wait(list(pending), timeout=0.5, return_when=FIRST_COMPLETED)
+            jobs.checkCancelled()
+            for future in finished:
+                i, f = pending.pop(future)
+                try:
+                    df = future.result()
+                    error = None
+                except Exception as e:
+                    df = None
+                    error = str(e)
+                done += 1
+                jobs.report('%d/%d %s' %(done, len(filenames), os.path.basename(str(f))),
+                            done / len(filenames))
+                yield i, f, df, error
+    finally:
+        #files still being read when cancelled are not waited for
+        pool.shutdown(wait=len(pending) == 0, cancel_futures=True)
+    return
+
+def sourceLabels(filenames):
+    """文件的简短唯一标签，为相对于共同目录的路径"""
+
+    if len(filenames) == 1:
+        return [os.path.basename(filenames[0])]
+    base = os.path.commonpath([os.path.abspath(f) for f in filenames])
+    if os.path.isfile(base):
+        base = os.path.dirname(base)
+    return [os.path.relpath(os.path.abspath(f), base) for f in filenames]
+
+def missingValue(dtype):
+    if dtype.kind in 'mM':
+        return np.datetime64('NaT')
+    return np.nan
+
+def extensionType(a, b):
+    """两列类型 a、b 中有扩展类型时 concat 得到的类型，例如 Int64 与
+    int64 得到 Int64，类别不同的分类列得到 object"""
+
+    empty = [pd.Series([], dtype=a), pd.Series([], dtype=b)]
+    return pd.concat(empty, ignore_index=True).dtype
+
+def missingArray(dtype, n):
+    """扩展类型的 n 个缺失值组成的数组"""
+
+    empty = dtype.construct_array_type()._from_sequence([], dtype=dtype)
+    return empty.take(np.full(n, -1, dtype=np.int64), allow_fill=True)
+
+def concatFrames(frames, sources=None, sourcecol='source'):
+    """
+    把多个表合并为一个，列为所有表的列的并集，一次写入预先分配的列，
+    每个表复制后即释放。列类型放宽到能容纳所有表的值，某些表中没有的列
+    为缺失值。Int64、分类、字符串等扩展类型在所有表类型相同时保留，
+    否则按 concat 的规则合并。sources 可为每个表给出标签，保存在分类列
+    sourcecol 中。
+    """
+
+    columns = []
+    types = {}
+    for df in frames:
+        for j, c in enumerate(df.columns):
+            dtype = df.dtypes.iloc[j]
+            if c not in types:
+                columns.append(c)
+                types[c] = dtype
+            elif isinstance(dtype, np.dtype) and isinstance(types[c], np.dtype):
+                types[c] = commonType(types[c], dtype)
+            elif dtype != types[c]:
+                types[c] = extensionType(types[c], dtype)
+    for c in columns:
+        if not isinstance(types[c], np.dtype):
+            #extension arrays hold missing values of their own type
+            continue
+        if any([c not in df.columns for df in frames]):
+            if types[c].kind in 'iu':
+                types[c] = np.dtype('float64')
+            elif types[c].kind not in 'fmMO':
+                types[c] = np.dtype(object)
+    total = sum([len(df) for df in frames])
+    #extension columns are collected per frame and joined at the end
+    arrays = [np.empty(total, dtype=types[c]) if isinstance(types[c], np.dtype) else []
+              for c in columns]
+    codes = np.empty(total, dtype=np.int32)
+    pos = 0
+    for k in range(len(frames)):
+        df = frames[k]
+        frames[k] = None
+        end = pos + len(df)
+        names = list(df.columns)
+        for j, c in enumerate(columns):
+            target = arrays[j]
+            if isinstance(target, list):
+                if c not in names:
+                    target.append(missingArray(types[c], end-pos))
+                else:
+                    values = df.iloc[:, names.index(c)]
+                    if values.dtype != types[c]:
+                        values = values.astype(types[c])
+                    target.append(values.array)
+                continue
+            if c not in names:
+                target[pos:end] = missingValue(target.dtype)
+                continue
+            values = df.iloc[:, names.index(c)]
+            if target.dtype == object and values.dtype != object:
+                values = values.astype(object)
+            target[pos:end] = values.to_numpy()
+        codes[pos:end] = k
+        pos = end
+        jobs.checkCancelled()
+    for j, c in enumerate(columns):
+        if isinstance(arrays[j], list):
+            arrays[j] = types[c].construct_array_type()._concat_same_type(arrays[j])
+    data = dict([(j, a) for j, a in enumerate(arrays)])
+    df = pd.DataFrame(data, index=pd.RangeIndex(total), copy=False)
+    df.columns = columns
+    if sources is not None:
+        name = sourcecol
+        while name in columns:
+            name = '_' + name
+        df[name] = pd.Categorical.from_codes(codes, categories=sources)
+    return df
+
+def concatFiles(filenames, read=pd.read_csv, workers=FILEWORKERS, source=False):
+    """并行读取文件并按文件顺序合并，见 iterFiles 和 concatFrames。
+    返回表格以及无法读取的文件的 (文件名, 错误) 列表。"""
+
+    frames = {}
+    errors = []
+    for i, f, df, error in iterFiles(filenames, read, workers):
+        if error is not None:
+            errors.append((f, error))
+        else:
+            frames[i] = df
+    order = sorted(frames.keys())
+    labels = sourceLabels(filenames)
+    sources = None
+    if source == True:
+        sources = [labels[i] for i in order]
+    jobs.report('合并 %d 个文件' %len(order))
+    df = concatFrames([frames.pop(i) for i in order], sources)
+    return df, errors
+
+def readEachFile(filenames, read=pd.read_csv, workers=FILEWORKERS, publish=None,
+                 processes=False):
+    """并行读取文件，按文件顺序把每个文件的 (文件名, 表格) 传给 publish。
+    返回无法读取的文件的 (文件名, 错误) 列表。"""
+
+    results = {}
+    errors = []
+    nextfile = 0
+    for i, f, df, error in iterFiles(filenames, read, workers, processes):
+        results[i] = (f, df, error)
+        while nextfile in results:
+            f, df, error = results.pop(nextfile)
+            nextfile += 1
+            if error is not None:
+                errors.append((f, error))
+            elif publish is not None:
+                publish((f, df))
+    return errors
+
+#workbooks larger than this are read in worker processes
+PROCESSBYTES = 20*1048576
+#extensions of Arrow IPC files
+ARROWEXT = ['.feather', '.arrow', '.ipc']
+#rows taken from a mapped table for each batch written by an export
+EXPORTROWS = 100000
+#row filter operators for Parquet files, passed to the reader
+PARQUETOPS = ['==','!=','<','<=','>','>=','in','not in']
+
+def parquetInfo(filename):
+    """Parquet 文件的结构和行组，从文件尾部的元数据读取。返回各列名称
+    和类型的表，以及各行组行数和字节数的表。"""
+
+    import pyarrow.parquet as pq
+    f = pq.ParquetFile(filename)
+    meta = f.metadata
+    schema = f.schema_arrow
+    index = indexColumns(schema)
+    cols = pd.DataFrame([[n, str(t)] for n, t in zip(schema.names, schema.types)
+                         if n not in index], columns=['name','type'])
+    groups = [[i, meta.row_group(i).num_rows, formatBytes(meta.row_group(i).total_byte_size)]
+              for i in range(meta.num_row_groups)]
+    groups = pd.DataFrame(groups, columns=['group','rows','bytes'])
+    return cols, groups
+
+def indexColumns(schema):
+    """pandas 保存在 Arrow schema 中的索引列名"""
+
+    meta = schema.pandas_metadata or {}
+    return [c for c in meta.get('index_columns', []) if isinstance(c, str)]
+
+def parquetValue(text, type):
+    """过滤值文本按所在列的 Arrow 类型转换后的值"""
+
+    import pyarrow as pa
+    if pa.types.is_dictionary(type):
+        type = type.value_type
+    if pa.types.is_string(type) or pa.types.is_large_string(type):
+        return text
+    return pa.scalar(text).cast(type).as_py()
+
+def readParquet(filename, columns=None, filters=None):
+    """
+    在任务中读取 Parquet 文件。只解码给定的列，filters 为
+    (列, 运算符, 文本) 的列表，交给读取器，统计信息排除的行组直接跳过。
+    报告已读行数，任务取消时停止。
+    """
+
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+    dataset = ds.dataset(filename, format='parquet')
+    schema = dataset.schema
+    expr = None
+    if filters:
+        terms = []
+        for col, op, text in filters:
+            type = schema.field(col).type
+            if op in ['in', 'not in']:
+                value = [parquetValue(t.strip(), type) for t in text.split(',')]
+            else:
+                value = parquetValue(text, type)
+            terms.append((col, op, value))
+        expr = pq.filters_to_expression(terms)
+    if columns is not None:
+        #keep the index stored by pandas
+        columns = list(columns) + [c for c in indexColumns(schema) if c not in columns]
+    scanner = dataset.scanner(columns=columns, filter=expr)
+    batches = []
+    rows = 0
+    start = time.time()
+    for batch in scanner.to_batches():
+        batches.append(batch)
+        rows += batch.num_rows
+        jobs.report('%d 行, %d 行/秒' %(rows, rows/max(time.time()-start, 1e-3)))
+    table = pa.Table.from_batches(batches, schema=scanner.projected_schema)
+    del batches
+    return table.to_pandas(split_blocks=True, self_destruct=True)
+
+def writeParquet(df, filename, compression='snappy', rowgroup=None):
+    """按给定的压缩方式和每行组行数把表格写入 Parquet 文件"""
+
+    if compression == 'none':
+        compression = None
+    df.to_parquet(filename, compression=compression, row_group_size=rowgroup or None)
+    return
+
+def writeArrow(data, filename, compression='uncompressed'):
+    """把表格或 pyarrow 表写入 Arrow IPC (Feather v2) 文件。表格的数值列
+    不复制地交给 Arrow，未压缩的文件打开时可以内存映射。"""
+
+    import pyarrow.feather as feather
+    feather.write_feather(data, filename, compression=compression)
+    return
+
+def takeBatches(table, rows, size=EXPORTROWS):
+    """按批取出 pyarrow 表中位置为 rows 的行，rows 为 None 时按文件顺序切片。
+    返回 (文件位置, 表) 的迭代器"""
+
+    n = table.num_rows if rows is None else len(rows)
+    size = max(int(size), 1)
+    for start in range(0, n, size):
+        jobs.checkCancelled()
+        jobs.report('已写出 %d/%d 行' %(start, n), start/n)
+        if rows is None:
+            pos = np.arange(start, min(start+size, n))
+            yield pos, table.slice(start, size)
+        else:
+            pos = rows[start:start+size]
+            yield pos, table.take(pos)
+    return
+
+def writeMapped(table, rows, filename, labels=None, compression=None, rowgroup=None):
+    """把内存映射的 pyarrow 表中 rows 行写入文件，在任务中按批取行并写出，
+    不把整个表读成 DataFrame。labels 根据文件位置给出行标签，用于 csv 等
+    按 DataFrame 写出的格式"""
+
+    import pyarrow as pa
+    ext = os.path.splitext(filename)[1]
+    if ext == '.parquet':
+        import pyarrow.parquet as pq
+        if compression == 'none':
+            compression = None
+        #each batch is one row group
+        size = rowgroup or EXPORTROWS
+        with pq.ParquetWriter(filename, table.schema, compression=compression) as w:
+            for pos, t in takeBatches(table, rows, size):
+                w.write_table(t, row_group_size=size)
+        return
+    if ext in ARROWEXT:
+        if compression == 'uncompressed':
+            compression = None
+        opts = pa.ipc.IpcWriteOptions(compression=compression)
+        with pa.ipc.new_file(filename, table.schema, options=opts) as w:
+            for pos, t in takeBatches(table, rows):
+                w.write_table(t)
+        return
+    def frames():
+        for pos, t in takeBatches(table, rows):
+            df = t.to_pandas()
+            if labels is not None:
+                df.index = labels(pos)
+            yield df
+    if ext == '.hdf5':
+        pd.concat(list(frames())).to_hdf(filename, key='df')
+    elif ext in ['.xls', '.xlsx']:
+        #a sheet is written from one frame
+        pd.concat(list(frames())).to_excel(filename)
+    else:
+        header = True
+        with open(filename, 'w', newline='') as f:
+            for df in frames():
+                df.to_csv(f, header=header)
+                header = False
+    return
+
+def columnNumber(letters):
+    """电子表格列名对应的列号，A 为 1"""
+
+    n = 0
+    for c in letters:
+        n = n * 26 + ord(c) - ord('A') + 1
+    return n
+
+def xlsxSheets(filename):
+    """由 workbook 部件和各工作表开头的 dimension 元素得到 xlsx 工作簿的
+    工作表名和大小，不读取单元格"""
+
+    import re
+    import zipfile
+    import xml.etree.ElementTree as ET
+    main = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+    relid = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}id'
+    rows = []
+    with zipfile.ZipFile(filename) as z:
+        book = ET.fromstring(z.read('xl/workbook.xml'))
+        rels = ET.fromstring(z.read('xl/_rels/workbook.xml.rels'))
+        targets = dict([(r.get('Id'), r.get('Target')) for r in rels])
+        for sheet in book.iter(main + 'sheet'):
+            target = targets.get(sheet.get(relid), '')
+            path = target[1:] if target.startswith('/') else 'xl/' + target
+            nrows = ncols = None
+            if path in z.namelist():
+                with z.open(path) as f:
+                    head = f.read(4096)
+                m = re.search(rb'<(?:\w+:)?dimension ref="([A-Z]+)(\d+)(?::([A-Z]+)(\d+))?"', head)
+                if m is not None:
+                    first, top, last, bottom = [g.decode() if g else None for g in m.groups()]
+                    last, bottom = last or first, bottom or top
+                    nrows = int(bottom) - int(top) + 1
+                    ncols = columnNumber(last) - columnNumber(first) + 1
+            rows.append([sheet.get('name'), nrows, ncols])
+    return rows
+
+def excelSheets(filename):
+    """
+    工作簿各工作表的名称和大小 [名称, 行数, 列数] 的列表，以及错误。xlsx
+    文件从工作簿元数据读取，不加载单元格，没有记录大小时为 None；元数据
+    无法读取时改用 pandas 取得工作表名，错误为其消息，否则为 None。
+    """
+
+    error = None
+    if os.path.splitext(filename)[1].lower() in ['.xlsx', '.xlsm']:
+        try:
+            return xlsxSheets(filename), None
+        except Exception as e:
+            error = str(e)
+    with pd.ExcelFile(filename) as f:
+        return [[name, None, None] for name in f.sheet_names], error
+
+def excelEngine(filename):
+    """已安装的最快的工作簿读取器，返回 None 时使用 pandas 默认读取器，
+    它以只读模式用 openpyxl 读取 xlsx 文件"""
+
+    if os.path.splitext(filename)[1].lower() == '.xlsb':
+        return 'pyxlsb'
+    version = tuple([int(v) for v in pd.__version__.split('.')[:2]])
+    if version >= (2, 2):
+        try:
+            import python_calamine
+            return 'calamine'
+        except ImportError:
+            pass
+    return
+
+def readSheets(filename, sheets, workers=FILEWORKERS, publish=None):
+    """并行读取工作簿中给定的工作表，按顺序把每个工作表的 (工作表, 表格)
+    传给 publish。大于 PROCESSBYTES 的工作簿在工作进程中读取，较小的
+    不值得启动进程。返回无法读取的工作表的 (工作表, 错误) 列表。"""
+
+    import functools
+    read = functools.partial(pd.read_excel, filename, engine=excelEngine(filename))
+    workers = min(workers, len(sheets))
+    processes = len(sheets) > 1 and os.path.getsize(filename) > PROCESSBYTES
+    return readEachFile(sheets, read, workers, publish, processes)
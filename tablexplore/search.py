@@ -0,0 +1,498 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    tablexplore 的表格搜索
+    创建于 2026 年 10 月
+    版权所有 (C) Damien Farrell
+
+    按列向量化地查找匹配单元格。数值列在查询不可能匹配时直接跳过，
+    分类列只匹配类别值。结果按行块分批产生，可在后台线程中运行并随时取消。
+    大表的文本列可建立索引：唯一值的三元组索引加上值到行的倒排表，
+    子串、前缀和相等查询只需检查唯一值。
+"""
+
+from __future__ import absolute_import, division, print_function
+import copy
+import threading
+import weakref
+import numpy as np
+import pandas as pd
+
+#tables with fewer rows are searched directly
+MINROWS = 50000
+#columns with more unique values get no trigram index
+MAXTRIGRAM = 500000
+#characters that can appear in the string form of a finite number
+NUMCHARS = set('0123456789.-+e')
+INTCHARS = set('0123456789-')
+REGEXCHARS = set('.^$*+?{}[]\\|()')
+
+def isLiteral(query):
+    """查询不含正则表达式特殊字符时为 True"""
+
+    return len(set(query) & REGEXCHARS) == 0
+
+def canMatchNumbers(query, kind='f', case=True, literal=True):
+    """字面查询永远无法匹配给定类型种类的格式化数字时为 False"""
+
+    if not literal:
+        return True
+    if not case:
+        query = query.lower()
+    if kind in 'iu':
+        return set(query) <= INTCHARS
+    return set(query) <= NUMCHARS or query in 'nan' or query in '-inf'
+
+def matchSpecial(arr, query, case=True):
+    """只能匹配 nan/inf 的字面查询对应的浮点掩码"""
+
+    if not case:
+        query = query.lower()
+    mask = np.zeros(len(arr), dtype=bool)
+    if query in 'nan':
+        mask |= np.isnan(arr)
+    if query in 'inf':
+        mask |= np.isinf(arr)
+    elif query in '-inf':
+        mask |= np.isneginf(arr)
+    return mask
+
+def matchValues(values, query, case=True, literal=True):
+    """字符串形式包含查询的值的布尔数组。values 为 series，query 为子串或正则表达式"""
+
+    dtype = values.dtype
+    if isinstance(dtype, pd.CategoricalDtype):
+        #match each category once then map the codes
+        cats = pd.Series(values.cat.categories.astype(str))
+        found = cats.str.contains(query, case=case, regex=not literal, na=False).to_numpy()
+        codes = values.cat.codes.to_numpy()
+        mask = np.zeros(len(values), dtype=bool)
+        inside = codes >= 0
+        mask[inside] = found[codes[inside]]
+        if matchValues(pd.Series(['nan']), query, case, literal)[0]:
+            mask[~inside] = True
+        return mask
+    if isinstance(dtype, np.dtype) and dtype.kind in 'iuf':
+        if not canMatchNumbers(query, dtype.kind, case, literal):
+            return np.zeros(len(values), dtype=bool)
+        arr = values.to_numpy()
+        q = query if case else query.lower()
+        if literal and dtype.kind == 'f' and not set(q) <= NUMCHARS:
+            return matchSpecial(arr, query, case)
+        #format the numbers once with numpy, much faster than per value
+        values = pd.Series(arr.astype(str).astype(object))
+    else:
+        values = values.astype('object').astype('str')
+    return values.str.contains(query, case=case, regex=not literal, na=False).to_numpy()
+
+def isTextColumn(dtype):
+    """为其建立文本索引的列返回 True"""
+
+    if isinstance(dtype, pd.CategoricalDtype) or isinstance(dtype, pd.StringDtype):
+        return True
+    return isinstance(dtype, np.dtype) and dtype.kind == 'O'
+
+def trigrams(text):
+    return set(text[i:i+3] for i in range(len(text)-2))
+
+class ColumnIndex(object):
+    """
+    单列的文本索引。每行保存唯一值的编号，按编号排序得到每个值的行列表。
+    唯一值的小写三元组在检查候选值之前缩小子串查询的范围。
+    """
+    def __init__(self, values):
+        codes, uniques = pd.factorize(values)
+        self.codes = codes.astype(np.int64)
+        texts = [str(u) for u in uniques]
+        missing = np.flatnonzero(self.codes < 0)
+        if len(missing) > 0:
+            #missing values get the text a scan gives them, e.g. None
+            #and nan stay apart
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                extra = np.zeros(len(missing), dtype=np.int64)
+                more = ['nan']
+            else:
+                extra, more = pd.factorize(values.iloc[missing].astype('object').astype('str'))
+            self.codes[missing] = len(texts) + extra
+            texts.extend(more)
+        self.texts = np.array(texts, dtype=object)
+        #ids of missing values, these only match a contains query
+        self.nulls = np.zeros(len(texts), dtype=bool)
+        self.nulls[len(uniques):] = True
+        self.lookup = None
+        self.lowered = None
+        self.grams = None
+        self.order = None
+        #True while a frozen copy shares the codes and trigrams
+        self.shared = False
+        if len(self.texts) <= MAXTRIGRAM:
+            self.buildGrams()
+        return
+
+    def __len__(self):
+        return len(self.codes)
+
+    def lowerTexts(self):
+
+        if self.lowered is None or len(self.lowered) < len(self.texts):
+            self.lowered = np.array([t.lower() for t in self.texts], dtype=object)
+        return self.lowered
+
+    def buildGrams(self):
+        """把每个小写三元组映射到包含它的值的 id"""
+
+        grams = {}
+        for k, t in enumerate(self.lowerTexts()):
+            for g in trigrams(t):
+                grams.setdefault(g, []).append(k)
+        self.grams = {g: np.array(v, dtype=np.int64) for g, v in grams.items()}
+        return
+
+    def buildOrder(self):
+        """倒排表：值 k 的行为 order[starts[k+1]:starts[k+2]]"""
+
+        self.order = np.argsort(self.codes, kind='stable')
+        counts = np.bincount(self.codes+1, minlength=len(self.texts)+1)
+        self.starts = np.concatenate([[0], np.cumsum(counts)])
+        return
+
+    def candidates(self, query):
+        """可能包含查询的值的 id，全部都可能时为 None"""
+
+        q = query.lower()
+        if self.grams is None or len(q) < 3:
+            return
+        ids = None
+        for g in trigrams(q):
+            p = self.grams.get(g)
+            if p is None:
+                return np.zeros(0, dtype=np.int64)
+            ids = p if ids is None else np.intersect1d(ids, p, assume_unique=True)
+        return ids
+
+    def matchIds(self, query, op='contains', case=True, literal=True):
+        """匹配查询的不重复值的 id"""
+
+        if op == 'equals':
+            return np.flatnonzero((self.texts == query) & ~self.nulls)
+        if op in ['starts with','ends with']:
+            texts = pd.Series(self.texts if case else self.lowerTexts())
+            q = query if case else query.lower()
+            if op == 'starts with':
+                found = texts.str.startswith(q)
+            else:
+                found = texts.str.endswith(q)
+            return np.flatnonzero(found.to_numpy(dtype=bool) & ~self.nulls)
+        ids = None
+        if literal:
+            ids = self.candidates(query)
+        texts = self.texts if ids is None else self.texts[ids]
+        found = pd.Series(texts).str.contains(query, case=case, regex=not literal,
+                                             na=False).to_numpy(dtype=bool)
+        if ids is None:
+            return np.flatnonzero(found)
+        return ids[found]
+
+    def rowsFor(self, ids):
+        """保存任一给定值 id 的排好序的行位置"""
+
+        if len(ids) == 0:
+            return np.zeros(0, dtype=np.int64)
+        if len(ids) > 1000:
+            return np.flatnonzero(np.isin(self.codes, ids))
+        if self.order is None:
+            self.buildOrder()
+        parts = [self.order[self.starts[k+1]:self.starts[k+2]] for k in ids]
+        return np.sort(np.concatenate(parts))
+
+    def match(self, query, op='contains', case=True, literal=True):
+        """匹配查询的行位置，op 为 'contains'、'equals'、'starts with' 或
+        'ends with'。与扫描一样，缺失值按其文本如 'nan' 或 'None' 匹配"""
+
+        return self.rowsFor(self.matchIds(query, op, case, literal))
+
+    def encode(self, values):
+        """新值的编码，未见过的值加入索引"""
+
+        if self.lookup is None:
+            self.lookup = {}
+            for k, t in enumerate(self.texts):
+                #missing values are kept apart from strings with their text
+                self.lookup.setdefault((self.nulls[k], t), k)
+        codes = np.empty(len(values), dtype=np.int64)
+        new = []
+        nulls = []
+        for i, v in enumerate(values):
+            #the same text as astype(str) in a scan
+            t = str(v)
+            key = (bool(pd.isna(v)), t)
+            k = self.lookup.get(key)
+            if k is None:
+                k = len(self.texts) + len(new)
+                self.lookup[key] = k
+                new.append(t)
+                nulls.append(key[0])
+            codes[i] = k
+        if len(new) > 0:
+            first = len(self.texts)
+            self.texts = np.concatenate([self.texts, np.array(new, dtype=object)])
+            self.nulls = np.concatenate([self.nulls, np.array(nulls, dtype=bool)])
+            if self.grams is not None:
+                for k, t in enumerate(new):
+                    for g in trigrams(t.lower()):
+                        p = self.grams.get(g)
+                        k2 = np.array([first+k], dtype=np.int64)
+                        self.grams[g] = k2 if p is None else np.concatenate([p, k2])
+        return codes
+
+    def freeze(self):
+        """供工作线程使用的副本，之后的编辑不会改变它"""
+
+        self.shared = True
+        return copy.copy(self)
+
+    def unshare(self):
+        """原地修改之前，先复制与冻结副本共享的数据"""
+
+        if self.shared:
+            self.codes = self.codes.copy()
+            if self.grams is not None:
+                self.grams = dict(self.grams)
+            self.shared = False
+        return
+
+    def update(self, rows, values):
+        """重新索引给定行位置上的值"""
+
+        self.unshare()
+        self.codes[np.asarray(rows, dtype=np.int64)] = self.encode(values)
+        self.order = None
+        return
+
+    def insertRows(self, first, values):
+
+        self.unshare()
+        self.codes = np.insert(self.codes, first, self.encode(values))
+        self.order = None
+        return
+
+    def removeRows(self, rows):
+
+        self.codes = np.delete(self.codes, rows)
+        self.order = None
+        return
+
+class TableIndex(object):
+    """
+    一个 DataFrame 中文本列的索引，按列位置保存。只弱引用建立索引的表，
+    表被替换后索引自然不再使用。
+    """
+    def __init__(self, df, generation=None, cancelled=None):
+        self.key = weakref.ref(df)
+        self.names = list(df.columns)
+        self.nrows = len(df)
+        self.columns = {}
+        #text columns whose index was dropped after large edits
+        self.stale = set()
+        for j in range(len(df.columns)):
+            if cancelled is not None and cancelled(generation):
+                return
+            if isTextColumn(df.dtypes.iloc[j]):
+                self.columns[j] = ColumnIndex(df.iloc[:,j])
+        return
+
+    def freeze(self):
+        """供工作线程使用的副本，之后的编辑不会改变它"""
+
+        frozen = copy.copy(self)
+        frozen.columns = dict([(j, c.freeze()) for j, c in self.columns.items()])
+        frozen.stale = set(self.stale)
+        return frozen
+
+    def isFor(self, df):
+        """索引是为此表建立时为 True"""
+
+        return self.key() is df
+
+    def setFrame(self, df):
+        """跟随替换了被索引表的新表"""
+
+        self.key = weakref.ref(df)
+        self.names = list(df.columns)
+        self.nrows = len(df)
+        return
+
+    def getColumn(self, name):
+        """该名称列的索引，未索引时为 None"""
+
+        if name not in self.names:
+            return
+        return self.columns.get(self.names.index(name))
+
+    def updateCells(self, df, rows=None, cols=None):
+        """重新索引编辑过的单元格。编辑很多的列被丢弃留待重建，
+        未建索引的文本列也是如此"""
+
+        if cols is None:
+            cols = range(len(df.columns))
+        for j in cols:
+            if j not in self.columns:
+                if isTextColumn(df.dtypes.iloc[j]):
+                    self.stale.add(j)
+                continue
+            if rows is None or len(rows) > len(df)//10 or not isTextColumn(df.dtypes.iloc[j]):
+                del self.columns[j]
+                self.stale.add(j)
+            else:
+                self.columns[j].update(rows, df.iloc[list(rows), j])
+        return
+
+    def insertedColumns(self, df, first, count):
+
+        self.setFrame(df)
+        self.columns = {(j+count if j >= first else j): c
+                        for j, c in self.columns.items()}
+        self.stale = set(j+count if j >= first else j for j in self.stale)
+        for j in range(first, first+count):
+            if isTextColumn(df.dtypes.iloc[j]):
+                self.stale.add(j)
+        return
+
+    def removedColumns(self, df, cols):
+
+        self.setFrame(df)
+        cols = sorted(set(cols))
+        self.columns = {j - int(np.searchsorted(cols, j)): c
+                        for j, c in self.columns.items() if j not in cols}
+        self.stale = set(j - int(np.searchsorted(cols, j))
+                         for j in self.stale if j not in cols)
+        return
+
+    def insertedRows(self, df, first, count):
+
+        self.setFrame(df)
+        for j, c in self.columns.items():
+            c.insertRows(first, df.iloc[first:first+count, j])
+        return
+
+    def removedRows(self, df, rows):
+
+        self.setFrame(df)
+        for c in self.columns.values():
+            c.removeRows(rows)
+        return
+
+class SearchEngine(object):
+    """
+    查找与查询匹配的单元格，按行块逐列处理表格。每块的结果按行序追加到
+    批次中，第一批结果立即可用。取消或开始新的搜索时提前停止。
+    """
+    def __init__(self, chunksize=200000):
+        self.chunksize = chunksize
+        self.generation = 0
+        self.batches = []
+        self.taken = 0
+        self.lock = threading.Lock()
+        return
+
+    def cancel(self):
+        """停止正在运行的搜索"""
+
+        with self.lock:
+            self.generation += 1
+        return
+
+    def start(self):
+        """取消当前搜索并清除结果，返回传给 search 的新代号"""
+
+        with self.lock:
+            self.generation += 1
+            self.batches = []
+            self.taken = 0
+            return self.generation
+
+    def take(self):
+        """上次调用以来新的 (rows, cols) 数组批次"""
+
+        with self.lock:
+            new = self.batches[self.taken:]
+            self.taken = len(self.batches)
+        return new
+
+    def cancelled(self, generation):
+        return self.generation != generation
+
+    def buildIndex(self, df, generation=None, progress_callback=None):
+        """为 df 建立 TableIndex，取消时返回 None"""
+
+        index = TableIndex(df, generation, self.cancelled)
+        if self.cancelled(generation):
+            return
+        return index
+
+    def search(self, df, query, case=True, generation=None, index=None,
+               order=None, progress_callback=None):
+        """在 df 中搜索查询，运行到完成或取消，每个有命中的块之后发出
+        到目前为止的命中数。已索引的列由索引回答。表按排序显示时 order 为
+        按视图顺序的 df 行，命中即为视图行。返回命中总数，取消时返回 None"""
+
+        if generation is None:
+            generation = self.start()
+        literal = isLiteral(query)
+        indexed = {}
+        if index is not None and index.isFor(df):
+            for j, c in index.columns.items():
+                indexed[j] = c.match(query, 'contains', case, literal)
+        nrows = len(df)
+        if order is not None:
+            nrows = len(order)
+            inverse = np.full(len(df), -1, dtype=np.int64)
+            inverse[order] = np.arange(nrows)
+            for j, r in indexed.items():
+                r = inverse[r]
+                indexed[j] = np.sort(r[r >= 0])
+        ncols = len(df.columns)
+        #skip numeric columns once rather than per chunk
+        cols = []
+        for j in range(ncols):
+            dtype = df.dtypes.iloc[j]
+            if isinstance(dtype, np.dtype) and dtype.kind in 'iuf' \
+                and not canMatchNumbers(query, dtype.kind, case, literal):
+                continue
+            cols.append(j)
+        total = 0
+        for start in range(0, nrows, self.chunksize):
+            if order is None:
+                chunk = df.iloc[start:start+self.chunksize]
+            else:
+                chunk = df.iloc[order[start:start+self.chunksize]]
+            rows = []
+            hitcols = []
+            for j in cols:
+                if self.generation != generation:
+                    return
+                if j in indexed:
+                    r = indexed[j]
+                    lo, hi = np.searchsorted(r, [start, start+self.chunksize])
+                    rows.append(r[lo:hi])
+                    hitcols.append(np.full(hi-lo, j))
+                    continue
+                r = np.nonzero(matchValues(chunk.iloc[:,j], query, case, literal))[0]
+                rows.append(r + start)
+                hitcols.append(np.full(len(r), j))
+            if len(rows) == 0:
+                continue
+            rows = np.concatenate(rows)
+            if len(rows) == 0:
+                continue
+            hitcols = np.concatenate(hitcols)
+            byrow = np.lexsort((hitcols, rows))
+            with self.lock:
+                if self.generation != generation:
+                    return
+                self.batches.append((rows[byrow], hitcols[byrow]))
+            total += len(rows)
+            if progress_callback is not None:
+                progress_callback.emit(str(total))
+        return total
@@ -66,6 +66,109 @@ def getPresetData(name):
     df = pd.read_csv(os.path.join(path,'datasets','%s.csv' %name),index_col=0)
     return df
 
+def columnMemory(values):
+    """列占用的内存字节数，包括对象本身"""
+
+    return int(values.memory_usage(index=False, deep=True))
+
+def optimizeColumn(values, catratio=0.5, sparseratio=0.9, arrowstrings=False):
+    """
+    返回占用内存更少且不丢失信息的列，无法缩小时返回原列：
+    整数降为能容纳其取值的最小整数类型，float64 在不损失精度时转为
+    float32，空值比例不低于 sparseratio 的浮点列转为稀疏类型，不同取值
+    不超过 catratio 比例的文本列转为 category，其余文本列在 arrowstrings
+    时转为 Arrow 字符串。
+    """
+
+    dtype = values.dtype
+    if not isinstance(dtype, np.dtype) or len(values) == 0:
+        return values
+    kind = dtype.kind
+    if kind == 'f':
+        if values.isnull().sum() >= sparseratio * len(values):
+            return values.astype(pd.SparseDtype(dtype, np.nan))
+        if dtype == np.float64:
+            small = values.astype(np.float32)
+            if np.array_equal(small.to_numpy(np.float64), values.to_numpy(), equal_nan=True):
+                return small
+    elif kind in 'iu':
+        lo, hi = values.min(), values.max()
+        if lo >= 0:
+            types = [np.uint8, np.uint16, np.uint32]
+        else:
+            types = [np.int8, np.int16, np.int32]
+        for t in types:
+            if np.dtype(t).itemsize >= dtype.itemsize:
+                break
+            if lo >= np.iinfo(t).min and hi <= np.iinfo(t).max:
+                return values.astype(t)
+    elif kind == 'O':
+        if pd.api.types.infer_dtype(values, skipna=True) != 'string':
+            return values
+        if values.nunique(dropna=True) <= catratio * len(values):
+            return values.astype('category')
+        if arrowstrings == True:
+            try:
+                import pyarrow
+            except ImportError:
+                return values
+            return values.astype('string[pyarrow]')
+    return values
+
+def editableColumn(values, value):
+    """
+    返回能写入 value 的列：稀疏列转回普通数组，value 不在类别中的
+    category 列转回类别的类型（文本为 object），其他列原样返回。
+    用于编辑经 optimizeColumn 转换的列。
+    """
+
+    dtype = values.dtype
+    if isinstance(dtype, pd.SparseDtype):
+        return values.sparse.to_dense()
+    if isinstance(dtype, pd.CategoricalDtype):
+        if pd.isnull(value) or value in dtype.categories:
+            return values
+        return values.astype(dtype.categories.dtype)
+    return values
+
+def optimizeDtypes(df, catratio=0.5, sparseratio=0.9, arrowstrings=False, report=None):
+    """
+    缩小表格各列占用的内存，见 optimizeColumn，不修改 df。
+    返回转换后的列（按列位置）和每列转换前后的内存报告。
+    report(text, fraction) 在处理每列前调用，用于显示进度。
+    """
+
+    columns = {}
+    rows = []
+    for j in range(len(df.columns)):
+        name = df.columns[j]
+        if report is not None:
+            report(str(name), j/len(df.columns))
+        values = df.iloc[:, j]
+        new = optimizeColumn(values, catratio, sparseratio, arrowstrings)
+        before = after = columnMemory(values)
+        if new is not values:
+            after = columnMemory(new)
+            if after < before:
+                columns[j] = new
+            else:
+                new = values
+                after = before
+        rows.append([name, str(values.dtype), str(new.dtype), before, after])
+    info = pd.DataFrame(rows, columns=['column','type','new type','bytes','new bytes'])
+    return columns, info
+
+def memoryReport(info):
+    """优化内存报告的文本，各列及合计的前后内存"""
+
+    info = info.copy()
+    total = info[['bytes','new bytes']].sum()
+    info.loc[len(info)] = ['合计', '', '', total['bytes'], total['new bytes']]
+    info['saved'] = (1 - info['new bytes'] / info['bytes'].clip(lower=1)).map('{:.0%}'.format)
+    for c in ['bytes','new bytes']:
+        info[c] = (info[c] / 1048576).map('{:.2f} MB'.format)
+    return info.to_string(index=False)
+
 def check_multiindex(index):
     """检查索引是否为 MultiIndex"""
 